@@ -0,0 +1,3 @@
+# Reusable engine code for the speed dating analysis.
+# The notebook (speed_dating_analysis.ipynb) imports from these modules
+# where a step has outgrown a single notebook cell.
@@ -0,0 +1,233 @@
+import numpy as np
+
+
+# Mergeable per-group statistics for a set of rating columns.
+# For each group it holds the number of rows, the number of successes
+# (dec_o = 1) and, per column, the number of non-NULL values, their mean and
+# M2 (the sum of squared deviations from the mean). Two GroupStats are merged
+# exactly with Chan's formula so partial results from chunks or shards can be
+# combined without revisiting the rows.
+
+# Parameters:
+#   - key_names (list): the names of the grouping keys, e.g. ['iid', 'gender']
+#   - keys (array): 2D array with one row of key values per group
+#   - columns (list): the names of the rating columns
+#   - count (array): the number of rows per group
+#   - successes (array): the sum of dec_o per group
+#   - n (array): the number of non-NULL values per group and column
+#   - mean (array): the mean per group and column
+#   - m2 (array): the sum of squared deviations per group and column
+
+class GroupStats:
+
+    def __init__(self, key_names : list, keys, columns : list, count, successes, n, mean, m2):
+        self.key_names = list(key_names)
+        self.keys = keys
+        self.columns = list(columns)
+        self.count = count
+        self.successes = successes
+        self.n = n
+        self.mean = mean
+        self.m2 = m2
+
+    # Returns the values of a grouping key per group
+
+    # Parameters:
+    #   - name (str): the name of the key
+
+    def key(self, name : str):
+        return self.keys[:, self.key_names.index(name)]
+
+    # Returns the index of a rating column
+
+    # Parameters:
+    #   - column (str): the name of the column
+
+    def _column(self, column : str):
+        return self.columns.index(column)
+
+    # Returns the sum of a column per group
+
+    # Parameters:
+    #   - column (str): the name of the column
+
+    def total(self, column : str):
+        i = self._column(column)
+        return self.mean[:, i] * self.n[:, i]
+
+    # Returns the mean of a column per group
+
+    # Parameters:
+    #   - column (str): the name of the column
+
+    def average(self, column : str):
+        i = self._column(column)
+        return np.where(self.n[:, i] > 0, self.mean[:, i], np.nan)
+
+    # Returns the variance of a column per group
+
+    # Parameters:
+    #   - column (str): the name of the column
+    #   - ddof (int): delta degrees of freedom (0 for the population variance
+    #                 used by the analysis queries)
+
+    def variance(self, column : str, ddof : int = 0):
+        i = self._column(column)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.m2[:, i] / (self.n[:, i] - ddof)
+
+    # Returns the proportion of rows per group where dec_o = 1
+
+    def success_ratio(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.successes / self.count
+
+    # Returns the statistics of this and another GroupStats combined exactly.
+    # Groups present in both are merged with Chan's formula.
+
+    # Parameters:
+    #   - other (GroupStats): statistics over the same key names and columns
+
+    def merge(self, other):
+        if self.key_names != other.key_names or self.columns != other.columns:
+            raise ValueError('GroupStats can only be merged over the same keys and columns')
+
+        keys, group_ids = unique_keys(np.vstack([self.keys, other.keys]))
+
+        merged = empty_stats(self.key_names, keys, self.columns)
+
+        for part, ids in ((self, group_ids[:len(self.keys)]),
+                          (other, group_ids[len(self.keys):])):
+            part_stats = empty_stats(self.key_names, keys, self.columns)
+            part_stats.count[ids] = part.count
+            part_stats.successes[ids] = part.successes
+            part_stats.n[ids] = part.n
+            part_stats.mean[ids] = part.mean
+            part_stats.m2[ids] = part.m2
+            merge_into(merged, part_stats.count, part_stats.successes,
+                       part_stats.n, part_stats.mean, part_stats.m2)
+
+        return merged
+
+
+# Returns the distinct rows of the key values and the group of each row.
+# SQL GROUP BY puts every NULL key in one group sorted first, where
+# np.unique gives each NaN its own group, so NaN keys are grouped as -inf
+# (below any rating) and restored afterwards.
+
+# Parameters:
+#   - key_values (array): 2D array with one row of key values per row
+
+def unique_keys(key_values):
+    key_values = np.asarray(key_values)
+    floating = np.issubdtype(key_values.dtype, np.floating)
+
+    if floating:
+        key_values = np.where(np.isnan(key_values), -np.inf, key_values)
+
+    keys, group_ids = np.unique(key_values, axis=0, return_inverse=True)
+
+    if floating:
+        keys[np.isneginf(keys)] = np.nan
+
+    return keys, group_ids.ravel()
+
+
+# Returns a GroupStats of zeros for the given groups
+
+# Parameters:
+#   - key_names (list): the names of the grouping keys
+#   - keys (array): 2D array with one row of key values per group
+#   - columns (list): the names of the rating columns
+
+def empty_stats(key_names : list, keys, columns : list):
+    groups, width = len(keys), len(columns)
+
+    return GroupStats(key_names, keys, columns,
+                      count=np.zeros(groups), successes=np.zeros(groups),
+                      n=np.zeros((groups, width)), mean=np.zeros((groups, width)),
+                      m2=np.zeros((groups, width)))
+
+
+# Merges partial statistics for the same groups into stats in place
+# using Chan's parallel update of the mean and M2
+
+# Parameters:
+#   - stats (GroupStats): the running statistics
+#   - count (array): the number of rows per group in the partial
+#   - successes (array): the sum of dec_o per group in the partial
+#   - n (array): the non-NULL values per group and column in the partial
+#   - mean (array): the mean per group and column in the partial
+#   - m2 (array): the sum of squared deviations per group and column in the partial
+
+def merge_into(stats : GroupStats, count, successes, n, mean, m2):
+    total = stats.n + n
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        delta = mean - stats.mean
+        weight = np.where(total > 0, n / total, 0)
+        stats.mean = stats.mean + delta * weight
+        stats.m2 = stats.m2 + m2 + np.where(total > 0, delta ** 2 * stats.n * weight, 0)
+
+    stats.n = total
+    stats.count = stats.count + count
+    stats.successes = stats.successes + successes
+
+
+# Computes count, sum, mean, variance and success ratio for any set of
+# rating columns grouped by one or more keys in a vectorised pass.
+# Rows are processed in chunks whose statistics are computed with bincount
+# and merged with Chan's formula, so the variance is stable and memory
+# is bounded by the chunk size.
+
+# Parameters:
+#   - keys (dict): key name to an array with one value per row,
+#                  e.g. {'iid': iid, 'gender': gender}
+#   - values (dict): column name to an array with one value per row
+#                    (NaN for NULL)
+#   - dec_o (array): the partner's decision per row
+#   - chunk_size (int): the number of rows per chunk (None for one chunk)
+
+def aggregate(keys : dict, values : dict, dec_o, chunk_size : int = None):
+    key_names = list(keys)
+    columns = list(values)
+
+    key_values = np.column_stack([np.asarray(keys[name]) for name in key_names])
+    group_keys, group_ids = unique_keys(key_values)
+    groups = len(group_keys)
+
+    matrix = np.empty((len(group_ids), len(columns)))
+    for i, column in enumerate(columns):
+        matrix[:, i] = values[column]
+    dec_o = np.asarray(dec_o, dtype=float)
+
+    stats = empty_stats(key_names, group_keys, columns)
+    chunk_size = chunk_size or max(len(group_ids), 1)
+
+    for start in range(0, len(group_ids), chunk_size):
+        ids = group_ids[start:start + chunk_size]
+        chunk = matrix[start:start + chunk_size]
+
+        count = np.bincount(ids, minlength=groups).astype(float)
+        successes = np.bincount(ids, weights=dec_o[start:start + chunk_size], minlength=groups)
+
+        n = np.zeros((groups, len(columns)))
+        mean = np.zeros((groups, len(columns)))
+        m2 = np.zeros((groups, len(columns)))
+
+        for i in range(len(columns)):
+            present = ~np.isnan(chunk[:, i])
+            column_values = np.where(present, chunk[:, i], 0)
+
+            n[:, i] = np.bincount(ids, weights=present, minlength=groups)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                mean[:, i] = np.where(
+                    n[:, i] > 0,
+                    np.bincount(ids, weights=column_values, minlength=groups) / n[:, i],
+                    0)
+            deviations = np.where(present, chunk[:, i] - mean[ids, i], 0)
+            m2[:, i] = np.bincount(ids, weights=deviations ** 2, minlength=groups)
+
+        merge_into(stats, count, successes, n, mean, m2)
+
+    return stats
@@ -0,0 +1,300 @@
+import numpy as np
+
+from speed_dating.aggregation import aggregate, empty_stats
+from speed_dating.tracing import connect
+
+# Numeric gender to string labels
+GENDER_LABELS = {0: 'Female', 1: 'Male'}
+
+
+# Loads a table into a dictionary of NumPy arrays, one per column.
+# NULL values become NaN.
+
+# Parameters:
+#   - conn (sqlite3.Connection): an open connection to your database
+#   - query (str): the SELECT query for the table
+#   - params (tuple): the values bound to the query's placeholders
+
+def load_columns(conn, query : str, params : tuple = ()):
+    cursor = conn.execute(query, params)
+    names = [description[0] for description in cursor.description]
+    rows = cursor.fetchall()
+
+    values = np.array(rows, dtype=float).reshape(len(rows), len(names))
+
+    return {name: values[:, i] for i, name in enumerate(names)}
+
+
+# Returns the columns of a table sorted by iid. Columns that are already
+# sorted (e.g. memory-mapped from a snapshot) are returned without a copy.
+
+# Parameters:
+#   - columns (dict): column name to array
+
+def sort_by_iid(columns : dict):
+    iid = columns['iid']
+
+    if len(iid) == 0 or (np.diff(iid) >= 0).all():
+        return dict(columns)
+
+    order = np.argsort(iid, kind='stable')
+
+    return {name: values[order] for name, values in columns.items()}
+
+
+# Returns a participant_filter for the store keeping the participants whose
+# self-rating of attractiveness is in a band, lower <= attr3_1 < upper. Like
+# SQL, NULL self-ratings are never in a band.
+
+# Parameters:
+#   - band (tuple): the (lower, upper) self-rating (None for unbounded)
+
+def band_filter(band : tuple):
+    lower, upper = band
+    lower = -np.inf if lower is None else lower
+    upper = np.inf if upper is None else upper
+
+    def participant_filter(participants):
+        self_rating = participants['attr3_1']
+        return (self_rating >= lower) & (self_rating < upper)
+
+    return participant_filter
+
+
+# Columnar in-memory copy of the participants and dates tables.
+# Both tables are loaded once and sorted by iid. Each participant's dates are
+# the contiguous rows date_start[i]:date_end[i] so every per-participant
+# figure is a vectorised reduction over these ranges instead of a join.
+
+# Parameters:
+#   - participants (dict): column name to array for the participants table
+#   - dates (dict): column name to array for the dates table
+
+class AnalysisStore:
+
+    def __init__(self, participants : dict, dates : dict):
+        self.participants = sort_by_iid(participants)
+        self.dates = sort_by_iid(dates)
+
+        self.iid = self.participants['iid'].astype(np.int64)
+        self.gender = self.participants['gender'].astype(np.int64)
+
+        # iid -> row range index over dates
+        date_iid = self.dates['iid'].astype(np.int64)
+        self.date_start = np.searchsorted(date_iid, self.iid, side='left')
+        self.date_end = np.searchsorted(date_iid, self.iid, side='right')
+        self.date_count = self.date_end - self.date_start
+
+        # The participants row of each date and the gender of its iid
+        self.date_participant = np.repeat(np.arange(len(self.iid)), self.date_count)
+        self.date_gender = self.gender[self.date_participant]
+
+        # Per-participant statistics computed on first use
+        self._participant_stats = {}
+
+    # Loads the store from the participants and dates tables
+
+    # Parameters:
+    #   - database_path (str): the path to your database
+
+    @classmethod
+    def from_database(cls, database_path : str):
+        # Connect to database
+        conn = connect(database_path)
+
+        participants = load_columns(conn, 'SELECT * FROM participants ORDER BY iid')
+        dates = load_columns(conn, 'SELECT * FROM dates ORDER BY iid, date_id')
+
+        # Close the connection
+        conn.close()
+
+        # Dates whose iid is not in participants would be dropped by the join
+        # in the SQL queries so they are dropped here too
+        known = np.isin(dates['iid'], participants['iid'])
+        dates = {name: values[known] for name, values in dates.items()}
+
+        return cls(participants, dates)
+
+    # Loads the store by memory-mapping a snapshot written by write_snapshot.
+    # The snapshot is stored in iid order so the columns are used in place.
+
+    # Parameters:
+    #   - snapshot_dir (str): the directory of the snapshot
+
+    @classmethod
+    def from_snapshot(cls, snapshot_dir : str):
+        # Imported here as the snapshot module depends on this one
+        from speed_dating.snapshot import open_snapshot
+
+        tables = open_snapshot(snapshot_dir)
+
+        return cls(tables['participants'], tables['dates'])
+
+    # Returns the row range of an iid's dates
+
+    # Parameters:
+    #   - iid (int): the id of an individual
+
+    def date_rows(self, iid : int):
+        i = np.searchsorted(self.iid, iid)
+        return slice(int(self.date_start[i]), int(self.date_end[i]))
+
+    # Returns the per-participant statistics of the given dates columns
+    # (grouped by iid and gender) aligned with the participants rows.
+    # Participants without dates have a count of 0.
+
+    # Parameters:
+    #   - columns (tuple): the dates columns to aggregate
+
+    def participant_stats(self, columns : tuple = ('attr_o',)):
+        columns = tuple(columns)
+
+        if columns not in self._participant_stats:
+            stats = aggregate({'iid': self.iid[self.date_participant],
+                               'gender': self.date_gender},
+                              {column: self.dates[column] for column in columns},
+                              self.dates['dec_o'])
+            aligned = empty_stats(stats.key_names,
+                                  np.column_stack([self.iid, self.gender]), stats.columns)
+            rows = np.searchsorted(self.iid, stats.key('iid'))
+            aligned.count[rows] = stats.count
+            aligned.successes[rows] = stats.successes
+            aligned.n[rows] = stats.n
+            aligned.mean[rows] = stats.mean
+            aligned.m2[rows] = stats.m2
+            self._participant_stats[columns] = aligned
+
+        return self._participant_stats[columns]
+
+    # Returns the participants rows that went on at least one date
+    # (the rows an inner join with dates keeps)
+
+    def _dated(self):
+        return self.date_count > 0
+
+    # Splits per-participant x and y values into the {gender: [x, y]}
+    # layout used by the plotting functions, sorted by gender then the
+    # given sort keys
+
+    # Parameters:
+    #   - rows (array): boolean mask of the participants to include
+    #   - x (array): the x value per participant
+    #   - y (array): the y value per participant
+    #   - sort_keys (tuple): extra arrays to sort by within each gender
+
+    def _by_gender(self, rows, x, y, sort_keys : tuple = ()):
+        data = {'Female': [[], []], 'Male': [[], []]}
+
+        for gender, label in GENDER_LABELS.items():
+            selected = np.flatnonzero(rows & (self.gender == gender))
+            if sort_keys:
+                order = np.lexsort([key[selected] for key in reversed(sort_keys)])
+                selected = selected[order]
+            data[label] = [x[selected], y[selected]]
+
+        return data
+
+    # Average allocation of each attribute by gender
+    # (same output as fetch_pref_data)
+
+    # Parameters:
+    #   - columns_pf_o (list): list of attributes in the form
+    #                          pf_o_{attribute} (attribute preferences)
+    #   - gender_labels (list): the genders to be included
+
+    def fetch_pref_data(self, columns_pf_o : list, gender_labels : list):
+        pref_data = {}
+
+        for i, gender in enumerate(np.unique(self.gender)):
+            rows = self.gender == gender
+            pref_data[gender_labels[i]] = tuple(
+                float(np.nanmean(self.participants[column][rows])) for column in columns_pf_o
+            )
+
+        return pref_data
+
+    # Ratings received and the partner's decision on each date by gender
+    # (same output as fetch_rating_data)
+
+    # Parameters:
+    #   - columns_o (list): list of attributes ending in _o (ratings given)
+
+    def fetch_rating_data(self, columns_o : list):
+        ratings = np.column_stack([self.dates[column] for column in columns_o])
+        dec_o = self.dates['dec_o'].astype(np.int64)
+
+        rating_data = {}
+        for gender in GENDER_LABELS:
+            rows = self.date_gender == gender
+            rating_data[gender] = [ratings[rows], dec_o[rows]]
+
+        return rating_data
+
+    # Average attractiveness rating received and percentage of successful
+    # second dates per participant (same output as fetch_avg_attr_data)
+
+    def fetch_avg_attr_data(self):
+        stats = self.participant_stats()
+
+        return self._by_gender(self._dated(), stats.average('attr_o'),
+                               stats.success_ratio() * 100)
+
+    # Proportion of successful second dates for each self-rating of
+    # attractiveness by gender (same output as fetch_avg_self_attr_data)
+
+    def fetch_avg_self_attr_data(self):
+        stats = aggregate({'gender': self.date_gender,
+                           'attr3_1': self.participants['attr3_1'][self.date_participant]},
+                          {}, self.dates['dec_o'])
+
+        avg_self_attr_data = {'Female': [[], []], 'Male': [[], []]}
+
+        for gender, label in GENDER_LABELS.items():
+            rows = stats.key('gender') == gender
+            avg_self_attr_data[label] = [stats.key('attr3_1')[rows],
+                                         stats.success_ratio()[rows]]
+
+        return avg_self_attr_data
+
+    # Self-rating of attractiveness and proportion of successful second dates
+    # per participant (same output as fetch_self_attr_data)
+
+    def fetch_self_attr_data(self):
+        self_attr = self.participants['attr3_1']
+
+        return self._by_gender(self._dated(), self_attr,
+                               self.participant_stats().success_ratio(), (self_attr,))
+
+    # Difference between self-rated attractiveness and average attractiveness
+    # rating received, against the proportion of successful second dates per
+    # participant (same output as fetch_attr_diff_data)
+
+    # Parameters:
+    #   - participant_filter (function): takes the participants columns and
+    #                                    returns a boolean mask of the
+    #                                    participants to include
+
+    def fetch_attr_diff_data(self, participant_filter = None):
+        stats = self.participant_stats()
+        attr_diff = self.participants['attr3_1'] - stats.average('attr_o')
+        dec_o_ratio = stats.success_ratio()
+
+        rows = self._dated()
+        if participant_filter is not None:
+            rows = rows & np.asarray(participant_filter(self.participants), dtype=bool)
+
+        return self._by_gender(rows, attr_diff, dec_o_ratio, (attr_diff,))
+
+    # Variance of the attractiveness rating received per participant
+    # (same output as fetch_var_attr_data)
+
+    def fetch_var_attr_data(self):
+        variances = self.participant_stats().variance('attr_o')
+
+        var_attr_data = {'Female': [], 'Male': []}
+        dated = self._dated()
+
+        for gender, label in GENDER_LABELS.items():
+            var_attr_data[label] = variances[dated & (self.gender == gender)]
+
+        return var_attr_data
@@ -0,0 +1,373 @@
+import argparse
+import json
+import os
+import platform
+import sqlite3
+import subprocess
+import tempfile
+import time
+import uuid
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+from speed_dating.analysis_store import AnalysisStore
+from speed_dating.ingest import create_db_streaming
+from speed_dating.notebook import load_notebook_functions
+from speed_dating.preprocessing import preprocess
+from speed_dating.schema import build_schema
+from speed_dating.sharding import run_sharded
+from speed_dating.summaries import build_summaries
+from speed_dating.tracing import peak_rss_mb
+
+# The .csv columns read by the notebook, in the original dataset's names
+CSV_COLUMNS = ['iid', 'gender', 'pid', 'match', 'dec_o',
+               'attr_o', 'sinc_o', 'intel_o', 'fun_o', 'amb_o',
+               'attr3_1', 'sinc3_1', 'fun3_1', 'intel3_1', 'amb3_1',
+               'pf_o_att', 'pf_o_sin', 'pf_o_int', 'pf_o_fun', 'pf_o_amb']
+
+COLUMNS_BASE = ['attr', 'sinc', 'intel', 'fun', 'amb']
+COLUMNS_O = [attribute + '_o' for attribute in COLUMNS_BASE]
+COLUMNS_3_1 = [attribute + '3_1' for attribute in COLUMNS_BASE]
+COLUMNS_PF_O = [f'pf_o_{attribute}' for attribute in COLUMNS_BASE]
+CSV_PF_O = ['pf_o_att', 'pf_o_sin', 'pf_o_int', 'pf_o_fun', 'pf_o_amb']
+
+# The proportion of missing values in each column set
+NULL_RATES = {'_o': 0.02, '3_1': 0.01, 'pf_o': 0.01}
+
+# Dirichlet weights for the 100 points each gender allocates across the
+# five attributes (men put more weight on attractiveness)
+PREFERENCE_WEIGHTS = {0: [9, 8, 10, 8, 6], 1: [15, 8, 9, 8, 4]}
+
+# The default dataset sizes (in rows of the .csv, one per date and perspective)
+BENCHMARK_SIZES = (10_000, 100_000, 1_000_000, 10_000_000)
+
+# The fetch functions timed by the benchmark and their arguments
+FETCH_FUNCTIONS = ('fetch_pref_data', 'fetch_rating_data', 'fetch_avg_attr_data',
+                   'fetch_avg_self_attr_data', 'fetch_self_attr_data',
+                   'fetch_attr_diff_data', 'fetch_var_attr_data')
+
+
+# Returns the .csv rows of one batch of synthetic waves.
+# Within a wave every woman dates every man and each date has a row from
+# both perspectives, so the (iid, pid) and (pid, iid) rows are reciprocal.
+
+# Parameters:
+#   - rng (np.random.Generator): the random generator
+#   - wave_sizes (array): (waves, 2) number of women and men per wave
+#   - first_iid (int): the iid of the first participant in the batch
+#   - null_rates (dict): the proportion of missing values per column set
+#   - first_wave (int): the number of the first wave in the batch
+
+def generate_waves(rng, wave_sizes, first_iid : int, null_rates : dict, first_wave : int = 1):
+    people = wave_sizes.sum(axis=1)
+    participants = people.sum()
+
+    # Participants are numbered wave by wave, women first
+    wave = np.repeat(np.arange(len(wave_sizes)), people)
+    position = np.arange(participants) - np.repeat(np.cumsum(people) - people, people)
+    gender = (position >= wave_sizes[wave, 0]).astype(np.int64)
+    iid = first_iid + np.arange(participants)
+
+    # Latent qualities, self ratings (people rate themselves generously)
+    # and the preferences of each participant
+    quality = rng.normal(6.5, 1.3, size=(participants, 5))
+    self_ratings = np.clip(np.rint(quality + 0.8 + rng.normal(0, 1, size=(participants, 5))),
+                           1, 10)
+    preferences = np.empty((participants, 5))
+    for value, weights in PREFERENCE_WEIGHTS.items():
+        rows = gender == value
+        preferences[rows] = np.round(rng.dirichlet(weights, size=rows.sum()) * 100, 2)
+    leniency = rng.normal(0, 0.7, size=participants)
+
+    # Every woman x man pair of each wave
+    start = np.cumsum(people) - people
+    women = np.concatenate([np.repeat(np.arange(s, s + f), m)
+                            for s, (f, m) in zip(start, wave_sizes)])
+    men = np.concatenate([np.tile(np.arange(s + f, s + f + m), f)
+                          for s, (f, m) in zip(start, wave_sizes)])
+
+    # Rows from both perspectives: the iid is rated by the pid
+    rated = np.concatenate([women, men])
+    rater = np.concatenate([men, women])
+
+    ratings = np.clip(np.rint(quality[rated] + leniency[rater, None]
+                              + rng.normal(0, 1.3, size=(len(rated), 5))), 1, 10)
+    appeal = (ratings * preferences[rater]).sum(axis=1) / 100
+    dec_o = (rng.random(len(rated)) < 1 / (1 + np.exp(-1.6 * (appeal - 6.6)))).astype(np.int64)
+
+    # A match needs both decisions, which sit on the two rows of the date
+    pairs = len(women)
+    decided = dec_o[:pairs] & dec_o[pairs:]
+    match = np.concatenate([decided, decided])
+
+    self_columns = self_ratings.copy()
+    preference_columns = preferences.copy()
+
+    # Missing self ratings and preferences are per participant and so
+    # repeat on each of their rows, missing ratings are per date
+    self_columns[rng.random(self_columns.shape) < null_rates.get('3_1', 0)] = np.nan
+    preference_columns[rng.random(preference_columns.shape) < null_rates.get('pf_o', 0)] = np.nan
+    ratings[rng.random(ratings.shape) < null_rates.get('_o', 0)] = np.nan
+
+    frame = pd.DataFrame({'iid': iid[rated], 'gender': gender[rated], 'pid': iid[rater],
+                          'match': match, 'dec_o': dec_o})
+    frame['wave'] = first_wave + wave[rated]
+    for i, column in enumerate(COLUMNS_O):
+        frame[column] = ratings[:, i]
+    for i, column in enumerate(COLUMNS_3_1):
+        frame[column] = self_columns[rated, i]
+    for i, column in enumerate(CSV_PF_O):
+        frame[column] = preference_columns[rater, i]
+
+    # Keep the rows of each participant together as in the original .csv
+    return frame.sort_values(['iid', 'pid'], kind='stable')[CSV_COLUMNS + ['wave']]
+
+
+# Writes a synthetic speed_dating.csv with the structure of the original:
+# waves of 5 - 22 women and men (numbered in the wave column), reciprocal
+# rows for every date and configurable NULL rates. Waves are generated and written in batches so
+# memory stays flat for large files.
+
+# Parameters:
+#   - csv_file (str): the path of the .csv to write
+#   - rows (int): the approximate number of rows (the last wave is kept whole)
+#   - null_rates (dict): the proportion of missing values per column set
+#                        ('_o', '3_1' and 'pf_o')
+#   - missing_pair_rate (float): the proportion of rows dropped so their
+#                                (pid, iid) row has no pair
+#   - seed (int): the seed for the random generator
+#   - batch_rows (int): the approximate number of rows generated at a time
+
+# Returns the number of rows and participants written
+
+def generate_csv(csv_file : str, rows : int, null_rates : dict = None,
+                 missing_pair_rate : float = 0.005, seed : int = 0,
+                 batch_rows : int = 200_000):
+    null_rates = NULL_RATES if null_rates is None else null_rates
+    rng = np.random.default_rng(seed)
+
+    rows_generated = 0
+    rows_written = 0
+    participants = 0
+    waves = 0
+
+    while rows_generated < rows:
+        # Enough waves for one batch (a wave averages about 370 rows), up to
+        # the first wave that reaches the rows wanted
+        wanted = min(batch_rows, rows - rows_generated)
+        wave_sizes = rng.integers(5, 23, size=(wanted // 370 + 1, 2))
+        wave_rows = np.cumsum(2 * wave_sizes.prod(axis=1))
+        wave_sizes = wave_sizes[:np.searchsorted(wave_rows, wanted) + 1]
+
+        batch = generate_waves(rng, wave_sizes, participants + 1, null_rates, waves + 1)
+        batch = batch[rng.random(len(batch)) >= missing_pair_rate]
+
+        batch.to_csv(csv_file, mode='a' if rows_written else 'w', header=not rows_written,
+                     index=False, encoding='latin')
+
+        rows_generated += int(wave_rows[len(wave_sizes) - 1])
+        rows_written += len(batch)
+        participants += int(wave_sizes.sum())
+        waves += len(wave_sizes)
+
+    return {'rows': rows_written, 'participants': participants, 'waves': waves}
+
+
+# Returns the short hash of the checked out commit, used to compare results
+# between versions (None outside a git repository)
+
+def code_version():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Returns the seconds taken by a function and its result
+
+# Parameters:
+#   - function: the function to time
+#   - args: its arguments
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+
+# Runs every stage of the notebook on a synthetic dataset of each size and
+# appends one JSON line per stage to the output file. The fetch functions
+# are timed reading from the database (the summary tables for the aggregate
+# ones) and from the analysis store, and the sharded data preparation is
+# timed with each number of workers (each run on fresh shards so no stage
+# is skipped).
+
+# Parameters:
+#   - sizes (tuple): the number of .csv rows of each dataset
+#   - output_path (str): the JSON lines file the results are appended to
+#   - null_rates (dict): the proportion of missing values per column set
+#   - n_neighbors (int): the number of neighbours used for imputation
+#   - train (bool): whether to time train_and_evaluate
+#   - seed (int): the seed for the synthetic data
+#   - work_dir (str): where the .csv and .db are written (None for a
+#                     temporary directory)
+#   - shard_workers (tuple): the numbers of processes run_sharded is timed
+#                            with (None for 1 and every core, empty to skip)
+
+# Returns the list of results written
+
+def run_benchmark(sizes : tuple = BENCHMARK_SIZES, output_path : str = 'benchmark_results.jsonl',
+                  null_rates : dict = None, n_neighbors : int = 5, train : bool = True,
+                  seed : int = 0, work_dir : str = None, shard_workers : tuple = None):
+    notebook = load_notebook_functions()
+    if shard_workers is None:
+        shard_workers = sorted({1, os.cpu_count() or 1})
+    gender_labels = ['Female', 'Male']
+
+    run = {
+        'run_id': uuid.uuid4().hex[:12],
+        'version': code_version(),
+        'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'machine': platform.machine(),
+        'cpus': os.cpu_count()
+    }
+    results = []
+
+    with tempfile.TemporaryDirectory(dir=work_dir) as directory:
+        for size in sizes:
+            csv_file = os.path.join(directory, f'speed_dating_{size}.csv')
+            database_path = os.path.join(directory, f'speed_dating_{size}.db')
+            timings = []
+
+            seconds, generated = timed(generate_csv, csv_file, size, null_rates, 0.005, seed)
+            timings.append(('generate_csv', None, seconds))
+
+            seconds, _ = timed(create_db_streaming, csv_file, 'latin', database_path, CSV_COLUMNS)
+            timings.append(('create_db', None, seconds))
+
+            # delete_null_values, delete_missing_pairs and data_imputation
+            report = preprocess(database_path, COLUMNS_O, COLUMNS_3_1, COLUMNS_PF_O, 3,
+                                COLUMNS_O, n_neighbors)
+            timings.extend((stage['stage'], None, stage['seconds']) for stage in report)
+
+            # create_participants, create_dates, create_indexes and analyze
+            report = build_schema(database_path, COLUMNS_O, COLUMNS_3_1, COLUMNS_PF_O)
+            timings.extend((stage['stage'], None, stage['seconds']) for stage in report)
+
+            # The summary tables read by the aggregate fetch functions
+            report = build_summaries(database_path, COLUMNS_O)
+            timings.extend((stage['stage'], None, stage['seconds']) for stage in report)
+
+            seconds, store = timed(AnalysisStore.from_database, database_path)
+            timings.append(('load_store', None, seconds))
+
+            arguments = {
+                'fetch_pref_data': (COLUMNS_PF_O, gender_labels),
+                'fetch_rating_data': (COLUMNS_O,),
+                'fetch_attr_diff_data': ((6, None),)
+            }
+            for name in FETCH_FUNCTIONS:
+                for variant, source in (('sql', None), ('store', store)):
+                    args = (database_path, *arguments.get(name, ()), source)
+                    seconds, _ = timed(notebook[name], *args)
+                    timings.append((name, variant, seconds))
+
+            for workers in shard_workers:
+                shard_dir = os.path.join(directory, f'shards_{size}_{workers}')
+                seconds, _ = timed(run_sharded, csv_file, shard_dir, CSV_COLUMNS, COLUMNS_O,
+                                   COLUMNS_3_1, COLUMNS_PF_O, 3, 'latin', None, workers)
+                timings.append(('run_sharded', f'{workers}_workers', seconds))
+
+            if train:
+                rating_data = notebook['fetch_rating_data'](database_path, COLUMNS_O, store)
+                seconds, _ = timed(notebook['train_and_evaluate'], rating_data, gender_labels)
+                timings.append(('train_and_evaluate', None, seconds))
+
+            size_results = [
+                {**run, 'size': size, 'rows': generated['rows'],
+                 'participants': generated['participants'], 'waves': generated['waves'],
+                 'stage': stage,
+                 'variant': variant, 'seconds': round(seconds, 6), 'peak_rss_mb': peak_rss_mb()}
+                for stage, variant, seconds in timings
+            ]
+            results.extend(size_results)
+
+            # Write each size as it completes so a long run keeps its results
+            with open(output_path, 'a') as file:
+                for result in size_results:
+                    file.write(json.dumps(result) + '\n')
+
+            print(f'{size} rows benchmarked.')
+
+    return results
+
+
+# Returns the seconds of each stage for two versions side by side with the
+# ratio of the candidate to the baseline (above 1 is a slowdown)
+
+# Parameters:
+#   - output_path (str): the JSON lines file written by run_benchmark
+#   - baseline (str): the version (commit) to compare against
+#   - candidate (str): the version (commit) to compare
+
+def compare_versions(output_path : str, baseline : str, candidate : str):
+    results = pd.read_json(output_path, lines=True)
+    results['variant'] = results['variant'].fillna('')
+
+    # The fastest run of each stage for each version
+    seconds = (results[results['version'].isin([baseline, candidate])]
+               .groupby(['size', 'stage', 'variant', 'version'])['seconds'].min()
+               .unstack('version'))
+    seconds['ratio'] = (seconds[candidate] / seconds[baseline]).round(3)
+
+    return seconds
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the notebook on synthetic data.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    generate_parser = subparsers.add_parser('generate', help='write a synthetic .csv')
+    generate_parser.add_argument('csv_file')
+    generate_parser.add_argument('--rows', type=int, default=10_000)
+    generate_parser.add_argument('--seed', type=int, default=0)
+
+    run_parser = subparsers.add_parser('run', help='time every stage for each size')
+    run_parser.add_argument('--sizes', type=int, nargs='+', default=list(BENCHMARK_SIZES))
+    run_parser.add_argument('--output', default='benchmark_results.jsonl')
+    run_parser.add_argument('--no-train', action='store_true')
+    run_parser.add_argument('--seed', type=int, default=0)
+    run_parser.add_argument('--work-dir', default=None)
+    run_parser.add_argument('--shard-workers', type=int, nargs='*', default=None,
+                            help='the process counts to time run_sharded with')
+
+    compare_parser = subparsers.add_parser('compare', help='compare two versions')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('candidate')
+    compare_parser.add_argument('--output', default='benchmark_results.jsonl')
+
+    for subparser in (generate_parser, run_parser):
+        subparser.add_argument('--null-rate-o', type=float, default=NULL_RATES['_o'])
+        subparser.add_argument('--null-rate-3-1', type=float, default=NULL_RATES['3_1'])
+        subparser.add_argument('--null-rate-pf-o', type=float, default=NULL_RATES['pf_o'])
+
+    args = parser.parse_args()
+
+    if args.command == 'compare':
+        print(compare_versions(args.output, args.baseline, args.candidate).to_string())
+    else:
+        null_rates = {'_o': args.null_rate_o, '3_1': args.null_rate_3_1,
+                      'pf_o': args.null_rate_pf_o}
+
+        if args.command == 'generate':
+            print(generate_csv(args.csv_file, args.rows, null_rates, seed=args.seed))
+        else:
+            run_benchmark(args.sizes, args.output, null_rates, train=not args.no_train,
+                          seed=args.seed, work_dir=args.work_dir,
+                          shard_workers=args.shard_workers)
@@ -0,0 +1,245 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy.stats import norm
+
+from speed_dating.analysis_store import GENDER_LABELS
+from speed_dating.query_pool import shared_pool
+from speed_dating.tracing import span
+
+# The statistics a group can be summarised by
+STATISTICS = ('ratio', 'median')
+
+# Per-participant outcomes of the dates (the participants an inner join
+# with dates keeps)
+OUTCOMES_QUERY = '''
+    SELECT p.gender, p.attr3_1, SUM(d.dec_o) AS successes, COUNT(*) AS trials,
+           p.attr3_1 - AVG(d.attr_o) AS attr_diff
+    FROM participants AS p
+    JOIN dates AS d ON p.iid = d.iid
+    GROUP BY p.iid
+    ORDER BY p.iid
+'''
+
+
+# Returns the gender, self-rating, successful second dates, dates and
+# attractiveness gap of every participant who went on a date
+
+# Parameters:
+#   - database_path (str): the path to your database
+#   - store (AnalysisStore): the in-memory store to read from instead of
+#                            the database (optional)
+
+# Returns a dictionary of arrays, one entry per participant
+
+def participant_outcomes(database_path : str, store = None):
+    if store is None:
+        return shared_pool(database_path).fetch_columns(OUTCOMES_QUERY)
+
+    stats = store.participant_stats()
+    dated = store._dated()
+
+    return {
+        'gender': store.gender[dated].astype(float),
+        'attr3_1': store.participants['attr3_1'][dated],
+        'successes': stats.successes[dated].astype(float),
+        'trials': stats.count[dated].astype(float),
+        'attr_diff': (store.participants['attr3_1'] - stats.average('attr_o'))[dated]
+    }
+
+
+# Returns a statistic of the resampled participants of one group
+
+# Parameters:
+#   - successes (array): the successes of each participant in the group
+#   - trials (array): the dates of each participant in the group
+#   - index (array): (resamples x participants) rows of resampled positions
+#   - statistic (str): 'ratio' pools the dates (sum of successes over sum of
+#                      dates), 'median' takes the median participant ratio
+
+def resampled_statistic(successes, trials, index, statistic : str):
+    if statistic == 'ratio':
+        return successes[index].sum(axis=1) / trials[index].sum(axis=1)
+
+    return np.median((successes / trials)[index], axis=1)
+
+
+# Draws one batch of bootstrap replicates for every group. Each group's
+# participants are resampled with replacement as one index matrix.
+
+# Parameters:
+#   - groups (list): (successes, trials) arrays of each group
+#   - n_resamples (int): the replicates in this batch
+#   - statistic (str): see resampled_statistic
+#   - seed (SeedSequence): the seed of this batch
+
+# Returns a (groups x n_resamples) array of replicates
+
+def bootstrap_batch(groups : list, n_resamples : int, statistic : str, seed):
+    rng = np.random.default_rng(seed)
+    replicates = np.empty((len(groups), n_resamples))
+
+    for i, (successes, trials) in enumerate(groups):
+        index = rng.integers(0, len(successes), size=(n_resamples, len(successes)))
+        replicates[i] = resampled_statistic(successes, trials, index, statistic)
+
+    return replicates
+
+
+# Returns the statistic of a group with each participant left out in turn
+# (used for the BCa acceleration, empty for groups of fewer than three)
+
+# Parameters:
+#   - successes (array): the successes of each participant in the group
+#   - trials (array): the dates of each participant in the group
+#   - statistic (str): see resampled_statistic
+
+def jackknife(successes, trials, statistic : str):
+    if len(successes) < 3:
+        return np.empty(0)
+
+    if statistic == 'ratio':
+        return (successes.sum() - successes) / (trials.sum() - trials)
+
+    ratios = successes / trials
+    keep = ~np.eye(len(ratios), dtype=bool)
+    return np.median(np.broadcast_to(ratios, (len(ratios), len(ratios)))[keep]
+                     .reshape(len(ratios), -1), axis=1)
+
+
+# Returns the percentile or bias-corrected and accelerated (BCa) interval
+# of one group's replicates
+
+# Parameters:
+#   - estimate (float): the statistic on the original sample
+#   - replicates (array): the bootstrap replicates
+#   - jackknife_values (array): the leave-one-out statistics
+#   - confidence (float): the confidence level
+#   - method (str): 'percentile' or 'bca'
+
+def confidence_interval(estimate : float, replicates, jackknife_values, confidence : float,
+                        method : str):
+    alpha = (1 - confidence) / 2
+    levels = np.array([alpha, 1 - alpha])
+
+    if method == 'bca' and len(jackknife_values) > 2:
+        # Bias correction from the share of replicates below the estimate
+        below = (np.mean(replicates < estimate) + np.mean(replicates == estimate) / 2)
+        z0 = norm.ppf(np.clip(below, 1e-10, 1 - 1e-10))
+
+        # Acceleration from the skewness of the jackknife values
+        deviations = jackknife_values.mean() - jackknife_values
+        denominator = 6 * np.sum(deviations ** 2) ** 1.5
+        acceleration = np.sum(deviations ** 3) / denominator if denominator > 0 else 0.0
+
+        z = norm.ppf(levels)
+        levels = norm.cdf(z0 + (z0 + z) / (1 - acceleration * (z0 + z)))
+
+    low, high = np.quantile(replicates, np.nan_to_num(levels, nan=0.5))
+
+    return float(low), float(high)
+
+
+# Bootstrap confidence intervals of the success ratio of each group of
+# participants. Participants (not dates) are resampled within each group
+# since the dates of one participant are not independent. The replicates are
+# split into batches that run across a process pool. Each batch has its own
+# seed spawned from the seed, so the intervals do not depend on the number
+# of processes.
+
+# Parameters:
+#   - groups (array): the group of each participant (e.g. attr3_1)
+#   - successes (array): the successful second dates of each participant
+#   - trials (array): the dates of each participant
+#   - n_resamples (int): the number of bootstrap replicates
+#   - confidence (float): the confidence level
+#   - method (str): 'percentile' or 'bca'
+#   - statistic (str): 'ratio' or 'median' (see resampled_statistic)
+#   - seed (int): the seed of the resampling
+#   - batch_size (int): the replicates drawn per task
+#   - max_workers (int): the number of processes (1 runs in this process)
+
+# Returns a dictionary of arrays with one entry per group: group, estimate,
+# low, high, participants and dates
+
+def grouped_intervals(groups, successes, trials, n_resamples : int = 2000,
+                      confidence : float = 0.95, method : str = 'bca',
+                      statistic : str = 'ratio', seed : int = 0, batch_size : int = 500,
+                      max_workers : int = None):
+    if statistic not in STATISTICS:
+        raise ValueError(f'statistic must be one of {STATISTICS}')
+
+    groups = np.asarray(groups, dtype=float)
+    successes = np.asarray(successes, dtype=float)
+    trials = np.asarray(trials, dtype=float)
+
+    keep = ~np.isnan(groups) & (trials > 0)
+    groups, successes, trials = groups[keep], successes[keep], trials[keep]
+
+    labels = np.unique(groups)
+    members = [(successes[groups == label], trials[groups == label]) for label in labels]
+
+    # Batches with fixed sizes and seeds so the replicates are reproducible
+    batch_sizes = [min(batch_size, n_resamples - start)
+                   for start in range(0, n_resamples, batch_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(batch_sizes))
+    max_workers = max_workers or min(os.cpu_count() or 1, len(batch_sizes))
+
+    with span('bootstrap', rows_in=len(groups), groups=len(labels), resamples=n_resamples):
+        if max_workers == 1:
+            batches = [bootstrap_batch(members, size, statistic, batch_seed)
+                       for size, batch_seed in zip(batch_sizes, seeds)]
+        else:
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                batches = list(executor.map(bootstrap_batch, [members] * len(batch_sizes),
+                                            batch_sizes, [statistic] * len(batch_sizes), seeds))
+
+    replicates = np.concatenate(batches, axis=1)
+
+    intervals = {name: np.empty(len(labels)) for name in ('estimate', 'low', 'high')}
+    for i, (group_successes, group_trials) in enumerate(members):
+        index = np.arange(len(group_successes))[None, :]
+        estimate = resampled_statistic(group_successes, group_trials, index, statistic)[0]
+
+        intervals['estimate'][i] = estimate
+        intervals['low'][i], intervals['high'][i] = confidence_interval(
+            estimate, replicates[i], jackknife(group_successes, group_trials, statistic),
+            confidence, method)
+
+    intervals['group'] = labels
+    intervals['participants'] = np.array([len(s) for s, _ in members])
+    intervals['dates'] = np.array([t.sum() for _, t in members])
+
+    return intervals
+
+
+# Bootstrap intervals of the success ratio for each gender grouped by a
+# per-participant value
+
+# Parameters:
+#   - outcomes (dict): the arrays returned by participant_outcomes
+#   - by (str): the column to group by (e.g. 'attr3_1' or 'attr_diff')
+#   - bin_width (float): rounds the column to bins of this width (None
+#                        groups by its exact values)
+#   - gender_labels (dict): numeric gender to label (defaults to
+#                           GENDER_LABELS)
+#   - kwargs: passed to grouped_intervals
+
+# Returns a dictionary of {gender label: intervals}
+
+def intervals_by_gender(outcomes : dict, by : str = 'attr3_1', bin_width : float = None,
+                        gender_labels : dict = None, **kwargs):
+    gender_labels = gender_labels or GENDER_LABELS
+    values = np.asarray(outcomes[by], dtype=float)
+    if bin_width is not None:
+        # Adding 0.0 turns -0.0 into 0.0 so they are one bin
+        values = np.round(values / bin_width) * bin_width + 0.0
+
+    intervals = {}
+    for gender, label in gender_labels.items():
+        rows = outcomes['gender'] == gender
+        intervals[label] = grouped_intervals(values[rows], outcomes['successes'][rows],
+                                             outcomes['trials'][rows], **kwargs)
+
+    return intervals
@@ -0,0 +1,68 @@
+import numpy as np
+from sklearn.ensemble import HistGradientBoostingClassifier, RandomForestClassifier
+from sklearn.linear_model import LogisticRegression
+from sklearn.model_selection import StratifiedKFold, cross_validate
+from sklearn.pipeline import make_pipeline
+from sklearn.preprocessing import StandardScaler
+
+
+# Returns a new, unfitted classifier for predicting dec_o
+
+# Parameters:
+#   - name (str): 'hist_gradient_boosting', 'logistic_regression' or
+#                 'random_forest'
+#   - random_state (int): the seed for the model
+
+def make_classifier(name : str, random_state : int = 42):
+    if name == 'hist_gradient_boosting':
+        return HistGradientBoostingClassifier(random_state=random_state)
+    if name == 'logistic_regression':
+        return make_pipeline(StandardScaler(), LogisticRegression(max_iter=1000))
+    if name == 'random_forest':
+        return RandomForestClassifier(n_estimators=200, random_state=random_state)
+
+    raise ValueError(f'Unknown classifier {name!r}')
+
+
+# Evaluates classifiers for second date success (dec_o) on the ratings
+# received with stratified k-fold cross-validation. Folds are fitted in
+# parallel and accuracy, AUC and fit/predict time are reported side by side.
+
+# Parameters:
+#   - rating_data (dict): ratings per date created by fetch_rating_data
+#   - gender_labels (list): the genders to be included
+#   - models (tuple): the names of the classifiers to evaluate
+#   - n_splits (int): the number of folds
+#   - n_jobs (int): the number of folds fitted at once (-1 uses every core)
+#   - random_state (int): the seed for the folds and models
+
+# Returns a dictionary of {gender: {model: results}}
+
+def evaluate_classifiers(rating_data, gender_labels : list,
+                         models : tuple = ('hist_gradient_boosting', 'logistic_regression',
+                                           'random_forest'),
+                         n_splits : int = 5, n_jobs : int = -1, random_state : int = 42):
+    folds = StratifiedKFold(n_splits=n_splits, shuffle=True, random_state=random_state)
+    results = {}
+
+    for i, gender in enumerate(gender_labels):
+        X = np.asarray(rating_data[i][0], dtype=float)
+        y = np.asarray(rating_data[i][1], dtype=int)
+        results[gender] = {}
+
+        for name in models:
+            scores = cross_validate(make_classifier(name, random_state), X, y, cv=folds,
+                                    scoring=('accuracy', 'roc_auc'), n_jobs=n_jobs)
+
+            # Total CPU time spent across the folds
+            cpu_seconds = scores['fit_time'].sum() + scores['score_time'].sum()
+
+            results[gender][name] = {
+                'accuracy': float(scores['test_accuracy'].mean()),
+                'auc': float(scores['test_roc_auc'].mean()),
+                'fit_seconds': float(scores['fit_time'].mean()),
+                'predict_seconds': float(scores['score_time'].mean()),
+                'accuracy_per_cpu_second': float(scores['test_accuracy'].mean() / cpu_seconds)
+            }
+
+    return results
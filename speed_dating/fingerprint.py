@@ -0,0 +1,50 @@
+import hashlib
+import json
+
+
+# Returns a SHA-256 hash of a JSON-serialisable value
+
+# Parameters:
+#   - value: the value to hash
+
+def value_fingerprint(value):
+    return hashlib.sha256(json.dumps(value, sort_keys=True, default=str).encode()).hexdigest()
+
+
+# Returns a SHA-256 hash of a file's contents
+
+# Parameters:
+#   - path (str): the path of the file
+#   - block_size (int): the bytes read at a time
+
+def file_fingerprint(path : str, block_size : int = 1 << 20):
+    digest = hashlib.sha256()
+
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(block_size), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+# Returns a SHA-256 hash of a table's definition and rows
+
+# Parameters:
+#   - conn (sqlite3.Connection): the database connection
+#   - table (str): the name of the table
+#   - batch_size (int): the rows hashed at a time
+
+def table_fingerprint(conn, table : str, batch_size : int = 50000):
+    digest = hashlib.sha256()
+
+    definition = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?",
+                              (table,)).fetchone()
+    if definition is None:
+        return None
+    digest.update(definition[0].encode())
+
+    cursor = conn.execute(f'SELECT * FROM {table}')
+    for rows in iter(lambda: cursor.fetchmany(batch_size), []):
+        digest.update(repr(rows).encode())
+
+    return digest.hexdigest()
@@ -0,0 +1,376 @@
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from speed_dating.tracing import span
+from speed_dating.training import MODEL_CACHE_DIR, fit_model
+
+# The importance methods accepted by feature_importance
+IMPORTANCE_METHODS = ('permutation', 'tree_shap')
+
+# Exact tree-path attribution enumerates every subset of the features so it
+# is limited to this many features
+MAX_SHAP_FEATURES = 12
+
+# The model and held-out data of a worker process, set once per process by
+# init_worker rather than sent with every task
+WORKER_STATE = {}
+
+
+# Returns a hash of a fitted forest's trees (the split features,
+# thresholds, children and leaf values), so a refitted but identical forest
+# has the same hash
+
+# Parameters:
+#   - model (RandomForestRegressor): the fitted forest
+
+def model_hash(model):
+    digest = hashlib.sha256()
+    digest.update(str(model.n_features_in_).encode())
+
+    for estimator in model.estimators_:
+        tree = estimator.tree_
+        for values in (tree.children_left, tree.children_right, tree.feature,
+                       tree.threshold, tree.value, tree.weighted_n_node_samples):
+            digest.update(np.ascontiguousarray(values).tobytes())
+
+    return digest.hexdigest()
+
+
+# Stores the model and held-out data in a worker process
+
+# Parameters:
+#   - model (RandomForestRegressor): the fitted forest
+#   - X (array): the held-out features
+#   - y (array): the held-out target values
+#   - single_threaded (bool): whether to stop the forest predicting with
+#                             threads (which would compete with the
+#                             processes)
+
+def init_worker(model, X, y, single_threaded : bool = False):
+    if single_threaded:
+        model.n_jobs = 1
+
+    WORKER_STATE['model'] = model
+    WORKER_STATE['X'] = X
+    WORKER_STATE['y'] = y
+
+
+# Returns the increase in mean squared error of a number of shuffles of one
+# feature. The shuffled copies of the held-out data are stacked so the
+# forest predicts them all in one call.
+
+# Parameters:
+#   - feature (int): the column to shuffle
+#   - n_repeats (int): the number of shuffles
+#   - seed (SeedSequence): the seed of the shuffles
+
+def permutation_task(feature : int, n_repeats : int, seed):
+    model, X, y = WORKER_STATE['model'], WORKER_STATE['X'], WORKER_STATE['y']
+    rng = np.random.default_rng(seed)
+
+    baseline = np.mean((model.predict(X) - y) ** 2)
+
+    shuffled = np.tile(X, (n_repeats, 1))
+    for repeat in range(n_repeats):
+        rows = slice(repeat * len(X), (repeat + 1) * len(X))
+        shuffled[rows, feature] = rng.permutation(X[:, feature])
+
+    predictions = model.predict(shuffled).reshape(n_repeats, len(X))
+
+    return np.mean((predictions - y) ** 2, axis=1) - baseline
+
+
+# Returns the leaves of a tree as boxes: each leaf's lower and upper bound
+# on every feature (x is in the leaf when lower < x <= upper), the share of
+# the training samples reaching it through the splits on each feature and
+# its value
+
+# Parameters:
+#   - tree (sklearn.tree._tree.Tree): the fitted tree
+#   - n_features (int): the number of features
+
+def leaf_boxes(tree, n_features : int):
+    left, right = tree.children_left, tree.children_right
+    cover = tree.weighted_n_node_samples
+    lower, upper, shares, values = [], [], [], []
+
+    stack = [(0, np.full(n_features, -np.inf), np.full(n_features, np.inf),
+              np.ones(n_features))]
+    while stack:
+        node, low, high, share = stack.pop()
+
+        if left[node] == -1:
+            lower.append(low)
+            upper.append(high)
+            shares.append(share)
+            values.append(tree.value[node].ravel()[0])
+            continue
+
+        feature, threshold = tree.feature[node], tree.threshold[node]
+
+        for child, is_left in ((left[node], True), (right[node], False)):
+            child_low, child_high, child_share = low.copy(), high.copy(), share.copy()
+            if is_left:
+                child_high[feature] = min(high[feature], threshold)
+            else:
+                child_low[feature] = max(low[feature], threshold)
+            child_share[feature] *= cover[child] / cover[node]
+            stack.append((child, child_low, child_high, child_share))
+
+    return np.array(lower), np.array(upper), np.array(shares), np.array(values)
+
+
+# Returns the exact path-dependent SHAP values of one tree. For each subset
+# S of the features the expected prediction given the features in S is the
+# sum over leaves of the leaf value times whether the sample is inside the
+# leaf on the features in S times the share of training samples reaching the
+# leaf through the splits on the other features (as TreeSHAP defines it).
+# The subsets are enumerated depth first so each one costs one product.
+
+# Parameters:
+#   - estimator (DecisionTreeRegressor): the fitted tree
+#   - X (array): the samples to explain
+
+# Returns a (samples x features) array of SHAP values and the expected value
+
+def tree_shap_values(estimator, X):
+    n_samples, n_features = X.shape
+    lower, upper, shares, values = leaf_boxes(estimator.tree_, n_features)
+
+    # inside[f] is whether each sample is inside each leaf on feature f
+    inside = [((X[:, f, None] > lower[None, :, f]) & (X[:, f, None] <= upper[None, :, f]))
+              .astype(np.float32) for f in range(n_features)]
+
+    full = (1 << n_features) - 1
+    expected = np.empty((full + 1, n_samples))
+
+    def expand(mask, in_leaf, next_feature):
+        # The share of training samples through the features not in the subset
+        outside = ~mask & full
+        weights = values * np.prod(shares[:, [f for f in range(n_features)
+                                              if outside >> f & 1]], axis=1)
+        expected[mask] = in_leaf @ weights if in_leaf is not None else weights.sum()
+
+        for f in range(next_feature, n_features):
+            expand(mask | 1 << f, inside[f] if in_leaf is None else in_leaf * inside[f], f + 1)
+
+    expand(0, None, 0)
+
+    # Shapley weights |S|! (M - |S| - 1)! / M! by subset size
+    sizes = np.arange(n_features)
+    factorials = np.cumprod(np.concatenate([[1], np.arange(1, n_features + 1)])).astype(float)
+    weights = factorials[sizes] * factorials[n_features - sizes - 1] / factorials[n_features]
+
+    shap = np.zeros((n_samples, n_features))
+    for mask in range(full + 1):
+        size = bin(mask).count('1')
+        for f in range(n_features):
+            if not mask >> f & 1:
+                shap[:, f] += weights[size] * (expected[mask | 1 << f] - expected[mask])
+
+    return shap, float(expected[0][0])
+
+
+# Returns the sum of the SHAP values and expected values of a range of the
+# forest's trees
+
+# Parameters:
+#   - start (int): the first tree
+#   - end (int): the tree after the last
+
+def tree_shap_task(start : int, end : int):
+    model, X = WORKER_STATE['model'], WORKER_STATE['X']
+    total, expected = np.zeros(X.shape), 0.0
+
+    for estimator in model.estimators_[start:end]:
+        shap, base = tree_shap_values(estimator, X)
+        total += shap
+        expected += base
+
+    return total, expected
+
+
+# Runs tasks against one model and held-out set, in this process or in a
+# process pool whose workers each receive the model once
+
+# Parameters:
+#   - function (function): permutation_task or tree_shap_task
+#   - tasks (list): the arguments of each task
+#   - model (RandomForestRegressor): the fitted forest
+#   - X (array): the held-out features
+#   - y (array): the held-out target values
+#   - max_workers (int): the number of processes (1 runs in this process)
+
+def run_tasks(function, tasks : list, model, X, y, max_workers : int):
+    if max_workers == 1:
+        init_worker(model, X, y)
+        try:
+            return [function(*task) for task in tasks]
+        finally:
+            WORKER_STATE.clear()
+
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=init_worker,
+                             initargs=(model, X, y, True)) as executor:
+        return list(executor.map(function, *zip(*tasks)))
+
+
+# Feature importance of a fitted forest measured on held-out data rather
+# than from the impurity decrease on the training data.
+# 'permutation' shuffles each feature n_repeats times and records the
+# increase in mean squared error. 'tree_shap' computes the exact
+# path-dependent SHAP value of every held-out sample and averages their
+# absolute values. The work is split into tasks across a process pool with
+# a seed spawned per task, so the result does not depend on the number of
+# processes, and the result is cached on disk under a hash of the model,
+# the held-out data and the parameters.
+
+# Parameters:
+#   - model (RandomForestRegressor): the fitted forest
+#   - X (array): the held-out features
+#   - y (array): the held-out target values
+#   - method (str): one of IMPORTANCE_METHODS
+#   - n_repeats (int): the shuffles per feature ('permutation')
+#   - max_samples (int): the held-out samples explained ('tree_shap', None
+#                        for all)
+#   - seed (int): the seed of the shuffles and the sample
+#   - batch_size (int): the shuffles or trees per task
+#   - cache_dir (str): the directory of cached results (None disables caching)
+#   - max_workers (int): the number of processes (None uses every core)
+
+# Returns a dictionary of the method, mean and standard deviation of each
+# feature's importance, seconds taken, cache status and model hash
+
+def feature_importance(model, X, y, method : str = 'permutation', n_repeats : int = 30,
+                       max_samples : int = 500, seed : int = 0, batch_size : int = 10,
+                       cache_dir : str = MODEL_CACHE_DIR, max_workers : int = None):
+    if method not in IMPORTANCE_METHODS:
+        raise ValueError(f'method must be one of {IMPORTANCE_METHODS}')
+
+    X = np.ascontiguousarray(X, dtype=float)
+    y = np.ascontiguousarray(y, dtype=float)
+    n_features = X.shape[1]
+
+    if method == 'tree_shap' and n_features > MAX_SHAP_FEATURES:
+        raise ValueError(f'tree_shap enumerates 2^features subsets so it is limited to '
+                         f'{MAX_SHAP_FEATURES} features')
+
+    start = time.perf_counter()
+    params = {'method': method, 'seed': seed,
+              'n_repeats': n_repeats if method == 'permutation' else None,
+              'max_samples': max_samples if method == 'tree_shap' else None}
+
+    # Look for a cached result of the same model, data and parameters
+    hashed_model = model_hash(model)
+    result_path = None
+    if cache_dir is not None:
+        digest = hashlib.sha256(hashed_model.encode())
+        digest.update(X.tobytes())
+        digest.update(y.tobytes())
+        digest.update(json.dumps(params, sort_keys=True).encode())
+
+        os.makedirs(cache_dir, exist_ok=True)
+        result_path = os.path.join(cache_dir, f'{digest.hexdigest()}.importance.json')
+
+        if os.path.exists(result_path):
+            with open(result_path) as file:
+                result = json.load(file)
+            result['cache'] = 'hit'
+            result['seconds'] = round(time.perf_counter() - start, 4)
+            return result
+
+    with span('feature_importance', method=method, rows_in=len(X)) as importance_span:
+        if method == 'permutation':
+            batches = [min(batch_size, n_repeats - offset)
+                       for offset in range(0, n_repeats, batch_size)]
+            tasks = [(feature, size) for feature in range(n_features) for size in batches]
+            seeds = np.random.SeedSequence(seed).spawn(len(tasks))
+            tasks = [task + (task_seed,) for task, task_seed in zip(tasks, seeds)]
+        else:
+            if max_samples is not None and len(X) > max_samples:
+                rows = np.sort(np.random.default_rng(seed).choice(len(X), max_samples,
+                                                                  replace=False))
+                X, y = X[rows], y[rows]
+
+            # Repeated ratings have the same SHAP values so each distinct
+            # row is explained once
+            explained, inverse = np.unique(X, axis=0, return_inverse=True)
+            n_trees = len(model.estimators_)
+            tasks = [(offset, min(offset + batch_size, n_trees))
+                     for offset in range(0, n_trees, batch_size)]
+
+        max_workers = max_workers or min(os.cpu_count() or 1, len(tasks))
+        importance_span.set(tasks=len(tasks), workers=max_workers)
+
+        if method == 'permutation':
+            results = run_tasks(permutation_task, tasks, model, X, y, max_workers)
+        else:
+            results = run_tasks(tree_shap_task, tasks, model, explained, None, max_workers)
+
+    if method == 'permutation':
+        scores = np.column_stack([np.concatenate(results[f * len(batches):(f + 1) * len(batches)])
+                                  for f in range(n_features)])
+        extra = {}
+    else:
+        shap = (sum(total for total, _ in results) / n_trees)[inverse.ravel()]
+        expected = sum(base for _, base in results) / n_trees
+        scores = np.abs(shap)
+
+        # The SHAP values of a sample add up to its prediction
+        additivity_error = np.abs(shap.sum(axis=1) + expected - model.predict(X)).max()
+        extra = {'expected_value': float(expected),
+                 'additivity_error': float(additivity_error)}
+
+    result = {
+        'method': method,
+        'importances_mean': scores.mean(axis=0).tolist(),
+        'importances_std': scores.std(axis=0).tolist(),
+        'samples': len(X),
+        'workers': max_workers,
+        'model_hash': hashed_model,
+        **extra
+    }
+
+    if result_path is not None:
+        with open(result_path, 'w') as file:
+            json.dump(result, file)
+
+    result['cache'] = 'miss' if result_path is not None else 'disabled'
+    result['seconds'] = round(time.perf_counter() - start, 4)
+
+    return result
+
+
+# Returns the held-out feature importances of the per-gender forests fitted
+# by train_and_evaluate_parallel (loaded from the model cache when present)
+
+# Parameters:
+#   - rating_data (dict): ratings per date created by fetch_rating_data
+#   - gender_labels (list): the genders to be included
+#   - method (str): one of IMPORTANCE_METHODS
+#   - n_estimators (int): the number of trees per forest
+#   - random_state (int): the seed for the split and the forests
+#   - cache_dir (str): the directory of cached models and results
+#   - kwargs: passed to feature_importance
+
+# Returns the mean importances by gender (the layout used by
+# create_bar_traces) and the full result of each gender
+
+def gender_importances(rating_data, gender_labels : list, method : str = 'permutation',
+                       n_estimators : int = 200, random_state : int = 42,
+                       cache_dir : str = MODEL_CACHE_DIR, **kwargs):
+    importances = {}
+    reports = {}
+
+    for i, gender in enumerate(gender_labels):
+        model, (_, X_test, _, y_test), _ = fit_model(rating_data[i][0], rating_data[i][1],
+                                                     n_estimators, random_state, cache_dir)
+        reports[gender] = feature_importance(model, X_test, y_test, method,
+                                             cache_dir=cache_dir, **kwargs)
+        importances[gender] = reports[gender]['importances_mean']
+
+    return importances, reports
@@ -0,0 +1,309 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from speed_dating.tracing import connect, span
+
+
+# K nearest neighbour imputation that only touches rows with missing values.
+# Donors are the complete rows. Rows with missing values are grouped by which
+# columns are missing and their neighbours are searched on the observed
+# columns only, either through a KD-tree or a blocked distance computation.
+# New complete rows can be added with partial_fit without refitting.
+
+# Parameters:
+#   - n_neighbors (int): the number of neighbours used for each imputation
+#   - method (str): 'kdtree' to search a spatial index or 'blocked' to
+#                   compute distances in blocks of block_size query rows
+#   - block_size (int): the number of query rows per distance block
+
+class KNNImputationEngine:
+
+    def __init__(self, n_neighbors : int = 5, method : str = 'kdtree',
+                 block_size : int = 2048):
+        if method not in ('kdtree', 'blocked'):
+            raise ValueError(f"method must be 'kdtree' or 'blocked', not {method!r}")
+
+        self.n_neighbors = n_neighbors
+        self.method = method
+        self.block_size = block_size
+        self.donors = None
+        # The highest database rowid already added as a donor
+        # (kept up to date by impute_null_values)
+        self.seen_rowid = 0
+        self._trees = {}
+
+    # Uses the complete rows of X as donors
+
+    # Parameters:
+    #   - X (array): 2D array of values with NaN for missing values
+
+    def fit(self, X):
+        X = np.asarray(X, dtype=float)
+        self.donors = X[~np.isnan(X).any(axis=1)]
+        self._trees = {}
+        return self
+
+    # Adds the complete rows of X to the donors without refitting
+
+    # Parameters:
+    #   - X (array): 2D array of new values with NaN for missing values
+
+    def partial_fit(self, X):
+        X = np.asarray(X, dtype=float)
+
+        if self.donors is None:
+            return self.fit(X)
+
+        new_donors = X[~np.isnan(X).any(axis=1)]
+
+        if len(new_donors):
+            self.donors = np.vstack([self.donors, new_donors])
+            # Indexes are rebuilt lazily on the next transform
+            self._trees = {}
+
+        return self
+
+    # Returns the indices of the k nearest donors for each query row,
+    # sorted from nearest to furthest
+
+    # Parameters:
+    #   - queries (array): 2D array of the observed values of each query row
+    #   - observed (tuple): the column indices the query values belong to
+    #   - k (int): the number of neighbours to return
+
+    def kneighbors(self, queries, observed : tuple, k : int):
+        donors = self.donors[:, list(observed)]
+        k = min(k, len(donors))
+
+        if self.method == 'kdtree':
+            if observed not in self._trees:
+                self._trees[observed] = cKDTree(donors)
+            _, indices = self._trees[observed].query(queries, k=k)
+            return indices.reshape(len(queries), k)
+
+        indices = np.empty((len(queries), k), dtype=np.int64)
+        donor_norms = (donors ** 2).sum(axis=1)
+
+        for start in range(0, len(queries), self.block_size):
+            block = queries[start:start + self.block_size]
+            # Squared euclidean distances for the block against every donor
+            distances = donor_norms[None, :] - 2 * block @ donors.T
+            nearest = np.argpartition(distances, k - 1, axis=1)[:, :k]
+            order = np.argsort(np.take_along_axis(distances, nearest, axis=1), axis=1)
+            indices[start:start + len(block)] = np.take_along_axis(nearest, order, axis=1)
+
+        return indices
+
+    # Returns a copy of X with missing values imputed. Complete rows are
+    # returned unchanged.
+
+    # Parameters:
+    #   - X (array): 2D array of values with NaN for missing values
+
+    def transform(self, X):
+        if self.donors is None or not len(self.donors):
+            raise ValueError('KNNImputationEngine needs complete donor rows before transform')
+
+        X = np.array(X, dtype=float)
+        missing = np.isnan(X)
+        rows = np.flatnonzero(missing.any(axis=1))
+
+        if not len(rows):
+            return X
+
+        # Group the incomplete rows by their missing pattern
+        patterns, pattern_ids = np.unique(missing[rows], axis=0, return_inverse=True)
+
+        for pattern_id, pattern in enumerate(patterns):
+            pattern_rows = rows[pattern_ids.ravel() == pattern_id]
+            observed = tuple(np.flatnonzero(~pattern))
+            missing_columns = np.flatnonzero(pattern)
+
+            # Nothing to measure distance on so fall back to the donor means
+            if not observed:
+                X[np.ix_(pattern_rows, missing_columns)] = self.donors[:, missing_columns].mean(axis=0)
+                continue
+
+            indices = self.kneighbors(X[np.ix_(pattern_rows, observed)], observed,
+                                      self.n_neighbors)
+            neighbours = self.donors[:, missing_columns][indices]
+            X[np.ix_(pattern_rows, missing_columns)] = neighbours.mean(axis=1)
+
+        return X
+
+    def fit_transform(self, X):
+        return self.fit(X).transform(X)
+
+
+# Scores one cross-validation fold for every candidate number of neighbours.
+# Values are hidden in the fold's rows, the rows are imputed once with the
+# largest candidate and every smaller candidate reuses the sorted neighbours.
+
+# Parameters:
+#   - X (array): 2D array of complete rows
+#   - train_index (array): the rows used as donors
+#   - test_index (array): the rows whose values are hidden and imputed
+#   - candidates (tuple): the numbers of neighbours to score
+#   - seed (int): the seed used to choose which values are hidden
+
+def score_fold(X, train_index, test_index, candidates : tuple, seed : int):
+    rng = np.random.default_rng(seed)
+    test = X[test_index]
+
+    # Hide one or two values per row, matching the rows that are imputed,
+    # and always leave one observed value to measure distances on
+    max_hidden = min(2, test.shape[1] - 1)
+    hidden = np.zeros(test.shape, dtype=bool)
+    for row in range(len(test)):
+        columns = rng.choice(test.shape[1], size=rng.integers(1, max_hidden + 1), replace=False)
+        hidden[row, columns] = True
+
+    engine = KNNImputationEngine(max(candidates)).fit(X[train_index])
+    squared_errors = {k: 0.0 for k in candidates}
+
+    patterns, pattern_ids = np.unique(hidden, axis=0, return_inverse=True)
+
+    for pattern_id, pattern in enumerate(patterns):
+        pattern_rows = np.flatnonzero(pattern_ids.ravel() == pattern_id)
+        observed = tuple(np.flatnonzero(~pattern))
+        missing_columns = np.flatnonzero(pattern)
+
+        indices = engine.kneighbors(test[np.ix_(pattern_rows, observed)], observed,
+                                    max(candidates))
+        neighbours = engine.donors[:, missing_columns][indices]
+        # Running means over the sorted neighbours give every k at once
+        running_means = np.cumsum(neighbours, axis=1) / np.arange(1, indices.shape[1] + 1)[None, :, None]
+        truth = test[np.ix_(pattern_rows, missing_columns)]
+
+        for k in candidates:
+            estimate = running_means[:, min(k, indices.shape[1]) - 1]
+            squared_errors[k] += float(((estimate - truth) ** 2).sum())
+
+    return squared_errors, int(hidden.sum())
+
+
+# Cross-validates the number of neighbours by hiding known values and
+# comparing them with their imputed values. Folds are scored in parallel.
+
+# Parameters:
+#   - X (array): 2D array of values (incomplete rows are ignored)
+#   - candidates (tuple): the numbers of neighbours to score
+#   - n_splits (int): the number of cross-validation folds
+#   - n_jobs (int): the number of processes (None uses every core)
+#   - random_state (int): the seed for the folds and hidden values
+
+# Returns the best number of neighbours and the RMSE of every candidate
+
+def select_n_neighbors(X, candidates : tuple = (1, 3, 5, 7, 9, 15, 25), n_splits : int = 5,
+                       n_jobs : int = None, random_state : int = 42):
+    X = np.asarray(X, dtype=float)
+    if X.ndim != 2 or X.shape[1] < 2:
+        raise ValueError('select_n_neighbors needs at least two columns to hide values from')
+    X = X[~np.isnan(X).any(axis=1)]
+
+    rng = np.random.default_rng(random_state)
+    folds = np.array_split(rng.permutation(len(X)), n_splits)
+
+    fold_args = []
+    for i, test_index in enumerate(folds):
+        train_index = np.concatenate([fold for j, fold in enumerate(folds) if j != i])
+        fold_args.append((X, train_index, test_index, candidates, random_state + i))
+
+    n_jobs = n_jobs or os.cpu_count()
+
+    with span('score_folds', rows_in=len(X), folds=n_splits, workers=n_jobs):
+        if n_jobs == 1:
+            results = [score_fold(*args) for args in fold_args]
+        else:
+            with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+                results = list(executor.map(score_fold, *zip(*fold_args)))
+
+    hidden_total = sum(hidden for _, hidden in results)
+    rmse = {
+        k: float(np.sqrt(sum(errors[k] for errors, _ in results) / hidden_total))
+        for k in candidates
+    }
+
+    return min(rmse, key=rmse.get), rmse
+
+
+# Returns the complete rows of a set of columns in speed_dating
+
+# Parameters:
+#   - database_path (str): the path to your database
+#   - columns (list): the set of columns to fetch
+
+def fetch_complete_rows(database_path : str, columns : list):
+    conn = connect(database_path)
+
+    rows = conn.execute(
+        f"SELECT {', '.join(columns)} FROM speed_dating "
+        f"WHERE {' AND '.join(f'{column} IS NOT NULL' for column in columns)}"
+    ).fetchall()
+
+    conn.close()
+
+    return np.array(rows, dtype=float).reshape(-1, len(columns))
+
+
+# Performs KNN imputation in place on the rows of speed_dating that have
+# NULL values. Only the imputed rows are written back with UPDATE so the
+# table (and its indexes) is kept rather than replaced.
+# Passing the engine from an earlier call only adds the complete rows
+# inserted since that call as donors instead of refitting on the table.
+
+# Parameters:
+#   - cursor (sqlite3.Cursor): a cursor with an open transaction
+#   - columns_to_impute (list): the set of columns to perform data imputation on
+#   - n_neighbors (int): the number of neighbours used for each imputation
+#   - engine (KNNImputationEngine): an engine fitted by an earlier call
+
+# Returns the number of rows imputed and the engine
+
+def impute_null_values(cursor, columns_to_impute : list, n_neighbors : int = 5,
+                       engine : KNNImputationEngine = None):
+    if engine is None:
+        engine = KNNImputationEngine(n_neighbors)
+
+    complete = ' AND '.join(f'{column} IS NOT NULL' for column in columns_to_impute)
+    incomplete = ' OR '.join(f'{column} IS NULL' for column in columns_to_impute)
+
+    # Add the complete rows the engine has not seen as donors
+    cursor.execute(
+        f"SELECT rowid, {', '.join(columns_to_impute)} FROM speed_dating "
+        f"WHERE rowid > ? AND {complete}", (engine.seen_rowid,)
+    )
+    donors = np.array(cursor.fetchall(), dtype=float).reshape(-1, len(columns_to_impute) + 1)
+
+    if len(donors):
+        with span('fit_donors', rows_in=len(donors)):
+            engine.partial_fit(donors[:, 1:])
+        engine.seen_rowid = int(donors[:, 0].max())
+
+    # Only the rows with NULL values are read and imputed
+    cursor.execute(
+        f"SELECT rowid, {', '.join(columns_to_impute)} FROM speed_dating WHERE {incomplete}"
+    )
+    rows = np.array(cursor.fetchall(), dtype=float).reshape(-1, len(columns_to_impute) + 1)
+
+    if not len(rows):
+        return 0, engine
+
+    with span('transform', rows_in=len(rows)):
+        imputed = engine.transform(rows[:, 1:])
+    # Imputed rows are never used as donors on later calls
+    engine.seen_rowid = max(engine.seen_rowid, int(rows[:, 0].max()))
+
+    update_query = (
+        f"UPDATE speed_dating SET {', '.join(f'{column} = ?' for column in columns_to_impute)} "
+        f"WHERE rowid = ?"
+    )
+    with span('write_imputed', rows_out=len(rows)):
+        cursor.executemany(update_query, [
+            (*row.tolist(), int(rowid)) for row, rowid in zip(imputed, rows[:, 0])
+        ])
+
+    return len(rows), engine
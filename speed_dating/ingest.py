@@ -0,0 +1,142 @@
+import time
+
+import pandas as pd
+
+from speed_dating.tracing import connect, peak_rss_mb, span
+
+# Mapping between original and desired column names so pf_o columns are
+# consistent with 3_1 and _o
+COLUMN_MAPPING = {
+    'pf_o_att': 'pf_o_attr',
+    'pf_o_sin': 'pf_o_sinc',
+    'pf_o_int': 'pf_o_intel'
+}
+
+# Columns stored as integers. Everything else is a rating and stored as a float.
+# iid/pid use 32 bit ints as 16 bits overflows past 32767 participants
+ID_COLUMNS = ['iid', 'pid']
+FLAG_COLUMNS = ['gender', 'match', 'dec_o']
+
+# Pragmas for a one-off bulk load. The database is rebuilt from the .csv
+# if the load is interrupted so durability is not needed during the load.
+BULK_LOAD_PRAGMAS = [
+    'PRAGMA journal_mode = OFF',
+    'PRAGMA synchronous = OFF',
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA cache_size = -65536',
+    'PRAGMA locking_mode = EXCLUSIVE'
+]
+
+# The bulk load pragmas that need the only connection to the database.
+# They are skipped on a database in WAL mode (see query_pool.enable_wal),
+# which other connections such as the pipeline's state or a query pool
+# may hold open, and which must stay in WAL for them.
+EXCLUSIVE_PRAGMAS = ['PRAGMA journal_mode = OFF', 'PRAGMA locking_mode = EXCLUSIVE']
+
+
+# Returns the pandas dtype for each selected .csv column
+
+# Parameters:
+#   - csv_columns (list): the columns to include from the original database
+
+def column_dtypes(csv_columns : list):
+    dtypes = {}
+
+    for column in csv_columns:
+        if column in ID_COLUMNS:
+            dtypes[column] = 'Int32'
+        elif column in FLAG_COLUMNS:
+            dtypes[column] = 'Int8'
+        else:
+            dtypes[column] = 'float64'
+
+    return dtypes
+
+
+# Converts the .csv to .db by streaming it in fixed size chunks.
+# Each chunk is inserted with executemany inside a single transaction so
+# memory stays flat as the .csv grows.
+# pf_o columns will be mapped so their names are consistent with 3_1 and _o
+
+# Parameters:
+#   - csv_file (str): the name of the .csv
+#   - encoding_type (str): the encoding of the csv
+#   - database_path (str): the path of the .db
+#   - csv_columns (list): the columns to include from the original database
+#   - chunk_size (int): the number of .csv rows read and inserted at a time
+
+# Returns a dictionary with the rows inserted, seconds taken, rows per second
+# and peak RSS in megabytes
+
+def create_db_streaming(csv_file : str, encoding_type : str,
+                        database_path : str, csv_columns : list,
+                        chunk_size : int = 50000):
+    start_time = time.perf_counter()
+
+    dtypes = column_dtypes(csv_columns)
+    table_columns = [COLUMN_MAPPING.get(column, column) for column in csv_columns]
+
+    # Connect to database
+    conn = connect(database_path)
+    # Create cursor object
+    cursor = conn.cursor()
+
+    try:
+        wal = cursor.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+
+        for pragma in BULK_LOAD_PRAGMAS:
+            if not (wal and pragma in EXCLUSIVE_PRAGMAS):
+                cursor.execute(pragma)
+
+        # Create the table with declared types so SQLite stores compact values
+        column_definitions = [
+            f'{name} {"REAL" if dtypes[column] == "float64" else "INTEGER"}'
+            for column, name in zip(csv_columns, table_columns)
+        ]
+        cursor.execute('DROP TABLE IF EXISTS speed_dating')
+        cursor.execute(f'CREATE TABLE speed_dating ({", ".join(column_definitions)})')
+
+        insert_query = (
+            f'INSERT INTO speed_dating ({", ".join(table_columns)}) '
+            f'VALUES ({", ".join(["?"] * len(table_columns))})'
+        )
+
+        # Read the CSV in chunks with only the selected columns parsed
+        chunks = pd.read_csv(csv_file, encoding=encoding_type, usecols=csv_columns,
+                             dtype=dtypes, chunksize=chunk_size)
+
+        rows_inserted = 0
+
+        # One transaction for the whole load
+        cursor.execute('BEGIN')
+
+        with span('insert_rows') as insert_span:
+            for chunk in chunks:
+                # Keep the .csv column order and swap missing values for NULL
+                chunk = chunk[csv_columns].astype(object)
+                chunk = chunk.where(chunk.notna(), None)
+
+                cursor.executemany(insert_query, chunk.itertuples(index=False, name=None))
+                rows_inserted += len(chunk)
+
+            insert_span.set(rows_out=rows_inserted)
+
+        # Create indexes once the data is loaded
+        with span('create_indexes'):
+            cursor.execute('CREATE INDEX idx_iid ON speed_dating(iid);')
+            cursor.execute('CREATE INDEX idx_pid ON speed_dating(pid);')
+
+        # Commit changes to the database
+        conn.commit()
+    finally:
+        # Close the database (a failed load is rolled back and its lock released)
+        conn.close()
+
+    seconds = time.perf_counter() - start_time
+
+    return {
+        'rows': rows_inserted,
+        'seconds': round(seconds, 4),
+        'rows_per_sec': round(rows_inserted / seconds, 1) if seconds else None,
+        'peak_rss_mb': peak_rss_mb()
+    }
@@ -0,0 +1,35 @@
+import ast
+import json
+import os
+
+# The analysis notebook at the root of the repository
+NOTEBOOK_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                             'speed_dating_analysis.ipynb')
+
+
+# Returns the functions defined in the analysis notebook without running it.
+# Only the imports and function definitions of each code cell are executed,
+# so nothing is read, plotted or trained.
+
+# Parameters:
+#   - path (str): the path of the notebook
+
+# Returns a dictionary of name to imported module or defined function
+
+def load_notebook_functions(path : str = NOTEBOOK_PATH):
+    with open(path, encoding='utf-8') as file:
+        cells = json.load(file)['cells']
+
+    namespace = {'__name__': 'speed_dating_analysis'}
+
+    for cell in cells:
+        if cell['cell_type'] != 'code':
+            continue
+
+        tree = ast.parse(''.join(cell['source']))
+        tree.body = [node for node in tree.body
+                     if isinstance(node, (ast.Import, ast.ImportFrom, ast.FunctionDef))]
+
+        exec(compile(tree, path, 'exec'), namespace)
+
+    return namespace
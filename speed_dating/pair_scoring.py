@@ -0,0 +1,191 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+from speed_dating.scoring import ScoringModel
+
+# The scoring model loaded once in each worker process
+_worker_model = None
+
+
+# Returns the wave of each participant. Dates never cross waves, so the
+# waves are the connected components of the graph of dates.
+
+# Parameters:
+#   - iid (array): the iid of each participant
+#   - date_iid (array): the iid of each date
+#   - date_pid (array): the pid of each date
+
+def participant_waves(iid, date_iid, date_pid):
+    iid = np.asarray(iid, dtype=np.int64)
+    rows = np.searchsorted(iid, date_iid)
+    columns = np.searchsorted(iid, date_pid)
+
+    # Dates with a pid that is not a participant do not link anyone
+    known = (columns < len(iid)) & (iid[np.minimum(columns, len(iid) - 1)] == date_pid)
+
+    graph = coo_matrix((np.ones(known.sum()), (rows[known], columns[known])),
+                       shape=(len(iid), len(iid)))
+    _, waves = connected_components(graph, directed=False)
+
+    return waves
+
+
+# Returns the ratings a participant is expected to receive from a partner
+# before they have met: their self-ratings weighted by how many of their 100
+# points the partner allocated to each attribute (an even allocation of 20
+# points leaves the self-rating unchanged).
+
+# Parameters:
+#   - self_ratings (array): (..., 5) self-ratings (the 3_1 columns)
+#   - preferences (array): (..., 5) partner preferences (the pf_o columns)
+
+def pair_features(self_ratings, preferences):
+    weights = preferences * self_ratings.shape[-1] / 100
+
+    return np.clip(self_ratings * weights, 1, 10)
+
+
+# Scores every male x female pair of one wave in chunks of males so only
+# chunk_size x females feature rows exist at a time
+
+# Parameters:
+#   - model (ScoringModel): the per-gender scoring model
+#   - male_self (array): (m, 5) male self-ratings
+#   - male_prefs (array): (m, 5) male preferences
+#   - female_self (array): (f, 5) female self-ratings
+#   - female_prefs (array): (f, 5) female preferences
+#   - chunk_size (int): the number of males scored at once
+
+# Returns the (m, f) probabilities that the female says yes to the male,
+# that the male says yes to the female and that both say yes
+
+def score_wave_pairs(model : ScoringModel, male_self, male_prefs, female_self, female_prefs,
+                     chunk_size : int = 64):
+    males, females = len(male_self), len(female_self)
+
+    female_yes = np.empty((males, females))
+    male_yes = np.empty((males, females))
+
+    for start in range(0, males, chunk_size):
+        stop = min(start + chunk_size, males)
+        chunk = stop - start
+
+        # The male is the iid (gender 1) rated by the female
+        male_features = pair_features(male_self[start:stop, None, :], female_prefs[None, :, :])
+        female_yes[start:stop] = model.score(male_features.reshape(-1, male_self.shape[1]),
+                                             1).reshape(chunk, females)
+
+        # The female is the iid (gender 0) rated by the male
+        female_features = pair_features(female_self[None, :, :], male_prefs[start:stop, None, :])
+        male_yes[start:stop] = model.score(female_features.reshape(-1, female_self.shape[1]),
+                                           0).reshape(chunk, females)
+
+    return female_yes, male_yes, female_yes * male_yes
+
+
+# Returns the column indices of the k largest values in each row, largest
+# first, using a partial sort
+
+# Parameters:
+#   - scores (array): 2D array of scores
+#   - k (int): the number of columns to return per row
+
+def top_k(scores, k : int):
+    k = min(k, scores.shape[1])
+
+    if k == 0:
+        return np.empty((len(scores), 0), dtype=np.int64)
+
+    candidates = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    order = np.argsort(-np.take_along_axis(scores, candidates, axis=1), axis=1)
+
+    return np.take_along_axis(candidates, order, axis=1)
+
+
+# Loads the scoring model once per worker process
+
+# Parameters:
+#   - model_path (str): the path of the saved scoring model
+
+def _load_worker_model(model_path : str):
+    global _worker_model
+    _worker_model = ScoringModel.load(model_path)
+
+
+# Scores one wave in a worker process
+
+# Parameters:
+#   - wave (dict): the iids, self-ratings and preferences of each gender
+#   - k (int): the number of partners to recommend per participant
+#   - chunk_size (int): the number of males scored at once
+
+def _score_wave(wave : dict, k : int, chunk_size : int):
+    female_yes, male_yes, mutual = score_wave_pairs(
+        _worker_model, wave['male_self'], wave['male_prefs'],
+        wave['female_self'], wave['female_prefs'], chunk_size)
+
+    return {
+        'males': wave['males'],
+        'females': wave['females'],
+        'female_yes': female_yes,
+        'male_yes': male_yes,
+        'mutual': mutual,
+        'top_females_for_male': wave['females'][top_k(mutual, k)],
+        'top_males_for_female': wave['males'][top_k(mutual.T, k)]
+    }
+
+
+# Scores every male x female pair in each wave and recommends the top-k
+# partners per participant by mutual second date probability. Waves are
+# scored in parallel processes that each load the scoring model once.
+
+# Parameters:
+#   - store (AnalysisStore): the loaded analysis store
+#   - model_path (str): the path of the saved scoring model
+#   - columns_3_1 (list): list of attributes ending in 3_1 (self ratings given)
+#   - columns_pf_o (list): list of attributes in the form
+#                          pf_o_{attribute} (attribute preferences)
+#   - k (int): the number of partners to recommend per participant
+#   - chunk_size (int): the number of males scored at once
+#   - max_workers (int): the number of processes (None uses every core)
+
+# Returns a dictionary of wave to its pair probabilities and recommendations
+
+def score_all_pairs(store, model_path : str, columns_3_1 : list, columns_pf_o : list,
+                    k : int = 5, chunk_size : int = 64, max_workers : int = None):
+    waves = participant_waves(store.iid, store.dates['iid'], store.dates['pid'])
+
+    self_ratings = np.column_stack([store.participants[column] for column in columns_3_1])
+    preferences = np.column_stack([store.participants[column] for column in columns_pf_o])
+
+    # Missing preferences count as an even allocation
+    preferences = np.where(np.isnan(preferences), 100 / len(columns_pf_o), preferences)
+
+    tasks = {}
+    for wave in np.unique(waves):
+        males = (waves == wave) & (store.gender == 1)
+        females = (waves == wave) & (store.gender == 0)
+
+        if males.any() and females.any():
+            tasks[int(wave)] = {
+                'males': store.iid[males], 'females': store.iid[females],
+                'male_self': self_ratings[males], 'male_prefs': preferences[males],
+                'female_self': self_ratings[females], 'female_prefs': preferences[females]
+            }
+
+    max_workers = max_workers or os.cpu_count()
+
+    if max_workers == 1:
+        _load_worker_model(model_path)
+        results = [_score_wave(task, k, chunk_size) for task in tasks.values()]
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=_load_worker_model,
+                                 initargs=(model_path,)) as executor:
+            results = list(executor.map(_score_wave, tasks.values(),
+                                        [k] * len(tasks), [chunk_size] * len(tasks)))
+
+    return dict(zip(tasks, results))
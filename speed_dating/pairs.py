@@ -0,0 +1,326 @@
+import time
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from speed_dating.query_pool import shared_pool
+from speed_dating.tracing import connect, span
+
+
+# Creates the pairs table holding each date once, keyed by the lower iid
+# (a) and the higher iid (b), with both sides' decisions and ratings side by
+# side. A dates row (iid, pid) holds pid's decision on and ratings of iid,
+# so a's decision on b comes from the mirror row (b, a) and b's from (a, b).
+# delete_missing_pairs guarantees every row has its mirror.
+
+# Parameters:
+#   - cursor (sqlite3.Cursor): a cursor in the open transaction
+#   - columns_o (list): list of attributes ending in _o (ratings received)
+
+def create_pairs_table(cursor, columns_o : list):
+    # Drop the pairs table if it exists
+    cursor.execute('DROP TABLE IF EXISTS pairs')
+
+    attributes = [column[:-2] for column in columns_o]
+
+    cursor.execute(f'''
+        CREATE TABLE pairs(
+            iid_a INTEGER NOT NULL REFERENCES participants (iid),
+            iid_b INTEGER NOT NULL REFERENCES participants (iid),
+            date_id_a INTEGER NOT NULL,
+            date_id_b INTEGER NOT NULL,
+            dec_a INTEGER NOT NULL CHECK (dec_a IN (0, 1)),
+            dec_b INTEGER NOT NULL CHECK (dec_b IN (0, 1)),
+            match INTEGER NOT NULL CHECK (match IN (0, 1)),
+            {', '.join(f'{attribute}_a REAL, {attribute}_b REAL' for attribute in attributes)},
+            PRIMARY KEY (iid_a, iid_b),
+            CHECK (iid_a < iid_b)
+            ) STRICT, WITHOUT ROWID
+    ''')
+
+    insert_pairs(cursor, columns_o)
+
+    # Pairs of a participant as the higher iid
+    cursor.execute('CREATE INDEX idx_pairs_iid_b ON pairs (iid_b, iid_a)')
+
+    return cursor.execute('SELECT COUNT(*) FROM pairs').fetchone()[0]
+
+
+# Inserts the pairs of the dates after a date_id into the pairs table
+
+# Parameters:
+#   - cursor (sqlite3.Cursor): a cursor in the open transaction
+#   - columns_o (list): list of attributes ending in _o (ratings received)
+#   - after_date_id (int): only pairs dates with a later date_id (0 pairs
+#                          every date)
+
+def insert_pairs(cursor, columns_o : list, after_date_id : int = 0):
+    attributes = [column[:-2] for column in columns_o]
+
+    # The ratings a gave b are the ratings b received on the (b, a) row
+    cursor.execute(f'''
+        INSERT INTO pairs (iid_a, iid_b, date_id_a, date_id_b, dec_a, dec_b, match,
+                           {', '.join(f'{attribute}_a, {attribute}_b' for attribute in attributes)})
+        SELECT a.iid, a.pid, a.date_id, b.date_id, b.dec_o, a.dec_o, a.match,
+               {', '.join(f'b.{attribute}_o, a.{attribute}_o' for attribute in attributes)}
+        FROM dates AS a
+        JOIN dates AS b ON b.iid = a.pid AND b.pid = a.iid
+        WHERE a.iid < a.pid AND (a.date_id > ? OR b.date_id > ?)
+        ORDER BY a.iid, a.pid
+    ''', (after_date_id, after_date_id))
+
+    return cursor.rowcount
+
+
+# Builds the pairs table from the dates table in one transaction
+
+# Parameters:
+#   - database_path (str): the path to your database
+#   - columns_o (list): list of attributes ending in _o (ratings received)
+
+# Returns a list of {stage, seconds, rows}
+
+def build_pairs(database_path : str, columns_o : list):
+    # Connect to database
+    conn = connect(database_path)
+
+    # Create a cursor object
+    cursor = conn.cursor()
+
+    try:
+        cursor.execute('BEGIN')
+
+        stage_start = time.perf_counter()
+        with span('create_pairs') as stage_span:
+            rows = create_pairs_table(cursor, columns_o)
+            stage_span.set(rows_out=rows)
+
+        # Commit the changes
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        # Close the connection
+        conn.close()
+
+    seconds = round(time.perf_counter() - stage_start, 4)
+    print(f'create_pairs: {rows} rows in {seconds} seconds.')
+
+    return [{'stage': 'create_pairs', 'seconds': seconds, 'rows': rows}]
+
+
+# Returns the pairs table as a dictionary of arrays
+
+# Parameters:
+#   - database_path (str): the path to your database
+
+def load_pairs(database_path : str):
+    return shared_pool(database_path).fetch_columns('SELECT * FROM pairs ORDER BY iid_a, iid_b')
+
+
+# Returns the same columns as the pairs table built from the store's dates
+# by matching each date with its mirror through sorted (iid, pid) keys
+
+# Parameters:
+#   - store (AnalysisStore): the in-memory store
+#   - columns_o (list): list of attributes ending in _o (ratings received)
+
+def pairs_from_store(store, columns_o : list):
+    iid = store.dates['iid'].astype(np.int64)
+    pid = store.dates['pid'].astype(np.int64)
+
+    # A key per (iid, pid) and per mirror (pid, iid)
+    base = max(iid.max(), pid.max()) + 1
+    keys = iid * base + pid
+    order = np.argsort(keys, kind='stable')
+    position = np.searchsorted(keys[order], pid * base + iid)
+    position = np.minimum(position, len(keys) - 1)
+    mirror = order[position]
+
+    lower = (iid < pid) & (keys[mirror] == pid * base + iid)
+    a = np.flatnonzero(lower)
+    a = a[np.lexsort((pid[a], iid[a]))]
+    b = mirror[a]
+
+    pairs = {
+        'iid_a': iid[a].astype(float), 'iid_b': pid[a].astype(float),
+        'date_id_a': store.dates['date_id'][a], 'date_id_b': store.dates['date_id'][b],
+        'dec_a': store.dates['dec_o'][b], 'dec_b': store.dates['dec_o'][a],
+        'match': store.dates['match'][a]
+    }
+    for column in columns_o:
+        attribute = column[:-2]
+        pairs[f'{attribute}_a'] = store.dates[column][b]
+        pairs[f'{attribute}_b'] = store.dates[column][a]
+
+    return pairs
+
+
+# Sparse directed graph of the participants built from the dates. Node i
+# is the participant iid[i].
+#   - met[i, j] is 1 when i and j went on a date
+#   - decisions[i, j] is 1 when i said yes to j (the dec_o of the (j, i) row)
+#   - matches[i, j] is 1 when the date was a match (symmetric)
+# All three are CSR matrices, so the reciprocity and degree statistics are
+# sparse products and row sums over the dates instead of self-joins.
+
+# Parameters:
+#   - iid (array): the iid of each participant (sorted)
+#   - date_iid (array): the iid of each date
+#   - date_pid (array): the pid of each date
+#   - dec_o (array): the partner's decision on each date
+#   - match (array): whether each date was a match
+
+class MatchGraph:
+
+    def __init__(self, iid, date_iid, date_pid, dec_o, match):
+        self.iid = np.asarray(iid, dtype=np.int64)
+        n = len(self.iid)
+
+        rows = np.searchsorted(self.iid, np.asarray(date_iid, dtype=np.int64))
+        columns = np.searchsorted(self.iid, np.asarray(date_pid, dtype=np.int64))
+
+        # Dates with a partner who is not a participant are left out
+        known = ((rows < n) & (columns < n)
+                 & (self.iid[np.minimum(rows, n - 1)] == date_iid)
+                 & (self.iid[np.minimum(columns, n - 1)] == date_pid))
+        rows, columns = rows[known], columns[known]
+        dec_o = np.asarray(dec_o)[known]
+        match = np.asarray(match)[known]
+
+        self.met = self._adjacency(np.ones(len(rows)), rows, columns, n)
+        # The (iid, pid) row holds pid's decision on iid: an edge pid -> iid
+        self.decisions = self._adjacency(dec_o, columns, rows, n)
+        self.matches = self._adjacency(match, rows, columns, n)
+
+    # Returns a 0/1 CSR matrix with explicit zeros removed
+
+    # Parameters:
+    #   - values (array): the value of each edge
+    #   - rows (array): the source node of each edge
+    #   - columns (array): the target node of each edge
+    #   - n (int): the number of nodes
+
+    @staticmethod
+    def _adjacency(values, rows, columns, n : int):
+        matrix = csr_matrix((np.asarray(values, dtype=np.int8), (rows, columns)), shape=(n, n))
+        matrix.eliminate_zeros()
+
+        return matrix
+
+    # Builds the graph from the in-memory store
+
+    # Parameters:
+    #   - store (AnalysisStore): the in-memory store
+
+    @classmethod
+    def from_store(cls, store):
+        return cls(store.iid, store.dates['iid'], store.dates['pid'], store.dates['dec_o'],
+                   store.dates['match'])
+
+    # Builds the graph from the dates table
+
+    # Parameters:
+    #   - database_path (str): the path to your database
+
+    @classmethod
+    def from_database(cls, database_path : str):
+        pool = shared_pool(database_path)
+        participants = pool.fetch_columns('SELECT iid FROM participants ORDER BY iid')
+        dates = pool.fetch_columns('SELECT iid, pid, dec_o, match FROM dates')
+
+        return cls(participants['iid'], dates['iid'], dates['pid'], dates['dec_o'],
+                   dates['match'])
+
+    # Returns the pairs where both said yes to each other (symmetric)
+
+    def mutual(self):
+        return self.decisions.multiply(self.decisions.T).tocsr()
+
+    # Returns per-participant statistics as a dictionary of arrays: dates,
+    # yes given (out degree), yes received (in degree), mutual yes,
+    # matches, selectivity (yes given per date), desirability (yes
+    # received per date) and reciprocity (the share of their yes answers
+    # that were returned)
+
+    def participant_stats(self):
+        dates = np.asarray(self.met.sum(axis=1)).ravel()
+        yes_given = np.asarray(self.decisions.sum(axis=1)).ravel()
+        yes_received = np.asarray(self.decisions.sum(axis=0)).ravel()
+        mutual = np.asarray(self.mutual().sum(axis=1)).ravel()
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return {
+                'iid': self.iid,
+                'dates': dates,
+                'yes_given': yes_given,
+                'yes_received': yes_received,
+                'mutual': mutual,
+                'matches': np.asarray(self.matches.sum(axis=1)).ravel(),
+                'selectivity': yes_given / dates,
+                'desirability': yes_received / dates,
+                'reciprocity': mutual / yes_given
+            }
+
+    # Returns the graph-wide statistics: the number of dates (pairs), yes
+    # answers and mutual pairs, the reciprocity (the share of yes answers
+    # that were returned), the share of yes answers expected to be returned
+    # if decisions were independent, and the number of match flags that
+    # disagree with the two decisions (0 for consistent data)
+
+    def summary(self):
+        pairs = self.met.nnz // 2
+        yes = self.decisions.nnz
+        mutual = self.mutual()
+        yes_rate = yes / self.met.nnz if self.met.nnz else np.nan
+
+        return {
+            'pairs': pairs,
+            'yes': yes,
+            'mutual_pairs': mutual.nnz // 2,
+            'reciprocity': mutual.nnz / yes if yes else np.nan,
+            'independent_reciprocity': yes_rate,
+            'inconsistent_matches': (self.matches != mutual).nnz
+        }
+
+
+# Compares the per-participant mutual yes counts and reciprocity computed
+# with a self-join of the dates table against the match graph
+
+# Parameters:
+#   - database_path (str): the path to your database
+#   - graph (MatchGraph): the graph (built from the database if None)
+#   - repeats (int): the number of timed runs of each
+
+# Returns a dictionary of {self_join_seconds, graph_seconds, identical}
+
+def compare_reciprocity(database_path : str, graph : MatchGraph = None, repeats : int = 5):
+    query = '''
+        SELECT b.pid AS iid, SUM(b.dec_o) AS yes_given, SUM(a.dec_o * b.dec_o) AS mutual
+        FROM dates AS a
+        JOIN dates AS b ON b.iid = a.pid AND b.pid = a.iid
+        GROUP BY b.pid
+        ORDER BY b.pid
+    '''
+    pool = shared_pool(database_path)
+
+    start = time.perf_counter()
+    for _ in range(repeats):
+        joined = pool.fetch_columns(query)
+    self_join_seconds = (time.perf_counter() - start) / repeats
+
+    graph = graph or MatchGraph.from_database(database_path)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        stats = graph.participant_stats()
+    graph_seconds = (time.perf_counter() - start) / repeats
+
+    rows = np.searchsorted(stats['iid'], joined['iid'].astype(np.int64))
+
+    return {
+        'self_join_seconds': round(self_join_seconds, 6),
+        'graph_seconds': round(graph_seconds, 6),
+        'identical': bool(np.array_equal(stats['mutual'][rows], joined['mutual'])
+                          and np.array_equal(stats['yes_given'][rows], joined['yes_given']))
+    }
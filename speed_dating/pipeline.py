@@ -0,0 +1,376 @@
+import json
+import os
+import time
+
+from speed_dating.fingerprint import file_fingerprint, table_fingerprint, value_fingerprint
+from speed_dating.imputation import select_n_neighbors
+from speed_dating.ingest import create_db_streaming
+from speed_dating.pairs import build_pairs
+from speed_dating.preprocessing import fetch_cleaned_rows, preprocess
+from speed_dating.schema import build_schema
+from speed_dating.snapshot import write_snapshot
+from speed_dating.summaries import SUMMARY_TABLES, build_summaries
+from speed_dating.tracing import connect, span
+
+# Tables holding the state of the pipeline between runs
+STATE_TABLES = '''
+    CREATE TABLE IF NOT EXISTS pipeline_stages(
+        stage TEXT PRIMARY KEY,
+        key TEXT NOT NULL,
+        result TEXT,
+        outputs TEXT NOT NULL,
+        seconds REAL
+    );
+    CREATE TABLE IF NOT EXISTS pipeline_tables(
+        name TEXT PRIMARY KEY,
+        fingerprint TEXT NOT NULL,
+        writer TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS pipeline_files(
+        path TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        mtime_ns INTEGER NOT NULL,
+        fingerprint TEXT NOT NULL
+    );
+'''
+
+
+# A step of the pipeline with the tables and files it reads, the tables it
+# writes and its parameters. A stage may rewrite a table it reads (in place).
+
+# Parameters:
+#   - name (str): the name of the stage
+#   - run (function): called with (params, results) where results holds the
+#                     results of the stages in after. Its return value must
+#                     be JSON-serialisable.
+#   - reads (tuple): the tables the stage reads
+#   - writes (tuple): the tables the stage creates or changes
+#   - files (tuple): the files the stage reads
+#   - params (dict): the parameters of the stage
+#   - after (tuple): the stages whose results the stage uses
+#   - creates (tuple): the files the stage creates (the stage reruns if
+#                      any of them is missing)
+
+class Stage:
+
+    def __init__(self, name : str, run, reads : tuple = (), writes : tuple = (),
+                 files : tuple = (), params : dict = None, after : tuple = (),
+                 creates : tuple = ()):
+        self.name = name
+        self.run = run
+        self.reads = tuple(reads)
+        self.writes = tuple(writes)
+        self.files = tuple(files)
+        self.params = params or {}
+        self.after = tuple(after)
+        self.creates = tuple(creates)
+
+
+# Runs a DAG of stages against one database, skipping every stage whose
+# inputs are unchanged since it last ran.
+# A stage's key is a hash of its parameters, the fingerprints of the files
+# it reads, the fingerprints its upstream stages recorded for the tables it
+# reads and the results it uses. A stage only runs when its key changes or
+# a table it wrote has since been rebuilt by an earlier stage. If a stage
+# needs a table that a later stage has changed in place, the stages that
+# wrote the table are rerun first. A rerun that produces the same table
+# leaves the downstream keys unchanged, so they are still skipped.
+
+# Parameters:
+#   - database_path (str): the path to your database
+#   - stages (list): the stages in dependency order
+
+class Pipeline:
+
+    def __init__(self, database_path : str, stages : list):
+        self.database_path = database_path
+        self.stages = list(stages)
+        self.order = {stage.name: i for i, stage in enumerate(self.stages)}
+
+        # Every table and result must come from an earlier stage
+        for i, stage in enumerate(self.stages):
+            for dependency in stage.after:
+                if self.order.get(dependency, i) >= i:
+                    raise ValueError(f'{stage.name} uses {dependency} which does not run before it')
+
+    # Returns the last stage before a stage that writes a table
+    # (None if the table is not written by the pipeline)
+
+    # Parameters:
+    #   - table (str): the name of the table
+    #   - before (int): the position of the reading stage
+
+    def _producer(self, table : str, before : int):
+        for stage in reversed(self.stages[:before]):
+            if table in stage.writes:
+                return stage.name
+        return None
+
+    # Returns the fingerprint of a file, only rehashing it when its size or
+    # modification time has changed
+
+    # Parameters:
+    #   - path (str): the path of the file
+
+    def _file_fingerprint(self, path : str):
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+
+        cached = self.conn.execute('SELECT size, mtime_ns, fingerprint FROM pipeline_files '
+                                   'WHERE path = ?', (path,)).fetchone()
+        if cached is not None and cached[:2] == (stat.st_size, stat.st_mtime_ns):
+            return cached[2]
+
+        fingerprint = file_fingerprint(path)
+        self.conn.execute('INSERT OR REPLACE INTO pipeline_files VALUES (?, ?, ?, ?)',
+                          (path, stat.st_size, stat.st_mtime_ns, fingerprint))
+
+        # Commit straight away so the stages can write to the database
+        self.conn.commit()
+
+        return fingerprint
+
+    # Returns the key of a stage from the current records of its inputs
+
+    # Parameters:
+    #   - stage (Stage): the stage
+
+    def _key(self, stage : Stage):
+        position = self.order[stage.name]
+        tables = {}
+
+        for table in stage.reads:
+            producer = self._producer(table, position)
+            if producer is None:
+                tables[table] = table_fingerprint(self.conn, table)
+            else:
+                tables[table] = self.records.get(producer, {}).get('outputs', {}).get(table)
+
+        return value_fingerprint({
+            'stage': stage.name,
+            'params': stage.params,
+            'files': {path: self._file_fingerprint(path) for path in stage.files},
+            'tables': tables,
+            'results': {name: self.records.get(name, {}).get('result') for name in stage.after}
+        })
+
+    # Returns whether a stage's stored output is still current
+
+    # Parameters:
+    #   - stage (Stage): the stage
+    #   - key (str): the stage's key for this run
+
+    def _is_current(self, stage : Stage, key : str):
+        record = self.records.get(stage.name)
+        if record is None or record['key'] != key:
+            return False
+
+        # Each table it writes must still hold its output or have been
+        # changed by a later stage
+        for table in stage.writes:
+            writer = self.tables.get(table, (None, None))[1]
+            if writer is None or self.order.get(writer, -1) < self.order[stage.name]:
+                return False
+
+        # Each file it creates must still exist
+        if not all(os.path.exists(path) for path in stage.creates):
+            return False
+
+        return True
+
+    # Rebuilds a table as a stage expects to read it by rerunning the stages
+    # that write it up to its producer
+
+    # Parameters:
+    #   - table (str): the name of the table
+    #   - producer (str): the stage whose output is expected
+
+    def _restore(self, table : str, producer : str):
+        writers = [stage for stage in self.stages[:self.order[producer] + 1]
+                   if table in stage.writes]
+        for stage in writers:
+            self._execute(stage, 'restored')
+
+    # Runs a stage, first restoring any table it reads that a later stage
+    # has changed in place, and records its key, result and outputs
+
+    # Parameters:
+    #   - stage (Stage): the stage
+    #   - status (str): the status reported for the stage
+
+    def _execute(self, stage : Stage, status : str):
+        position = self.order[stage.name]
+
+        for table in stage.reads:
+            producer = self._producer(table, position)
+            writer = self.tables.get(table, (None, None))[1]
+            if producer is not None and writer != producer:
+                self._restore(table, producer)
+
+        key = self._key(stage)
+        results = {name: self.records[name]['result'] for name in stage.after}
+
+        start = time.perf_counter()
+        with span(stage.name, category='pipeline', status=status):
+            result = stage.run(stage.params, results)
+        seconds = time.perf_counter() - start
+
+        # Keep the result as it will be read back by the next run
+        result = json.loads(json.dumps(result, default=str))
+
+        # Record the new contents of each table written
+        outputs = {}
+        for table in stage.writes:
+            outputs[table] = table_fingerprint(self.conn, table)
+            self.tables[table] = (outputs[table], stage.name)
+            self.conn.execute('INSERT OR REPLACE INTO pipeline_tables VALUES (?, ?, ?)',
+                              (table, outputs[table], stage.name))
+
+        self.records[stage.name] = {'key': key, 'result': result, 'outputs': outputs}
+        self.conn.execute('INSERT OR REPLACE INTO pipeline_stages VALUES (?, ?, ?, ?, ?)',
+                          (stage.name, key, json.dumps(result), json.dumps(outputs), seconds))
+        self.conn.commit()
+
+        self.report.append({'stage': stage.name, 'status': status, 'seconds': round(seconds, 4)})
+
+    # Runs every stage whose inputs have changed and skips the rest
+
+    # Parameters:
+    #   - force (tuple): the names of stages to run even if unchanged
+    #   - verify (bool): whether to rehash the tables written by the pipeline
+    #                    to catch changes made outside it (e.g. by running a
+    #                    notebook cell), which costs a read of each table
+
+    # Returns a list of {stage, status, seconds} where status is 'ran',
+    # 'restored' (rerun to rebuild a table) or 'skipped'
+
+    def run(self, force : tuple = (), verify : bool = True):
+        # Connect to database
+        self.conn = connect(self.database_path)
+        self.conn.executescript(STATE_TABLES)
+
+        self.records = {
+            stage: {'key': key, 'result': json.loads(result), 'outputs': json.loads(outputs)}
+            for stage, key, result, outputs in self.conn.execute(
+                'SELECT stage, key, result, outputs FROM pipeline_stages')
+        }
+        self.tables = {
+            name: (fingerprint, writer)
+            for name, fingerprint, writer in self.conn.execute(
+                'SELECT name, fingerprint, writer FROM pipeline_tables')
+        }
+        self.report = []
+
+        # Forget the writer of any table changed outside the pipeline so the
+        # stages that write it are rerun
+        if verify:
+            for name, (fingerprint, _) in list(self.tables.items()):
+                if table_fingerprint(self.conn, name) != fingerprint:
+                    del self.tables[name]
+
+        try:
+            for stage in self.stages:
+                start = time.perf_counter()
+                key = self._key(stage)
+
+                if stage.name not in force and self._is_current(stage, key):
+                    self.report.append({'stage': stage.name, 'status': 'skipped',
+                                        'seconds': round(time.perf_counter() - start, 4)})
+                else:
+                    self._execute(stage, 'ran')
+        finally:
+            # Close the connection
+            self.conn.close()
+
+        for stage in self.report:
+            print(f"{stage['stage']}: {stage['status']} in {stage['seconds']} seconds.")
+
+        return self.report
+
+    # Returns the stored result of a stage
+
+    # Parameters:
+    #   - name (str): the name of the stage
+
+    def result(self, name : str):
+        return self.records[name]['result']
+
+
+# Returns the notebook's data preparation as a pipeline: .csv to .db,
+# choosing the number of neighbours, pre-processing, table creation, the
+# pairs table, the summary tables and (optionally) a columnar snapshot of
+# the tables
+
+# Parameters:
+#   - csv_file (str): the name of the .csv
+#   - database_path (str): the path of the .db
+#   - csv_columns (list): the columns to include from the original database
+#   - columns_o (list): list of attributes ending in _o (ratings received)
+#   - columns_3_1 (list): list of attributes ending in 3_1 (self ratings given)
+#   - columns_pf_o (list): list of attributes in the form
+#                          pf_o_{attribute} (attribute preferences)
+#   - null_no (int): the threshold number of NULL values for row deletion
+#   - encoding_type (str): the encoding of the csv
+#   - snapshot_dir (str): the directory of the snapshot (None to skip it)
+#   - n_jobs (int): the processes scoring the imputation folds (None uses
+#                   every core, the choice does not change the result)
+
+def notebook_pipeline(csv_file : str, database_path : str, csv_columns : list, columns_o : list,
+                      columns_3_1 : list, columns_pf_o : list, null_no : int = 3,
+                      encoding_type : str = 'latin', snapshot_dir : str = None,
+                      n_jobs : int = None):
+
+    def create_db(params, results):
+        return create_db_streaming(csv_file, params['encoding_type'], database_path,
+                                   params['csv_columns'])
+
+    def choose_n_neighbors(params, results):
+        # Cross-validated on the rows preprocess keeps as donors
+        donors = fetch_cleaned_rows(database_path, params['columns_o'], params['columns_3_1'],
+                                    params['columns_pf_o'], params['null_no'],
+                                    params['columns_o'])
+        n_neighbors, rmse = select_n_neighbors(donors, n_jobs=n_jobs)
+        return {'n_neighbors': n_neighbors, 'rmse': rmse}
+
+    def clean(params, results):
+        return preprocess(database_path, params['columns_o'], params['columns_3_1'],
+                          params['columns_pf_o'], params['null_no'], params['columns_o'],
+                          results['select_n_neighbors']['n_neighbors'])
+
+    def create_tables(params, results):
+        return build_schema(database_path, params['columns_o'], params['columns_3_1'],
+                            params['columns_pf_o'])
+
+    def create_pairs(params, results):
+        return build_pairs(database_path, params['columns_o'])
+
+    def create_summaries(params, results):
+        return build_summaries(database_path, params['columns_o'])
+
+    def snapshot(params, results):
+        manifest = write_snapshot(database_path, params['snapshot_dir'])
+        return {table: details['rows'] for table, details in manifest['tables'].items()}
+
+    columns = {'columns_o': columns_o, 'columns_3_1': columns_3_1, 'columns_pf_o': columns_pf_o}
+
+    stages = [
+        Stage('create_db', create_db, writes=('speed_dating',), files=(csv_file,),
+              params={'csv_columns': csv_columns, 'encoding_type': encoding_type}),
+        Stage('select_n_neighbors', choose_n_neighbors, reads=('speed_dating',),
+              params={**columns, 'null_no': null_no}),
+        Stage('preprocess', clean, reads=('speed_dating',), writes=('speed_dating',),
+              params={**columns, 'null_no': null_no}, after=('select_n_neighbors',)),
+        Stage('build_schema', create_tables, reads=('speed_dating',),
+              writes=('participants', 'dates'), params=columns),
+        Stage('build_pairs', create_pairs, reads=('dates',), writes=('pairs',),
+              params={'columns_o': columns_o}),
+        Stage('build_summaries', create_summaries, reads=('participants', 'dates'),
+              writes=SUMMARY_TABLES, params={'columns_o': columns_o})
+    ]
+
+    if snapshot_dir is not None:
+        stages.append(Stage('write_snapshot', snapshot, reads=('participants', 'dates'),
+                            params={'snapshot_dir': snapshot_dir},
+                            creates=(os.path.join(snapshot_dir, 'manifest.json'),)))
+
+    return Pipeline(database_path, stages)
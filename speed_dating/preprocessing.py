@@ -0,0 +1,185 @@
+import time
+
+import numpy as np
+
+from speed_dating.imputation import impute_null_values
+from speed_dating.tracing import connect, span
+
+
+# Builds the condition matching rows with a specified number of NULL values
+# in any of the attribute sets
+
+# Parameters:
+#   - column_sets (list): the lists of columns (e.g. columns_o, columns_3_1 and
+#                         columns_pf_o) to check for NULL values
+#   - null_no (int): the threshold number of NULL values for row deletion
+#   - table (str): the name or alias of the table the columns belong to
+
+# Returns the condition and its parameters
+
+def null_values_condition(column_sets : list, null_no : int, table : str = 'speed_dating'):
+    # Each (column IS NULL) evaluates to 1 so the sum is the number of
+    # NULL values in that set
+    conditions = [
+        f"(({' + '.join(f'({table}.{column} IS NULL)' for column in columns)}) >= ?)"
+        for columns in column_sets
+    ]
+
+    return f"({' OR '.join(conditions)})", [null_no] * len(column_sets)
+
+
+# Builds the DELETE query for rows with a specified number of NULL values in
+# any of the attribute sets
+
+# Parameters:
+#   - column_sets (list): the lists of columns (e.g. columns_o, columns_3_1 and
+#                         columns_pf_o) to check for NULL values
+#   - null_no (int): the threshold number of NULL values for row deletion
+#   - after_rowid (int): only checks the rows after this rowid (None checks
+#                        every row)
+
+def null_values_query(column_sets : list, null_no : int, after_rowid : int = None):
+    condition, parameters = null_values_condition(column_sets, null_no)
+
+    if after_rowid is not None:
+        delete_query = f"DELETE FROM speed_dating WHERE rowid > ? AND {condition}"
+        return delete_query, [after_rowid] + parameters
+
+    delete_query = f"DELETE FROM speed_dating WHERE {condition}"
+
+    return delete_query, parameters
+
+
+# Deletes rows that are missing their corresponding (pid, iid) row.
+# The composite (iid, pid) index turns the anti-join into one index probe
+# per row instead of a scan of the table per row.
+
+# Parameters:
+#   - cursor (sqlite3.Cursor): a cursor with an open transaction
+#   - after_rowid (int): only checks the rows after this rowid
+
+def delete_missing_pairs_indexed(cursor, after_rowid : int = 0):
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_iid_pid ON speed_dating (iid, pid)')
+
+    cursor.execute('''
+        DELETE FROM speed_dating
+        WHERE rowid IN (
+            SELECT s1.rowid
+            FROM speed_dating AS s1
+            LEFT JOIN speed_dating AS s2 ON s2.iid = s1.pid AND s2.pid = s1.iid
+            WHERE s1.rowid > ? AND s2.iid IS NULL)
+    ''', (after_rowid,))
+
+    return cursor.rowcount
+
+
+# Returns the rows of speed_dating that are complete in the columns to impute
+# and kept by the cleaning rules of preprocess (not deleted for their NULL
+# values and with their pair also kept), without changing the table.
+# These are the donors preprocess imputes from, so the number of
+# neighbours is cross-validated on them.
+
+# Parameters:
+#   - database_path (str): the path to the SQLite database.
+#   - columns_o (list): list of attributes ending in _o (ratings received).
+#   - columns_3_1 (list): list of attributes ending in 3_1 (self ratings given).
+#   - columns_pf_o (list): list of attributes in the form
+#                          pf_o_{attribute} (attribute preferences).
+#   - null_no (int): the threshold number of NULL values for row deletion.
+#   - columns_to_impute (list): the set of columns to perform data imputation on
+
+# Returns a 2D array with one row per donor
+
+def fetch_cleaned_rows(database_path : str, columns_o : list, columns_3_1 : list,
+                       columns_pf_o : list, null_no : int, columns_to_impute : list):
+    column_sets = [columns_o, columns_3_1, columns_pf_o]
+    deleted, parameters = null_values_condition(column_sets, null_no, 's1')
+    pair_deleted, pair_parameters = null_values_condition(column_sets, null_no, 's2')
+
+    # Connect to database
+    conn = connect(database_path)
+
+    rows = conn.execute(f'''
+        SELECT {', '.join(f's1.{column}' for column in columns_to_impute)}
+        FROM speed_dating AS s1
+        WHERE {' AND '.join(f's1.{column} IS NOT NULL' for column in columns_to_impute)}
+            AND NOT {deleted}
+            AND EXISTS (
+                SELECT 1
+                FROM speed_dating AS s2
+                WHERE s2.iid = s1.pid AND s2.pid = s1.iid AND NOT {pair_deleted})
+    ''', parameters + pair_parameters).fetchall()
+
+    # Close the connection
+    conn.close()
+
+    return np.array(rows, dtype=float).reshape(-1, len(columns_to_impute))
+
+
+# Runs every cleaning rule on one connection in one transaction:
+# deleting rows with several NULL values, deleting missing pairs and
+# imputing the remaining NULL values.
+
+# Parameters:
+#   - database_path (str): the path to the SQLite database.
+#   - columns_o (list): list of attributes ending in _o (ratings received).
+#   - columns_3_1 (list): list of attributes ending in 3_1 (self ratings given).
+#   - columns_pf_o (list): list of attributes in the form
+#                          pf_o_{attribute} (attribute preferences).
+#   - null_no (int): the threshold number of NULL values for row deletion.
+#   - columns_to_impute (list): the set of columns to perform data imputation on
+#   - n_neighbors (int): the number of neighbours used for each imputation
+
+# Returns a list with the name, seconds taken and rows affected of each stage
+
+def preprocess(database_path : str, columns_o : list, columns_3_1 : list,
+               columns_pf_o : list, null_no : int, columns_to_impute : list,
+               n_neighbors : int = 5):
+    # Connect to database
+    conn = connect(database_path)
+
+    # Create a cursor object
+    cursor = conn.cursor()
+
+    report = []
+
+    # Times a stage and records how many rows it affected
+    def run_stage(name, stage, *args):
+        stage_start = time.perf_counter()
+        with span(name) as stage_span:
+            rows = stage(*args)
+            stage_span.set(rows_out=rows if isinstance(rows, int) else None)
+        report.append({
+            'stage': name,
+            'seconds': round(time.perf_counter() - stage_start, 4),
+            'rows': rows
+        })
+
+    # Deletes rows with too many NULL values in any attribute set
+    def delete_null_rows():
+        delete_query, parameters = null_values_query(
+            [columns_o, columns_3_1, columns_pf_o], null_no)
+        cursor.execute(delete_query, parameters)
+        return cursor.rowcount
+
+    try:
+        cursor.execute('BEGIN')
+
+        run_stage('delete_null_values', delete_null_rows)
+        run_stage('delete_missing_pairs', delete_missing_pairs_indexed, cursor)
+        run_stage('data_imputation',
+                  lambda: impute_null_values(cursor, columns_to_impute, n_neighbors)[0])
+
+        # Commit the changes
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        # Close the connection
+        conn.close()
+
+    for stage in report:
+        print(f"{stage['stage']}: {stage['rows']} rows in {stage['seconds']} seconds.")
+
+    return report
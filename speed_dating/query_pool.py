@@ -0,0 +1,213 @@
+import os
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from urllib.parse import quote
+
+from speed_dating.analysis_store import load_columns
+from speed_dating.tracing import TRACER, span, trace_connection
+
+# The pools shared by the notebook's fetch functions, one per database
+SHARED_POOLS = {}
+SHARED_POOLS_LOCK = threading.Lock()
+
+
+# Switches a database to write-ahead logging so readers never block on (or
+# block) a writer. The journal mode is stored in the database file, so a
+# later rebuild of the .db keeps it (create_db_streaming then skips its
+# exclusive bulk load pragmas).
+
+# Parameters:
+#   - database_path (str): the path to your database
+
+# Returns the journal mode in use
+
+def enable_wal(database_path : str):
+    # Connect to database
+    conn = sqlite3.connect(database_path)
+
+    journal_mode = conn.execute('PRAGMA journal_mode = WAL').fetchone()[0]
+
+    # Close the connection
+    conn.close()
+
+    return journal_mode
+
+
+# A fixed pool of read-only connections to one database.
+# Each connection is opened with mode=ro and query_only so it can never
+# write, and no transaction is left open after a query so nothing needs to
+# be committed. sqlite3 keeps the prepared statements of each connection
+# in a cache keyed by the SQL text, so a query that is reused (with bound
+# parameters rather than formatted values) is only compiled once per
+# connection. SQLite releases the GIL while it steps through a query so
+# queries on different connections run concurrently in threads.
+
+# Parameters:
+#   - database_path (str): the path to your database
+#   - size (int): the number of connections
+#   - cached_statements (int): the prepared statements kept per connection
+
+class QueryPool:
+
+    def __init__(self, database_path : str, size : int = 4, cached_statements : int = 128):
+        self.database_path = database_path
+        self.size = size
+        self.journal_mode = enable_wal(database_path)
+
+        uri = f'file:{quote(os.path.abspath(database_path))}?mode=ro'
+        self.connections = queue.LifoQueue()
+
+        for _ in range(size):
+            conn = sqlite3.connect(uri, uri=True, check_same_thread=False,
+                                   cached_statements=cached_statements)
+            conn.execute('PRAGMA query_only = ON')
+            self.connections.put(conn)
+
+    # Borrows a connection for the duration of a with block, waiting for one
+    # to be returned if they are all in use. Its statements are traced while
+    # tracing is enabled.
+
+    @contextmanager
+    def connection(self):
+        conn = self.connections.get()
+        if TRACER.enabled:
+            trace_connection(conn)
+        try:
+            yield conn
+        finally:
+            self.connections.put(conn)
+
+    # Returns the rows of a query
+
+    # Parameters:
+    #   - query (str): the SELECT query
+    #   - params (tuple): the values bound to the query's placeholders
+
+    def fetch(self, query : str, params : tuple = ()):
+        with self.connection() as conn:
+            return conn.execute(query, params).fetchall()
+
+    # Returns the result of a query as a dictionary of NumPy arrays, one per
+    # column (NULL values become NaN)
+
+    # Parameters:
+    #   - query (str): the SELECT query
+    #   - params (tuple): the values bound to the query's placeholders
+
+    def fetch_columns(self, query : str, params : tuple = ()):
+        with self.connection() as conn:
+            return load_columns(conn, query, params)
+
+    # Runs queries concurrently, one per connection at a time
+
+    # Parameters:
+    #   - queries (dict): name to SELECT query or (query, params)
+
+    # Returns a dictionary of name to {column: array}
+
+    def fetch_all(self, queries : dict):
+        calls = {}
+        for name, query in queries.items():
+            query, params = (query, ()) if isinstance(query, str) else query
+            calls[name] = (self.fetch_columns, (query, params))
+
+        results, _ = run_concurrently(calls, self.size)
+
+        return results
+
+    # Closes every connection in the pool
+
+    def close(self):
+        while not self.connections.empty():
+            self.connections.get().close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# Returns the shared pool of a database, creating it on first use
+
+# Parameters:
+#   - database_path (str): the path to your database
+#   - size (int): the number of connections if the pool is created
+
+def shared_pool(database_path : str, size : int = 4):
+    key = os.path.abspath(database_path)
+
+    with SHARED_POOLS_LOCK:
+        if key not in SHARED_POOLS:
+            SHARED_POOLS[key] = QueryPool(database_path, size)
+
+        return SHARED_POOLS[key]
+
+
+# Closes the shared pools (e.g. before the database file is replaced)
+
+def close_shared_pools():
+    with SHARED_POOLS_LOCK:
+        for pool in SHARED_POOLS.values():
+            pool.close()
+        SHARED_POOLS.clear()
+
+
+# Runs independent calls concurrently in a thread pool
+
+# Parameters:
+#   - calls (dict): name to (function, args) or (function, args, kwargs)
+#   - max_workers (int): the number of threads (None for one per call)
+
+# Returns a dictionary of name to result and a dictionary of name to the
+# seconds each call took
+
+def run_concurrently(calls : dict, max_workers : int = None):
+
+    def timed_call(name, function, args = (), kwargs = None):
+        start = time.perf_counter()
+        with span(name, category='call'):
+            result = function(*args, **(kwargs or {}))
+        return result, time.perf_counter() - start
+
+    with ThreadPoolExecutor(max_workers=max_workers or max(len(calls), 1)) as executor:
+        futures = {name: executor.submit(timed_call, name, *call) for name, call in calls.items()}
+
+        results, seconds = {}, {}
+        for name, future in futures.items():
+            results[name], seconds[name] = future.result()
+
+    return results, {name: round(value, 4) for name, value in seconds.items()}
+
+
+# Fetches the data of several figures one after another and then
+# concurrently, and compares the wall-clock times
+
+# Parameters:
+#   - calls (dict): name to (function, args) or (function, args, kwargs)
+#   - max_workers (int): the number of threads (None for one per call)
+
+# Returns the concurrent results and a report of
+# {sequential_seconds, concurrent_seconds, longest_call_seconds, calls}
+
+def compare_concurrency(calls : dict, max_workers : int = None):
+    start = time.perf_counter()
+    _, sequential = run_concurrently(calls, max_workers=1)
+    sequential_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    results, concurrent = run_concurrently(calls, max_workers)
+    concurrent_seconds = time.perf_counter() - start
+
+    report = {
+        'sequential_seconds': round(sequential_seconds, 4),
+        'concurrent_seconds': round(concurrent_seconds, 4),
+        'longest_call_seconds': max(sequential.values(), default=0),
+        'calls': sequential
+    }
+
+    return results, report
@@ -0,0 +1,356 @@
+import time
+
+import numpy as np
+import plotly.graph_objects as go
+
+# Scatter traces with more points than this are drawn with WebGL
+WEBGL_THRESHOLD = 5000
+
+# Scatter traces with more points than this are binned (markers) or
+# downsampled with LTTB (lines) when the render mode is 'auto'
+AGGREGATE_THRESHOLD = 100_000
+
+# The render modes of scatter_trace
+RENDER_MODES = ('auto', 'svg', 'webgl', 'hexbin', 'rectbin', 'lttb')
+
+
+# Downsamples a series with Largest Triangle Three Buckets. The first and
+# last points are kept and every bucket in between keeps the point forming
+# the largest triangle with the point kept before it and the average of
+# the next bucket, so peaks and troughs survive.
+
+# Parameters:
+#   - x (array): the x values
+#   - y (array): the y values
+#   - n_out (int): the number of points to keep
+
+# Returns the kept x and y values ordered by x
+
+def lttb(x, y, n_out : int):
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+
+    order = np.argsort(x, kind='stable')
+    x, y = x[order], y[order]
+
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return x, y
+
+    # bounds[i]:bounds[i + 1] is bucket i, the last bucket ends before n - 1
+    every = (n - 2) / (n_out - 2)
+    bounds = np.floor(np.arange(n_out - 1) * every).astype(np.int64) + 1
+
+    selected = np.empty(n_out, dtype=np.int64)
+    selected[0], selected[-1] = 0, n - 1
+    a = 0
+
+    for i in range(n_out - 2):
+        start, end = bounds[i], bounds[i + 1]
+
+        if i + 2 < len(bounds):
+            next_x = x[bounds[i + 1]:bounds[i + 2]].mean()
+            next_y = y[bounds[i + 1]:bounds[i + 2]].mean()
+        else:
+            next_x, next_y = x[n - 1], y[n - 1]
+
+        # Twice the area of the triangle for each candidate point
+        area = np.abs((x[a] - next_x) * (y[start:end] - y[a])
+                      - (x[a] - x[start:end]) * (next_y - y[a]))
+        a = start + int(np.argmax(area))
+        selected[i + 1] = a
+
+    return x[selected], y[selected]
+
+
+# Counts points in a hexagonal grid. Each point goes to the nearer centre of
+# two offset rectangular lattices, which tiles the plane with hexagons.
+
+# Parameters:
+#   - x (array): the x values
+#   - y (array): the y values
+#   - gridsize (int): the number of hexagons across the x range
+
+# Returns the x and y centre and count of every non-empty hexagon
+
+def hex_bins(x, y, gridsize : int = 50):
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+
+    nx = gridsize
+    ny = max(int(gridsize / np.sqrt(3)), 1)
+    x_min, y_min = x.min(), y.min()
+    sx = (x.max() - x_min) / nx or 1.0
+    sy = (y.max() - y_min) / ny or 1.0
+
+    x_scaled = (x - x_min) / sx
+    y_scaled = (y - y_min) / sy
+
+    ix1, iy1 = np.round(x_scaled), np.round(y_scaled)
+    ix2, iy2 = np.floor(x_scaled), np.floor(y_scaled)
+    d1 = (x_scaled - ix1) ** 2 + 3.0 * (y_scaled - iy1) ** 2
+    d2 = (x_scaled - ix2 - 0.5) ** 2 + 3.0 * (y_scaled - iy2 - 0.5) ** 2
+    first = d1 < d2
+
+    # Centres in lattice units (the second lattice is offset by half a cell)
+    cx = np.where(first, ix1, ix2 + 0.5)
+    cy = np.where(first, iy1, iy2 + 0.5)
+
+    centres, counts = np.unique(np.column_stack([cx, cy]), axis=0, return_counts=True)
+
+    return x_min + centres[:, 0] * sx, y_min + centres[:, 1] * sy, counts
+
+
+# Counts points in a rectangular grid
+
+# Parameters:
+#   - x (array): the x values
+#   - y (array): the y values
+#   - bins (int): the number of bins along each axis
+
+# Returns the x and y centre and count of every non-empty bin
+
+def rect_bins(x, y, bins : int = 50):
+    counts, x_edges, y_edges = np.histogram2d(np.asarray(x, dtype=float),
+                                              np.asarray(y, dtype=float), bins=bins)
+    ix, iy = np.nonzero(counts)
+
+    x_centres = (x_edges[:-1] + x_edges[1:]) / 2
+    y_centres = (y_edges[:-1] + y_edges[1:]) / 2
+
+    return x_centres[ix], y_centres[iy], counts[ix, iy].astype(np.int64)
+
+
+# Returns the render mode used for a number of points
+
+# Parameters:
+#   - points (int): the number of points in the trace
+#   - lines (bool): whether the trace is drawn as a line
+#   - render_mode (str): one of RENDER_MODES
+
+def resolve_render_mode(points : int, lines : bool, render_mode : str = 'auto'):
+    if render_mode not in RENDER_MODES:
+        raise ValueError(f'render_mode must be one of {RENDER_MODES}')
+
+    if render_mode != 'auto':
+        return render_mode
+    if points > AGGREGATE_THRESHOLD:
+        return 'lttb' if lines else 'hexbin'
+    if points > WEBGL_THRESHOLD:
+        return 'webgl'
+    return 'svg'
+
+
+# Returns the asymmetric error bars of a series from confidence intervals,
+# matching each point to the interval of its x value (points without an
+# interval get no bar)
+
+# Parameters:
+#   - x_data (list): the x values
+#   - y_data (list): the y values
+#   - intervals (dict): arrays of group, low and high
+
+def error_bars(x_data, y_data, intervals : dict):
+    x = np.asarray(x_data, dtype=float)
+    y = np.asarray(y_data, dtype=float)
+    groups = np.asarray(intervals['group'], dtype=float)
+
+    position = np.clip(np.searchsorted(groups, x), 0, max(len(groups) - 1, 0))
+    matched = (groups[position] == x) if len(groups) else np.zeros(len(x), dtype=bool)
+
+    above = np.where(matched, np.asarray(intervals['high'])[position] - y, np.nan)
+    below = np.where(matched, y - np.asarray(intervals['low'])[position], np.nan)
+
+    return dict(type='data', symmetric=False, array=np.maximum(above, 0),
+                arrayminus=np.maximum(below, 0), thickness=1)
+
+
+# Returns the trace of one scatter series, switching to WebGL, binning or
+# LTTB downsampling as the number of points grows
+
+# Parameters:
+#   - x_data (list): the x values
+#   - y_data (list): the y values
+#   - name (str): the name of the trace
+#   - color (str): the marker colour
+#   - line_plot (bool): whether to draw lines and markers
+#   - render_mode (str): one of RENDER_MODES ('auto' picks one by size)
+#   - max_points (int): the points kept by 'lttb' and the grid size of the
+#                       binned modes is derived from it
+#   - intervals (dict): confidence intervals with group, low and high arrays
+#                       (see bootstrap.grouped_intervals) drawn as error bars
+#                       on the points whose x value is a group (svg and webgl
+#                       only)
+
+def scatter_trace(x_data, y_data, name : str, color : str, line_plot : bool = False,
+                  render_mode : str = 'auto', max_points : int = 2000, intervals : dict = None):
+    mode = 'lines+markers' if line_plot else 'markers'
+    render_mode = resolve_render_mode(len(x_data), line_plot, render_mode)
+    error_y = error_bars(x_data, y_data, intervals) if intervals is not None else None
+
+    if render_mode == 'svg':
+        return go.Scatter(x=x_data, y=y_data, mode=mode, name=name, marker_color=color,
+                          error_y=error_y)
+
+    if render_mode == 'webgl':
+        return go.Scattergl(x=x_data, y=y_data, mode=mode, name=name, marker_color=color,
+                            error_y=error_y)
+
+    if render_mode == 'lttb':
+        x_kept, y_kept = lttb(x_data, y_data, max_points)
+        return go.Scattergl(x=x_kept, y=y_kept, mode=mode, name=f'{name} (LTTB)',
+                            marker_color=color)
+
+    # Binned modes draw one marker per bin sized by its count
+    gridsize = max(int(np.sqrt(max_points)), 1)
+    if render_mode == 'hexbin':
+        x_centres, y_centres, counts = hex_bins(x_data, y_data, gridsize)
+        symbol = 'hexagon'
+    else:
+        x_centres, y_centres, counts = rect_bins(x_data, y_data, gridsize)
+        symbol = 'square'
+
+    sizes = 4 + 16 * np.sqrt(counts / counts.max())
+
+    return go.Scattergl(x=x_centres, y=y_centres, mode='markers', name=f'{name} (binned)',
+                        marker=dict(color=color, size=sizes, symbol=symbol, opacity=0.7),
+                        customdata=counts, hovertemplate='%{x}, %{y}: %{customdata} points')
+
+
+# Returns the Tukey box statistics of each group of values: quartiles
+# (linear interpolation, as Plotly computes them), whiskers at the furthest
+# values within 1.5 IQR of the box, the mean and the outliers
+
+# Parameters:
+#   - x_data (list): the group of each value
+#   - y_data (list): the values
+
+# Returns a dictionary of arrays (one entry per group) and the outliers'
+# groups and values
+
+def box_stats(x_data, y_data):
+    x = np.asarray(x_data, dtype=float)
+    y = np.asarray(y_data, dtype=float)
+
+    keep = ~(np.isnan(x) | np.isnan(y))
+    x, y = x[keep], y[keep]
+
+    # Sort by group then value so each group is a contiguous sorted slice
+    order = np.lexsort((y, x))
+    x, y = x[order], y[order]
+    groups, starts = np.unique(x, return_index=True)
+    ends = np.append(starts[1:], len(x))
+
+    stats = {name: np.empty(len(groups)) for name in
+             ('q1', 'median', 'q3', 'lowerfence', 'upperfence', 'mean')}
+    outlier_x, outlier_y = [], []
+
+    for i, (start, end) in enumerate(zip(starts, ends)):
+        values = y[start:end]
+        q1, median, q3 = np.percentile(values, [25, 50, 75])
+        low, high = q1 - 1.5 * (q3 - q1), q3 + 1.5 * (q3 - q1)
+        inside = values[(values >= low) & (values <= high)]
+
+        stats['q1'][i], stats['median'][i], stats['q3'][i] = q1, median, q3
+        stats['lowerfence'][i], stats['upperfence'][i] = inside[0], inside[-1]
+        stats['mean'][i] = values.mean()
+
+        outliers = values[(values < low) | (values > high)]
+        outlier_x.append(np.full(len(outliers), groups[i]))
+        outlier_y.append(outliers)
+
+    stats['x'] = groups
+    stats['outlier_x'] = np.concatenate(outlier_x) if outlier_x else np.empty(0)
+    stats['outlier_y'] = np.concatenate(outlier_y) if outlier_y else np.empty(0)
+
+    return stats
+
+
+# Returns the traces of one box series with the statistics computed here
+# rather than in the browser: a box trace of precomputed quartiles and
+# whiskers and a marker trace of the outliers
+
+# Parameters:
+#   - x_data (list): the group of each value
+#   - y_data (list): the values
+#   - name (str): the name of the series
+#   - color (str): the colour of the series
+#   - intervals (dict): confidence intervals of each group's median with
+#                       group, low and high arrays, drawn as the box notches
+#                       (see bootstrap.grouped_intervals)
+
+def box_traces(x_data, y_data, name : str, color : str, intervals : dict = None):
+    stats = box_stats(x_data, y_data)
+
+    notches = {}
+    if intervals is not None:
+        # Plotly draws symmetric notches so use the wider side of each interval
+        bars = error_bars(stats['x'], stats['median'], intervals)
+        notchspan = np.nan_to_num(np.maximum(bars['array'], bars['arrayminus']))
+        notches = dict(notched=True, notchspan=notchspan)
+
+    box = go.Box(x=stats['x'], q1=stats['q1'], median=stats['median'], q3=stats['q3'],
+                 lowerfence=stats['lowerfence'], upperfence=stats['upperfence'],
+                 mean=stats['mean'], name=name, marker_color=color, offsetgroup=name,
+                 legendgroup=name, **notches)
+    outliers = go.Scatter(x=stats['outlier_x'], y=stats['outlier_y'], mode='markers',
+                          name=f'{name} outliers', marker_color=color, offsetgroup=name,
+                          legendgroup=name, showlegend=False)
+
+    return [box, outliers]
+
+
+# Returns the size of a figure's JSON payload and the time taken to build it
+
+# Parameters:
+#   - fig (go.Figure): the figure
+
+# Returns a dictionary of {traces, points, json_kb, serialise_seconds}
+
+def figure_stats(fig):
+    start = time.perf_counter()
+    payload = fig.to_json()
+    seconds = time.perf_counter() - start
+
+    points = 0
+    for trace in fig.data:
+        values = getattr(trace, 'x', None)
+        if values is None:
+            values = getattr(trace, 'y', None)
+        points += len(values) if values is not None else 0
+
+    return {
+        'traces': len(fig.data),
+        'points': points,
+        'json_kb': round(len(payload.encode()) / 1024, 1),
+        'serialise_seconds': round(seconds, 4)
+    }
+
+
+# Compares the figure size and serialisation time of each render mode on a
+# scatter of n_points points and of raw against precomputed box plots
+
+# Parameters:
+#   - n_points (int): the number of points
+#   - seed (int): the seed of the synthetic points
+
+# Returns a dictionary of {render mode: figure_stats}
+
+def benchmark_rendering(n_points : int = 200_000, seed : int = 0):
+    rng = np.random.default_rng(seed)
+    x = rng.normal(6.5, 1.5, n_points)
+    y = np.clip(5 * x + rng.normal(0, 15, n_points), 0, 100)
+    groups = rng.integers(1, 11, n_points)
+
+    results = {}
+    for render_mode in ('svg', 'webgl', 'hexbin', 'rectbin', 'lttb'):
+        fig = go.Figure([scatter_trace(x, y, 'points', '#1f77b4',
+                                       line_plot=render_mode == 'lttb',
+                                       render_mode=render_mode)])
+        results[render_mode] = figure_stats(fig)
+
+    results['box_raw'] = figure_stats(go.Figure([go.Box(x=groups, y=y)]))
+    results['box_precomputed'] = figure_stats(go.Figure(box_traces(groups, y, 'points',
+                                                                   '#1f77b4')))
+
+    return results
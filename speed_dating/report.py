@@ -0,0 +1,516 @@
+import argparse
+import html
+import importlib
+import importlib.util
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+# Only the standard library is imported here so the command starts fast.
+# NumPy, pandas, SciPy, scikit-learn and plotly are imported by the stages
+# and figures that use them.
+
+# The attributes and their names in the figures (as in the notebook)
+COLUMNS_BASE = ['attr', 'sinc', 'intel', 'fun', 'amb']
+COLUMNS_FULL = ['Attractive', 'Sincere', 'Intelligent', 'Fun', 'Ambitious']
+
+# The plot colours and labels of each gender
+COLORS = ['#ff6361', '#003f5c']
+GENDER_LABELS = ['Female', 'Male']
+BACKGROUND = '#dadfe1'
+
+# The libraries whose import time is worth reporting
+HEAVY_MODULES = ('numpy', 'pandas', 'scipy', 'sklearn', 'plotly')
+
+# The modules every figure uses, imported once before the workers start so
+# forked workers share them
+FIGURE_MODULES = ('numpy', 'plotly.graph_objects', 'speed_dating.analysis_store',
+                  'speed_dating.rendering')
+
+# The store each worker process reads from, loaded on its first figure
+WORKER_STATE = {}
+
+
+# Returns the top-level heavy libraries that have been imported
+
+def loaded_libraries():
+    return sorted(name for name in HEAVY_MODULES if name in sys.modules)
+
+
+# Returns a plotly layout in the notebook's style
+
+# Parameters:
+#   - title (str): the figure title
+#   - x_title (str): the x-axis title
+#   - y_title (str): the y-axis title
+#   - kwargs: further layout properties
+
+def figure_layout(title : str, x_title : str, y_title : str, **kwargs):
+    import plotly.graph_objects as go
+
+    return go.Layout(title=title, xaxis=dict(title=x_title), yaxis=dict(title=y_title),
+                     plot_bgcolor=BACKGROUND, paper_bgcolor=BACKGROUND, **kwargs)
+
+
+# Returns one scatter trace per gender of {gender: [x, y]} data
+
+# Parameters:
+#   - data (dict): the x and y data for each gender
+#   - line_plot (bool): whether to draw lines instead of markers
+#   - intervals (dict): the confidence intervals of each gender (optional)
+
+def scatter_traces(data : dict, line_plot : bool = False, intervals : dict = None):
+    from speed_dating.rendering import scatter_trace
+
+    return [scatter_trace(x_data, y_data, gender, color, line_plot,
+                          intervals=intervals[gender] if intervals is not None else None)
+            for (gender, (x_data, y_data)), color in zip(data.items(), COLORS)]
+
+
+# Each section's figure, built from the store in a worker process
+
+# Parameters (of every figure function):
+#   - store (AnalysisStore): the in-memory store
+#   - settings (dict): the database path and model cache directory
+
+def preferences_figure(store, settings : dict):
+    import plotly.graph_objects as go
+
+    pref_data = store.fetch_pref_data([f'pf_o_{attribute}' for attribute in COLUMNS_BASE],
+                                      GENDER_LABELS)
+    traces = [go.Bar(x=COLUMNS_FULL, y=list(values), name=gender, marker_color=color)
+              for (gender, values), color in zip(pref_data.items(), COLORS)]
+
+    return go.Figure(traces, figure_layout('Average Allocation for Attributes by Gender',
+                                           'Attributes', 'Average Allocation', barmode='group'))
+
+
+def feature_importance_figure(store, settings : dict):
+    import plotly.graph_objects as go
+    from speed_dating.training import MODEL_CACHE_DIR, train_and_evaluate_parallel
+
+    rating_data = store.fetch_rating_data([f'{attribute}_o' for attribute in COLUMNS_BASE])
+    # The worker is already one of the report's processes
+    _, _, importances, _ = train_and_evaluate_parallel(
+        rating_data, GENDER_LABELS, cache_dir=settings['model_cache_dir'] or MODEL_CACHE_DIR,
+        max_workers=1)
+    traces = [go.Bar(x=COLUMNS_FULL, y=list(values), name=gender, marker_color=color)
+              for (gender, values), color in zip(importances.items(), COLORS)]
+
+    return go.Figure(traces, figure_layout(
+        'Feature Importance for Successful Second Date Prediction', 'Attributes',
+        'Relative Feature Importance', barmode='group'))
+
+
+def avg_attr_figure(store, settings : dict):
+    import plotly.graph_objects as go
+
+    return go.Figure(scatter_traces(store.fetch_avg_attr_data()), figure_layout(
+        'Influence of Average Attractiveness Rating Received on Second Date Success',
+        'Average Attractiveness Rating Received', 'Percentage of Successful Second Dates'))
+
+
+def self_rating_figure(store, settings : dict):
+    import plotly.graph_objects as go
+    from speed_dating.bootstrap import intervals_by_gender, participant_outcomes
+
+    # 95% BCa bootstrap intervals of each success rate, resampling participants
+    outcomes = participant_outcomes(settings['database_path'], store)
+    intervals = intervals_by_gender(outcomes, 'attr3_1', max_workers=1)
+
+    return go.Figure(
+        scatter_traces(store.fetch_avg_self_attr_data(), line_plot=True, intervals=intervals),
+        figure_layout('Relationship between Self-Rating of Attractiveness and Second Date '
+                      'Success Rate', 'Self-Rating of Attractiveness',
+                      'Percentage of Successful Second Dates'))
+
+
+def self_rating_box_figure(store, settings : dict):
+    import plotly.graph_objects as go
+    from speed_dating.bootstrap import intervals_by_gender, participant_outcomes
+    from speed_dating.rendering import box_traces
+
+    # The notches show 95% percentile bootstrap intervals of each median
+    outcomes = participant_outcomes(settings['database_path'], store)
+    intervals = intervals_by_gender(outcomes, 'attr3_1', statistic='median',
+                                    method='percentile', max_workers=1)
+
+    traces = []
+    for (gender, (x_data, y_data)), color in zip(store.fetch_self_attr_data().items(), COLORS):
+        traces.extend(box_traces(x_data, y_data, gender, color, intervals[gender]))
+
+    return go.Figure(traces, figure_layout(
+        'Second Dates Success Percentage by Self Rating of Attractiveness',
+        'Self-Rating of Attractiveness', 'Percentage of Successful Second Dates',
+        boxmode='group', scattermode='group'))
+
+
+# Returns the figure of the attractiveness self-perception gap of one band
+
+# Parameters:
+#   - store (AnalysisStore): the in-memory store
+#   - settings (dict): the database path
+#   - band (str): the self-rating band label
+#   - title (str): the band in the title
+
+def self_perception_figure(store, settings : dict, band : str, title : str):
+    import plotly.graph_objects as go
+    from speed_dating.self_perception import SELF_RATING_BANDS, by_gender, self_perception
+
+    result = self_perception(settings['database_path'], ['attr'], SELF_RATING_BANDS, store)
+
+    return go.Figure(scatter_traces(by_gender(result, 'attr', band)), figure_layout(
+        f'Influence of Attraction Self-Perception on Second Date Success ({title})',
+        'Difference in Self Rating and Attractiveness Rating Received',
+        'Percentage of Successful Second Dates'))
+
+
+def self_perception_all_figure(store, settings : dict):
+    from plotly.subplots import make_subplots
+    from speed_dating.self_perception import SELF_RATING_BANDS, by_gender, self_perception
+
+    result = self_perception(settings['database_path'], COLUMNS_BASE, SELF_RATING_BANDS, store)
+    bands = list(SELF_RATING_BANDS)
+
+    fig = make_subplots(rows=len(COLUMNS_BASE), cols=len(bands), shared_yaxes=True,
+                        subplot_titles=[f'{name} ({band})' for name in COLUMNS_FULL
+                                        for band in bands])
+
+    for row, attribute in enumerate(COLUMNS_BASE, start=1):
+        for col, band in enumerate(bands, start=1):
+            for trace in scatter_traces(by_gender(result, attribute, band)):
+                # Only show one legend entry per gender
+                trace.update(showlegend=(row, col) == (1, 1), legendgroup=trace.name)
+                fig.add_trace(trace, row=row, col=col)
+
+    fig.update_layout(title='Influence of Self-Perception on Second Date Success by Attribute',
+                      height=300 * len(COLUMNS_BASE), plot_bgcolor=BACKGROUND,
+                      paper_bgcolor=BACKGROUND)
+    fig.update_xaxes(title_text='Self Rating minus Average Rating Received',
+                     row=len(COLUMNS_BASE))
+    fig.update_yaxes(title_text='Proportion of Successful Second Dates', col=1)
+
+    return fig
+
+
+def attraction_variance_figure(store, settings : dict):
+    import plotly.graph_objects as go
+    from speed_dating.density import kde
+
+    traces = []
+    for (gender, values), color in zip(store.fetch_var_attr_data().items(), COLORS):
+        # A variance cannot be negative
+        x_vals, y_vals, h = kde(values, bounds=(0, None))
+        # A gender without values has no density to draw
+        if h is None:
+            continue
+        traces.append(go.Scatter(x=x_vals, y=y_vals, mode='lines',
+                                 name=f'{gender} (bandwidth {h:.3f})', line=dict(color=color)))
+
+    return go.Figure(traces, go.Layout(title='Attraction Variance by Gender '
+                                             '(Kernel Density Estimate)',
+                                       xaxis=dict(title='Attraction Variance'),
+                                       yaxis=dict(title='Density')))
+
+
+# The sections of the report in order, as name to (heading, figure function)
+SECTIONS = {
+    'preferences': ('Initial Preference Allocation', preferences_figure),
+    'feature_importance': ('Actual Attribute Importance for Second Date Success',
+                           feature_importance_figure),
+    'avg_attr': ('The Power of Attractiveness', avg_attr_figure),
+    'self_rating': ('Self-Rated Attractiveness against Second Date Success', self_rating_figure),
+    'self_rating_box': ('Variance in Second Date Success by Self-Rated Attractiveness',
+                        self_rating_box_figure),
+    'self_perception_6_10': ('Influence of Accurate Self-Perception with Self Ratings of 6 - 10',
+                             lambda store, settings: self_perception_figure(
+                                 store, settings, 'Self Ratings 6 - 10', 'Self Ratings 6 - 10')),
+    'self_perception_0_5': ('Influence of Accurate Self-Perception with Self Ratings of 5 - 0',
+                            lambda store, settings: self_perception_figure(
+                                store, settings, 'Self Ratings 0 - 5', 'Self Ratings 5 - 0')),
+    'self_perception_all': ('Self-Perception of Every Attribute', self_perception_all_figure),
+    'attraction_variance': ('Beauty is in the Eye of the Beholder', attraction_variance_figure)
+}
+
+
+# Returns the worker's store, loading it on first use from the snapshot if
+# it is current and from the database otherwise
+
+# Parameters:
+#   - database_path (str): the path to your database
+#   - snapshot_dir (str): the directory of the snapshot (None to skip it)
+
+def worker_store(database_path : str, snapshot_dir : str = None):
+    key = (database_path, snapshot_dir)
+
+    if WORKER_STATE.get('key') != key:
+        from speed_dating.analysis_store import AnalysisStore
+        from speed_dating.snapshot import snapshot_is_current
+
+        if snapshot_dir is not None and snapshot_is_current(snapshot_dir, database_path):
+            WORKER_STATE['store'] = AnalysisStore.from_snapshot(snapshot_dir)
+        else:
+            WORKER_STATE['store'] = AnalysisStore.from_database(database_path)
+        WORKER_STATE['key'] = key
+
+    return WORKER_STATE['store']
+
+
+# Builds one section's figure. Runs in a worker process.
+
+# Parameters:
+#   - name (str): the section name (a key of SECTIONS)
+#   - settings (dict): the database path, snapshot directory and model
+#                      cache directory
+
+# Returns a dictionary of {section, figure (plotly JSON), load_seconds,
+# build_seconds, imported (the heavy libraries first imported for it)}
+
+def build_section(name : str, settings : dict):
+    loaded = set(loaded_libraries())
+
+    start = time.perf_counter()
+    store = worker_store(settings['database_path'], settings['snapshot_dir'])
+    load_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    figure = SECTIONS[name][1](store, settings).to_json()
+    build_seconds = time.perf_counter() - start
+
+    return {
+        'section': name,
+        'figure': figure,
+        'load_seconds': round(load_seconds, 4),
+        'build_seconds': round(build_seconds, 4),
+        'imported': sorted(set(loaded_libraries()) - loaded)
+    }
+
+
+# Returns the contents of plotly.min.js from the installed plotly package,
+# found without importing plotly
+
+def plotly_js():
+    spec = importlib.util.find_spec('plotly')
+    if spec is None:
+        raise ValueError('plotly must be installed to write the report')
+
+    path = os.path.join(spec.submodule_search_locations[0], 'package_data', 'plotly.min.js')
+    with open(path, encoding='utf-8') as file:
+        return file.read()
+
+
+# Returns a self-contained HTML page with plotly.js embedded once and one
+# section per figure
+
+# Parameters:
+#   - sections (list): the results of build_section in report order
+#   - title (str): the page title
+
+def render_html(sections : list, title : str = 'Beauty and the Beholder'):
+    parts = [
+        '<!DOCTYPE html>',
+        '<html lang="en">',
+        '<head>',
+        '<meta charset="utf-8">',
+        f'<title>{html.escape(title)}</title>',
+        f'<style>body {{ font-family: sans-serif; margin: 2em; background: {BACKGROUND}; }}'
+        ' section { margin-bottom: 3em; }</style>',
+        f'<script>{plotly_js()}</script>',
+        '</head>',
+        '<body>',
+        f'<h1>{html.escape(title)}</h1>',
+        '<nav><ul>'
+    ]
+    parts += [f'<li><a href="#{section["section"]}">'
+              f'{html.escape(SECTIONS[section["section"]][0])}</a></li>' for section in sections]
+    parts.append('</ul></nav>')
+
+    for section in sections:
+        name = section['section']
+        # Stop the figure JSON from closing the script element
+        figure = section['figure'].replace('</', '<\\/')
+        parts += [
+            f'<section id="{name}">',
+            f'<h2>{html.escape(SECTIONS[name][0])}</h2>',
+            f'<div id="figure-{name}"></div>',
+            f'<script>(function () {{ var figure = {figure}; '
+            f"Plotly.newPlot('figure-{name}', figure.data, figure.layout, "
+            '{responsive: true}); })();</script>',
+            '</section>'
+        ]
+
+    parts += ['</body>', '</html>']
+
+    return '\n'.join(parts)
+
+
+# Runs the notebook's data preparation pipeline, skipping the stages whose
+# inputs are unchanged
+
+# Parameters:
+#   - csv_file (str): the name of the .csv
+#   - database_path (str): the path of the .db
+#   - snapshot_dir (str): the directory of the snapshot
+
+def run_pipeline(csv_file : str, database_path : str, snapshot_dir : str):
+    from speed_dating.benchmark import CSV_COLUMNS, COLUMNS_3_1, COLUMNS_O, COLUMNS_PF_O
+    from speed_dating.pipeline import notebook_pipeline
+
+    return notebook_pipeline(csv_file, database_path, CSV_COLUMNS, COLUMNS_O, COLUMNS_3_1,
+                             COLUMNS_PF_O, snapshot_dir=snapshot_dir).run()
+
+
+# Builds the report: optionally runs the pipeline, builds every section's
+# figure across a process pool and writes index.html (plotly.js embedded
+# once, one figure per section) and report.json (the timings) to the
+# output directory
+
+# Parameters:
+#   - output_dir (str): the directory the report is written to
+#   - database_path (str): the path of the .db
+#   - snapshot_dir (str): the directory of the snapshot (None to read the
+#                         database)
+#   - csv_file (str): the .csv to run the pipeline on (None skips the
+#                     pipeline and reports on the existing database)
+#   - sections (list): the sections to include (None for every section)
+#   - max_workers (int): the number of processes (1 builds in this process)
+#   - model_cache_dir (str): the directory of cached models (None for the
+#                            default of speed_dating/training.py)
+#   - startup_seconds (float): the CPU seconds the interpreter took to start
+#                              and import this module, recorded in
+#                              report.json (None to leave out)
+
+# Returns a dictionary of the timings: stages, sections, the heavy libraries
+# imported by this process, the startup CPU seconds and the total seconds
+
+def build_report(output_dir : str, database_path : str, snapshot_dir : str = None,
+                 csv_file : str = None, sections : list = None, max_workers : int = None,
+                 model_cache_dir : str = None, startup_seconds : float = None):
+    start = time.perf_counter()
+    sections = list(sections or SECTIONS)
+
+    unknown = [name for name in sections if name not in SECTIONS]
+    if unknown:
+        raise ValueError(f'Unknown sections {unknown}, expected some of {list(SECTIONS)}')
+
+    stages = []
+
+    def run_stage(name, function, *args):
+        stage_start = time.perf_counter()
+        result = function(*args)
+        stages.append({'stage': name, 'seconds': round(time.perf_counter() - stage_start, 4),
+                       'libraries': loaded_libraries()})
+        return result
+
+    if csv_file is not None:
+        run_stage('pipeline', run_pipeline, csv_file, database_path, snapshot_dir)
+
+    # Imported once here so forked workers do not import them again
+    run_stage('import_figure_modules', lambda: [importlib.import_module(name)
+                                                for name in FIGURE_MODULES])
+
+    settings = {'database_path': database_path, 'snapshot_dir': snapshot_dir,
+                'model_cache_dir': model_cache_dir}
+    max_workers = max_workers or min(os.cpu_count() or 1, len(sections))
+
+    def build_figures():
+        if max_workers == 1:
+            return [build_section(name, settings) for name in sections]
+
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(build_section, sections, [settings] * len(sections)))
+
+    results = run_stage('build_figures', build_figures)
+
+    def write_bundle():
+        os.makedirs(output_dir, exist_ok=True)
+        with open(os.path.join(output_dir, 'index.html'), 'w', encoding='utf-8') as file:
+            file.write(render_html(results))
+
+    run_stage('write_html', write_bundle)
+
+    report = {
+        'stages': stages,
+        'sections': [{key: value for key, value in result.items() if key != 'figure'}
+                     | {'json_kb': round(len(result['figure'].encode()) / 1024, 1)}
+                     for result in results],
+        'workers': max_workers,
+        'libraries': loaded_libraries(),
+        'startup_cpu_seconds': None if startup_seconds is None else round(startup_seconds, 4),
+        'seconds': round(time.perf_counter() - start, 4)
+    }
+
+    with open(os.path.join(output_dir, 'report.json'), 'w') as file:
+        json.dump(report, file, indent=2)
+
+    return report
+
+
+# Measures the import time of a module in a fresh interpreter with
+# python -X importtime
+
+# Parameters:
+#   - module (str): the module to import
+#   - top (int): the number of slowest top-level packages to return
+
+# Returns a dictionary of {seconds, packages: {package: cumulative seconds}}
+
+def import_profile(module : str = 'speed_dating.report', top : int = 10):
+    stderr = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            capture_output=True, text=True, check=True).stderr
+
+    packages = {}
+    for line in stderr.splitlines():
+        match = re.match(r'import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)', line)
+        # Only the imports made directly by the module (not nested ones)
+        if match and len(match.group(3)) <= 2:
+            package = match.group(4).split('.')[0]
+            packages[package] = packages.get(package, 0) + int(match.group(2)) / 1e6
+
+    slowest = sorted(packages.items(), key=lambda item: item[1], reverse=True)[:top]
+
+    return {
+        'seconds': round(sum(packages.values()), 4),
+        'packages': {package: round(seconds, 4) for package, seconds in slowest}
+    }
+
+
+if __name__ == '__main__':
+    # The CPU time of the interpreter's startup and imports so far
+    startup_seconds = time.process_time()
+
+    parser = argparse.ArgumentParser(description='Build the analysis report as static HTML.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    build_parser = subparsers.add_parser('build', help='render every figure to a HTML bundle')
+    build_parser.add_argument('output_dir')
+    build_parser.add_argument('--database', default='speed_dating.db')
+    build_parser.add_argument('--snapshot', default='speed_dating.snapshot')
+    build_parser.add_argument('--csv', default=None,
+                              help='run the data preparation pipeline on this .csv first')
+    build_parser.add_argument('--sections', nargs='+', default=None, choices=list(SECTIONS))
+    build_parser.add_argument('--workers', type=int, default=None)
+    build_parser.add_argument('--model-cache', default=None)
+
+    imports_parser = subparsers.add_parser('imports', help='measure the import time of a module')
+    imports_parser.add_argument('module', nargs='?', default='speed_dating.report')
+
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        report = build_report(args.output_dir, args.database, args.snapshot, args.csv,
+                              args.sections, args.workers, args.model_cache, startup_seconds)
+
+        for stage in report['stages']:
+            print(f"{stage['stage']}: {stage['seconds']} seconds.")
+        for section in report['sections']:
+            print(f"{section['section']}: built in {section['build_seconds']} seconds "
+                  f"({section['json_kb']} KB, imported {section['imported'] or 'nothing'}).")
+        print(f"Startup: {report['startup_cpu_seconds']} CPU seconds. "
+              f"Report written to {args.output_dir} in {report['seconds']} seconds.")
+    else:
+        print(json.dumps(import_profile(args.module), indent=2))
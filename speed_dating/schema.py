@@ -0,0 +1,419 @@
+import os
+import re
+import sqlite3
+import tempfile
+import time
+
+from speed_dating.tracing import connect, span
+
+# Plan details that read every row of a table (or CTE) without an index
+FULL_SCAN = re.compile(r'^SCAN (\w+)$')
+
+# Table references in a query with their optional alias
+TABLE_REFERENCE = re.compile(
+    r'\b(?:FROM|JOIN)\s+(\w+)'
+    r'(?:\s+(?:AS\s+)?(?!(?:ON|JOIN|WHERE|GROUP|ORDER)\b)(\w+))?',
+    re.IGNORECASE)
+
+
+# Creates the participants table as a STRICT table keyed on iid.
+# INTEGER PRIMARY KEY makes iid the rowid, so rows are stored in iid order
+# and no separate index on iid is needed.
+
+# Parameters:
+#   - cursor (sqlite3.Cursor): a cursor in the open transaction
+#   - columns_3_1 (list): list of attributes ending in 3_1 (self ratings given)
+#   - columns_pf_o (list): list of attributes in the form
+#                          pf_o_{attribute} (attribute preferences)
+
+def create_participants_table(cursor, columns_3_1 : list, columns_pf_o : list):
+    # Drop the participants table if it exists
+    cursor.execute('DROP TABLE IF EXISTS participants')
+
+    # Ratings and preferences can be fractional (e.g. 16.67 points or an
+    # imputed rating), whole values are still stored on disk as integers
+    cursor.execute(f'''
+        CREATE TABLE participants(
+            iid INTEGER PRIMARY KEY,
+            gender INTEGER NOT NULL CHECK (gender IN (0, 1)),
+            {', '.join(f'{attr} REAL' for attr in columns_3_1)},
+            {', '.join(f'{attr} REAL' for attr in columns_pf_o)}
+            ) STRICT
+    ''')
+
+    # Insert each participant with their self ratings
+    cursor.execute(f'''
+        INSERT INTO participants(iid, gender, {', '.join(columns_3_1)})
+        SELECT DISTINCT iid, gender, {', '.join(columns_3_1)}
+        FROM speed_dating
+    ''')
+
+    # The preferences of each participant are recorded on the rows where
+    # they are the pid
+    cursor.execute(f'''
+        UPDATE participants
+        SET {', '.join(f'{attr} = s.{attr}' for attr in columns_pf_o)}
+        FROM
+            speed_dating AS s
+        WHERE
+            participants.iid = s.pid
+    ''')
+
+    return cursor.execute('SELECT COUNT(*) FROM participants').fetchone()[0]
+
+
+# Creates the dates table as a STRICT, WITHOUT ROWID table clustered on
+# (iid, date_id). Every analysis query joins dates on iid, so the rows of a
+# participant are stored together and the primary key serves as the index
+# on iid.
+
+# Parameters:
+#   - cursor (sqlite3.Cursor): a cursor in the open transaction
+#   - columns_o (list): list of attributes ending in _o (ratings received)
+
+def create_dates_table(cursor, columns_o : list):
+    # Drop the dates table if it exists
+    cursor.execute('DROP TABLE IF EXISTS dates')
+
+    cursor.execute(f'''
+        CREATE TABLE dates(
+            iid INTEGER NOT NULL REFERENCES participants (iid),
+            date_id INTEGER NOT NULL,
+            pid INTEGER NOT NULL REFERENCES participants (iid),
+            match INTEGER NOT NULL CHECK (match IN (0, 1)),
+            dec_o INTEGER NOT NULL CHECK (dec_o IN (0, 1)),
+            {', '.join(f'{attr} REAL' for attr in columns_o)},
+            PRIMARY KEY (iid, date_id)
+            ) STRICT, WITHOUT ROWID
+    ''')
+
+    # date_id numbers the dates in the order of the .db, as the
+    # AUTOINCREMENT key did
+    cursor.execute(f'''
+        INSERT INTO dates (iid, date_id, pid, match, dec_o, {', '.join(columns_o)})
+        SELECT iid, ROW_NUMBER() OVER (ORDER BY rowid), pid, match, dec_o,
+               {', '.join(columns_o)}
+        FROM speed_dating
+        ORDER BY iid, rowid
+    ''')
+
+    return cursor.execute('SELECT COUNT(*) FROM dates').fetchone()[0]
+
+
+# Creates the covering indexes used by the analysis queries. Each one holds
+# every column its query reads, so the query never visits the table rows.
+
+# Parameters:
+#   - cursor (sqlite3.Cursor): a cursor in the open transaction
+#   - columns_pf_o (list): list of attributes in the form
+#                          pf_o_{attribute} (attribute preferences)
+
+def create_analysis_indexes(cursor, columns_pf_o : list):
+    # Average preferences grouped by gender (fetch_pref_data)
+    cursor.execute(f'''
+        CREATE INDEX idx_participants_gender_pf
+        ON participants (gender, {', '.join(columns_pf_o)})
+    ''')
+
+    # Participants in (gender, iid) order, so the dates of each gender are
+    # read in order through the dates primary key (fetch_rating_data)
+    cursor.execute('CREATE INDEX idx_participants_gender ON participants (gender)')
+
+    # Success grouped by self-rating and gender (fetch_avg_self_attr_data)
+    cursor.execute('CREATE INDEX idx_participants_attr3_1 ON participants (attr3_1, gender)')
+
+    # Self-rating per participant in iid order (fetch_self_attr_data and
+    # fetch_attr_diff_data)
+    cursor.execute('CREATE INDEX idx_participants_iid_attr3_1 '
+                   'ON participants (iid, gender, attr3_1)')
+
+    # Attractiveness and success per participant (fetch_avg_attr_data,
+    # fetch_var_attr_data and the self-perception queries)
+    cursor.execute('CREATE INDEX idx_dates_iid_attr ON dates (iid, dec_o, attr_o)')
+
+
+# Creates the participants and dates tables with their covering indexes in
+# one transaction and runs ANALYZE so the query planner has statistics
+
+# Parameters:
+#   - database_path (str): the path to your database
+#   - columns_o (list): list of attributes ending in _o (ratings received)
+#   - columns_3_1 (list): list of attributes ending in 3_1 (self ratings given)
+#   - columns_pf_o (list): list of attributes in the form
+#                          pf_o_{attribute} (attribute preferences)
+
+# Returns a list of {stage, seconds, rows} for each stage
+
+def build_schema(database_path : str, columns_o : list, columns_3_1 : list, columns_pf_o : list):
+    # Connect to database
+    conn = connect(database_path)
+
+    # Create a cursor object
+    cursor = conn.cursor()
+
+    report = []
+
+    # Times a stage and records how many rows it created
+    def run_stage(name, stage, *args):
+        stage_start = time.perf_counter()
+        with span(name) as stage_span:
+            rows = stage(*args)
+            stage_span.set(rows_out=rows if isinstance(rows, int) else None)
+        report.append({
+            'stage': name,
+            'seconds': round(time.perf_counter() - stage_start, 4),
+            'rows': rows if isinstance(rows, int) else None
+        })
+
+    try:
+        cursor.execute('BEGIN')
+
+        run_stage('create_participants', create_participants_table, cursor,
+                  columns_3_1, columns_pf_o)
+        run_stage('create_dates', create_dates_table, cursor, columns_o)
+        run_stage('create_indexes', create_analysis_indexes, cursor, columns_pf_o)
+
+        # Gather the statistics used by the query planner
+        run_stage('analyze', cursor.execute, 'ANALYZE')
+
+        # Commit the changes
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        # Close the connection
+        conn.close()
+
+    for stage in report:
+        rows = '' if stage['rows'] is None else f"{stage['rows']} rows in "
+        print(f"{stage['stage']}: {rows}{stage['seconds']} seconds.")
+
+    return report
+
+
+# Returns the SQL of each fetch function's database query
+
+# Parameters:
+#   - columns_o (list): list of attributes ending in _o (ratings received)
+#   - columns_pf_o (list): list of attributes in the form
+#                          pf_o_{attribute} (attribute preferences)
+#   - custom_where (str): the condition used by fetch_attr_diff_data
+
+def analysis_queries(columns_o : list, columns_pf_o : list, custom_where : str = 'attr3_1 >= 6'):
+    return {
+        'fetch_pref_data': f'''
+            SELECT gender, {', '.join(f'AVG({column})' for column in columns_pf_o)}
+            FROM participants
+            GROUP BY gender
+            ORDER BY gender
+        ''',
+        'fetch_rating_data': f'''
+            SELECT gender, dec_o, {', '.join(columns_o)}
+            FROM participants AS p
+            JOIN dates AS d on p.iid = d.iid
+            ORDER BY gender, p.iid, d.date_id
+        ''',
+        'fetch_avg_attr_data': '''
+            SELECT gender, AVG(attr_o), ((SUM(dec_o) * 1.0)/COUNT(*)) * 100
+            FROM dates AS d
+            JOIN participants AS p on d.iid = p.iid
+            GROUP BY d.iid
+            ORDER BY gender
+        ''',
+        'fetch_avg_self_attr_data': '''
+            SELECT DISTINCT gender, attr3_1, (SUM(dec_o) * 1.0) / COUNT(*)
+            FROM participants AS p
+            JOIN dates AS d on p.iid = d.iid
+            GROUP BY attr3_1, gender
+            ORDER BY gender
+        ''',
+        'fetch_self_attr_data': '''
+            SELECT gender, attr3_1, (SUM(dec_o) * 1.0) / COUNT(*)
+            FROM participants AS p
+            JOIN dates AS d ON p.iid = d.iid
+            GROUP BY p.iid
+            ORDER BY gender, attr3_1
+        ''',
+        'fetch_attr_diff_data': f'''
+            SELECT gender, attr3_1 - AVG(attr_o), (SUM(dec_o) * 1.0) / COUNT(*)
+            FROM participants AS p
+            JOIN dates AS d ON p.iid = d.iid
+            WHERE {custom_where}
+            GROUP BY p.iid
+            ORDER BY gender, attr3_1 - AVG(attr_o)
+        ''',
+        'fetch_var_attr_data': '''
+            WITH avg_ratings AS (
+                SELECT iid, AVG(attr_o) AS avg_attr_o
+                FROM dates
+                GROUP BY iid
+            )
+
+            SELECT p.gender,
+                AVG((d.attr_o - subquery.avg_attr_o) * (d.attr_o - subquery.avg_attr_o)) AS var_attr_o
+            FROM participants AS p
+            JOIN dates d ON p.iid = d.iid
+            JOIN avg_ratings subquery ON p.iid = subquery.iid
+            GROUP BY p.iid, gender
+            ORDER BY gender
+        '''
+    }
+
+
+# Returns the EXPLAIN QUERY PLAN of each query and the tables it reads
+# without an index (a full table scan). Scans of a materialized CTE are
+# not counted as they do not read a table.
+
+# Parameters:
+#   - database_path (str): the path to your database
+#   - queries (dict): query name to SQL, e.g. from analysis_queries
+
+# Returns a dictionary of {name: {'plan': [details], 'full_scans': [tables]}}
+
+def check_query_plans(database_path : str, queries : dict):
+    # Connect to database
+    conn = sqlite3.connect(database_path)
+
+    tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+
+    plans = {}
+    for name, query in queries.items():
+        plan = [row[3] for row in conn.execute(f'EXPLAIN QUERY PLAN {query}')]
+
+        # Resolve each alias in the query to the table (or CTE) it names
+        references = {}
+        for table, alias in TABLE_REFERENCE.findall(query):
+            references[table] = table
+            if alias:
+                references[alias] = table
+
+        plans[name] = {
+            'plan': plan,
+            'full_scans': [match.group(1) for match in map(FULL_SCAN.match, plan)
+                           if match and references.get(match.group(1), match.group(1)) in tables]
+        }
+
+    # Close the connection
+    conn.close()
+
+    return plans
+
+
+# Returns the best time of several runs of each query
+
+# Parameters:
+#   - database_path (str): the path to your database
+#   - queries (dict): query name to SQL (or to (SQL, params) for a query
+#                     with placeholders), e.g. from analysis_queries
+#   - repeats (int): the number of runs per query
+
+def time_queries(database_path : str, queries : dict, repeats : int = 5):
+    # Connect to database
+    conn = sqlite3.connect(database_path)
+
+    timings = {}
+    for name, query in queries.items():
+        query, params = query if isinstance(query, tuple) else (query, ())
+        best = float('inf')
+        for _ in range(repeats):
+            start = time.perf_counter()
+            conn.execute(query, params).fetchall()
+            best = min(best, time.perf_counter() - start)
+        timings[name] = round(best, 6)
+
+    # Close the connection
+    conn.close()
+
+    return timings
+
+
+# Creates the participants and dates tables with the previous declared
+# types and indexes, kept to measure the schema against
+
+# Parameters:
+#   - database_path (str): the path to your database
+#   - columns_o (list): list of attributes ending in _o (ratings received)
+#   - columns_3_1 (list): list of attributes ending in 3_1 (self ratings given)
+#   - columns_pf_o (list): list of attributes in the form
+#                          pf_o_{attribute} (attribute preferences)
+
+def create_previous_tables(database_path : str, columns_o : list, columns_3_1 : list,
+                           columns_pf_o : list):
+    # Connect to database
+    conn = sqlite3.connect(database_path)
+
+    conn.executescript(f'''
+        DROP TABLE IF EXISTS participants;
+        DROP TABLE IF EXISTS dates;
+
+        CREATE TABLE participants(
+            iid SMALLINT UNSIGNED PRIMARY KEY,
+            gender TINYINT,
+            {', '.join(f'{attr} TINYINT UNSIGNED' for attr in columns_3_1)},
+            {', '.join(f'{attr} TINYINT UNSIGNED' for attr in columns_pf_o)}
+            );
+        CREATE INDEX idx_participants_iid ON participants (iid);
+
+        INSERT INTO participants(iid, gender, {', '.join(columns_3_1)})
+        SELECT DISTINCT iid, gender, {', '.join(columns_3_1)}
+        FROM speed_dating;
+
+        UPDATE participants
+        SET {', '.join(f'{attr} = s.{attr}' for attr in columns_pf_o)}
+        FROM speed_dating AS s
+        WHERE participants.iid = s.pid;
+
+        CREATE TABLE dates(
+            date_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            iid SMALLINT UNSIGNED,
+            pid SMALLINT UNSIGNED,
+            match TINYINT,
+            dec_o TINYINT,
+            {', '.join(f'{attr} TINYINT UNSIGNED' for attr in columns_o)}
+            );
+        CREATE INDEX idx_dates_date_id ON dates (date_id);
+
+        INSERT INTO dates (iid, pid, match, dec_o, {', '.join(columns_o)})
+        SELECT iid, pid, match, dec_o, {', '.join(columns_o)}
+        FROM speed_dating;
+    ''')
+
+    # Close the connection
+    conn.close()
+
+
+# Times the analysis queries against the previous tables and the new schema.
+# Both are built from the speed_dating table in copies of the database, so
+# the database itself is not changed.
+
+# Parameters:
+#   - database_path (str): the path to your database
+#   - columns_o (list): list of attributes ending in _o (ratings received)
+#   - columns_3_1 (list): list of attributes ending in 3_1 (self ratings given)
+#   - columns_pf_o (list): list of attributes in the form
+#                          pf_o_{attribute} (attribute preferences)
+#   - repeats (int): the number of runs per query
+
+# Returns a dictionary of {name: {'before': seconds, 'after': seconds}}
+
+def compare_schemas(database_path : str, columns_o : list, columns_3_1 : list,
+                    columns_pf_o : list, repeats : int = 5):
+    queries = analysis_queries(columns_o, columns_pf_o)
+    timings = {}
+
+    with tempfile.TemporaryDirectory() as directory:
+        for label, build in (('before', create_previous_tables), ('after', build_schema)):
+            copy_path = os.path.join(directory, f'{label}.db')
+
+            # Copy the database with the sqlite backup API
+            source = sqlite3.connect(database_path)
+            copy = sqlite3.connect(copy_path)
+            source.backup(copy)
+            copy.close()
+            source.close()
+
+            build(copy_path, columns_o, columns_3_1, columns_pf_o)
+            timings[label] = time_queries(copy_path, queries, repeats)
+
+    return {name: {label: timings[label][name] for label in timings} for name in queries}
@@ -0,0 +1,378 @@
+import argparse
+import json
+import pickle
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+# The attributes each scoring request provides, in order
+SCORING_COLUMNS = ['attr_o', 'sinc_o', 'intel_o', 'fun_o', 'amb_o']
+
+
+# A fitted sklearn forest flattened into a handful of NumPy arrays.
+# Every node of every tree is stored in one set of arrays, renumbered breadth
+# first so the children of a node are always adjacent (right = left + 1).
+# A batch of rows walks every tree at once: each step is a few array gathers
+# over the (tree, row) pairs that have not reached a leaf yet, so there is no
+# per-row or per-tree Python.
+
+# Parameters:
+#   - feature (array): the feature each node splits on
+#   - threshold (array): the split threshold of each node
+#   - left (array): the left child of each node (the node itself for leaves)
+#   - value (array): the prediction of each node (used at the leaves)
+#   - roots (array): the root node of each tree
+
+class FlatForest:
+
+    def __init__(self, feature, threshold, left, value, roots):
+        self.feature = feature
+        self.threshold = threshold
+        self.left = left
+        self.value = value
+        self.roots = roots
+        self.is_leaf = left == np.arange(len(left))
+
+    # Flattens a fitted RandomForestRegressor or RandomForestClassifier.
+    # For a classifier the leaf value is the probability of dec_o = 1.
+
+    # Parameters:
+    #   - model: the fitted sklearn forest
+
+    @classmethod
+    def from_sklearn(cls, model):
+        features, thresholds, lefts, values, roots = [], [], [], [], []
+        offset = 0
+
+        for estimator in model.estimators_:
+            tree = estimator.tree_
+            children_left = tree.children_left
+            children_right = tree.children_right
+
+            # Breadth first order with each node's children next to each other
+            order = [np.array([0])]
+            frontier = order[0]
+            while len(frontier):
+                internal = frontier[children_left[frontier] >= 0]
+                frontier = np.column_stack([children_left[internal],
+                                            children_right[internal]]).ravel()
+                order.append(frontier)
+            order = np.concatenate(order)
+
+            new_id = np.empty(tree.node_count, dtype=np.int64)
+            new_id[order] = np.arange(tree.node_count)
+            leaves = children_left[order] < 0
+
+            if tree.value.shape[2] > 1:
+                # Classifier: the proportion of the positive class
+                value = tree.value[order, 0, 1] / tree.value[order, 0, :].sum(axis=1)
+            else:
+                value = tree.value[order, 0, 0]
+
+            features.append(np.where(leaves, 0, tree.feature[order]))
+            thresholds.append(np.where(leaves, np.inf, tree.threshold[order]))
+            lefts.append(np.where(leaves, np.arange(tree.node_count),
+                                  new_id[np.where(leaves, 0, children_left[order])]) + offset)
+            values.append(value)
+            roots.append(offset)
+
+            offset += tree.node_count
+
+        return cls(np.concatenate(features).astype(np.int32),
+                   np.concatenate(thresholds),
+                   np.concatenate(lefts).astype(np.int32),
+                   np.concatenate(values),
+                   np.array(roots, dtype=np.int32))
+
+    # Returns the mean prediction of the trees for each row
+
+    # Parameters:
+    #   - X (array): 2D array with one row of ratings per prediction
+
+    def predict(self, X):
+        # sklearn compares float32 features against its thresholds
+        X = np.asarray(X, dtype=np.float32).astype(np.float64)
+        rows = len(X)
+        # Feature-major so each feature's values are contiguous
+        values = np.ascontiguousarray(X.T).ravel()
+
+        # One entry per (tree, row) pair, tree-major
+        nodes = np.repeat(self.roots, rows)
+        columns = np.tile(np.arange(rows), len(self.roots))
+
+        active = np.arange(len(nodes))
+        active_nodes = nodes
+
+        while len(active):
+            go_right = values[self.feature[active_nodes] * rows + columns] > self.threshold[active_nodes]
+            active_nodes = self.left[active_nodes] + go_right
+            nodes[active] = active_nodes
+
+            # Drop the pairs that have reached a leaf
+            walking = ~self.is_leaf[active_nodes]
+            active = active[walking]
+            active_nodes = active_nodes[walking]
+            columns = columns[walking]
+
+        return self.value[nodes].reshape(len(self.roots), rows).mean(axis=0)
+
+
+# Per-gender flattened forests that score dec_o probabilities for batches
+# of five _o attribute ratings
+
+# Parameters:
+#   - forests (dict): gender (0 or 1) to FlatForest
+
+class ScoringModel:
+
+    ARRAYS = ('feature', 'threshold', 'left', 'value', 'roots')
+
+    def __init__(self, forests : dict):
+        self.forests = forests
+
+    # Builds the scoring model from fitted sklearn forests
+
+    # Parameters:
+    #   - models (dict): gender (0 or 1) to a fitted sklearn forest
+
+    @classmethod
+    def from_models(cls, models : dict):
+        return cls({gender: FlatForest.from_sklearn(model) for gender, model in models.items()})
+
+    # Builds the scoring model from the forests cached by
+    # train_and_evaluate_parallel
+
+    # Parameters:
+    #   - training_report (dict): the per-gender report from train_and_evaluate_parallel
+    #   - gender_labels (list): the genders in the order of their numeric value
+
+    @classmethod
+    def from_training_report(cls, training_report : dict, gender_labels : list):
+        models = {}
+
+        for gender, label in enumerate(gender_labels):
+            with open(training_report[label]['model_path'], 'rb') as file:
+                models[gender] = pickle.load(file)
+
+        return cls.from_models(models)
+
+    # Saves the flattened forests to a single .npz file
+
+    # Parameters:
+    #   - path (str): the path of the .npz file
+
+    def save(self, path : str):
+        arrays = {}
+
+        for gender, forest in self.forests.items():
+            for name in self.ARRAYS:
+                arrays[f'{gender}_{name}'] = getattr(forest, name)
+
+        np.savez(path, **arrays)
+
+    # Loads flattened forests saved by save
+
+    # Parameters:
+    #   - path (str): the path of the .npz file
+
+    @classmethod
+    def load(cls, path : str):
+        forests = {}
+
+        with np.load(path) as arrays:
+            genders = sorted({int(name.split('_')[0]) for name in arrays.files})
+            for gender in genders:
+                forests[gender] = FlatForest(*(arrays[f'{gender}_{name}']
+                                               for name in cls.ARRAYS))
+
+        return cls(forests)
+
+    # Returns the dec_o probability of each row
+
+    # Parameters:
+    #   - ratings (array): 2D array of the five _o ratings per row
+    #   - gender (array): the gender (0 or 1) of each row's iid
+
+    def score(self, ratings, gender):
+        ratings = np.asarray(ratings, dtype=float).reshape(-1, len(SCORING_COLUMNS))
+        gender = np.broadcast_to(np.asarray(gender, dtype=np.int64), (len(ratings),))
+
+        unknown = ~np.isin(gender, list(self.forests))
+        if unknown.any():
+            raise ValueError(f'No model for gender {sorted(set(gender[unknown].tolist()))}, '
+                             f'expected some of {sorted(self.forests)}')
+
+        probabilities = np.empty(len(ratings))
+
+        for value, forest in self.forests.items():
+            rows = gender == value
+            if rows.any():
+                probabilities[rows] = forest.predict(ratings[rows])
+
+        return probabilities
+
+
+# Builds the HTTP request handler class for a loaded scoring model.
+# POST /score with {"ratings": [[attr_o, sinc_o, intel_o, fun_o, amb_o], ...],
+# "gender": [0 or 1, ...]} returns {"dec_o": [probability, ...]}.
+
+# Parameters:
+#   - model (ScoringModel): the loaded scoring model
+
+def make_handler(model : ScoringModel):
+
+    class ScoringHandler(BaseHTTPRequestHandler):
+
+        def do_POST(self):
+            if self.path != '/score':
+                self.send_error(404)
+                return
+
+            try:
+                body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                probabilities = model.score(body['ratings'], body['gender'])
+            except (KeyError, TypeError, ValueError) as error:
+                self.send_error(400, str(error))
+                return
+
+            response = json.dumps({'dec_o': probabilities.tolist()}).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(response)))
+            self.end_headers()
+            self.wfile.write(response)
+
+        # Keep the console quiet during load tests
+        def log_message(self, format, *args):
+            pass
+
+    return ScoringHandler
+
+
+# Serves a saved scoring model over HTTP until interrupted
+
+# Parameters:
+#   - model_path (str): the path of the saved scoring model
+#   - host (str): the interface to listen on
+#   - port (int): the port to listen on
+
+def serve(model_path : str, host : str = '127.0.0.1', port : int = 8765):
+    model = ScoringModel.load(model_path)
+    server = ThreadingHTTPServer((host, port), make_handler(model))
+
+    print(f'Scoring dec_o on http://{host}:{port}/score')
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+# Returns p50/p99 latency and throughput of a list of request latencies
+
+# Parameters:
+#   - latencies (list): seconds taken by each request
+#   - rows (int): the total number of rows scored
+#   - seconds (float): the wall clock time taken for every request
+
+def latency_summary(latencies : list, rows : int, seconds : float):
+    latencies = np.asarray(latencies)
+
+    return {
+        'requests': len(latencies),
+        'p50_ms': round(float(np.percentile(latencies, 50)) * 1000, 4),
+        'p99_ms': round(float(np.percentile(latencies, 99)) * 1000, 4),
+        'rows_per_sec': round(rows / seconds, 1),
+        'us_per_row': round(seconds / rows * 1e6, 3)
+    }
+
+
+# Measures in-process scoring latency without the HTTP layer
+
+# Parameters:
+#   - model (ScoringModel): the loaded scoring model
+#   - batch_size (int): the rows per batch
+#   - batches (int): the number of batches to score
+#   - seed (int): the seed for the random ratings
+
+def benchmark_model(model : ScoringModel, batch_size : int = 1000, batches : int = 100,
+                    seed : int = 0):
+    rng = np.random.default_rng(seed)
+    latencies = []
+
+    start = time.perf_counter()
+    for _ in range(batches):
+        ratings = rng.integers(1, 11, size=(batch_size, len(SCORING_COLUMNS)))
+        gender = rng.integers(0, 2, size=batch_size)
+
+        request_start = time.perf_counter()
+        model.score(ratings, gender)
+        latencies.append(time.perf_counter() - request_start)
+
+    return latency_summary(latencies, batch_size * batches, time.perf_counter() - start)
+
+
+# Sends random scoring batches to a running server and reports
+# p50/p99 latency and throughput
+
+# Parameters:
+#   - url (str): the URL of the /score endpoint
+#   - batch_size (int): the rows per request
+#   - requests (int): the number of requests to send
+#   - concurrency (int): the number of requests in flight at once
+#   - seed (int): the seed for the random ratings
+
+def load_test(url : str = 'http://127.0.0.1:8765/score', batch_size : int = 100,
+              requests : int = 1000, concurrency : int = 8, seed : int = 0):
+    rng = np.random.default_rng(seed)
+    payloads = [
+        json.dumps({
+            'ratings': rng.integers(1, 11, size=(batch_size, len(SCORING_COLUMNS))).tolist(),
+            'gender': rng.integers(0, 2, size=batch_size).tolist()
+        }).encode()
+        for _ in range(requests)
+    ]
+
+    # Sends one request and returns its latency
+    def send(payload):
+        request = urllib.request.Request(url, data=payload,
+                                         headers={'Content-Type': 'application/json'})
+        request_start = time.perf_counter()
+        with urllib.request.urlopen(request) as response:
+            response.read()
+        return time.perf_counter() - request_start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = list(executor.map(send, payloads))
+
+    return latency_summary(latencies, batch_size * requests, time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve or load test the dec_o scoring model.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    serve_parser = subparsers.add_parser('serve', help='serve a saved scoring model over HTTP')
+    serve_parser.add_argument('model_path')
+    serve_parser.add_argument('--host', default='127.0.0.1')
+    serve_parser.add_argument('--port', type=int, default=8765)
+
+    load_parser = subparsers.add_parser('load', help='send random batches to a running server')
+    load_parser.add_argument('--url', default='http://127.0.0.1:8765/score')
+    load_parser.add_argument('--batch-size', type=int, default=100)
+    load_parser.add_argument('--requests', type=int, default=1000)
+    load_parser.add_argument('--concurrency', type=int, default=8)
+
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        serve(args.model_path, args.host, args.port)
+    else:
+        print(json.dumps(load_test(args.url, args.batch_size, args.requests, args.concurrency),
+                         indent=2))
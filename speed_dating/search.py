@@ -0,0 +1,442 @@
+import itertools
+import math
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+from sklearn.metrics import roc_auc_score
+from sklearn.model_selection import train_test_split
+from threadpoolctl import threadpool_limits
+
+from speed_dating.classification import make_classifier
+from speed_dating.tracing import span
+
+# The hyperparameters searched for each model
+SEARCH_SPACES = {
+    'random_forest': {
+        'n_estimators': (50, 100, 200, 400),
+        'max_depth': (None, 4, 8, 16),
+        'min_samples_leaf': (1, 5, 20, 50),
+        'max_features': (1.0, 'sqrt', 0.6)
+    },
+    'hist_gradient_boosting': {
+        'max_iter': (50, 100, 200, 400),
+        'max_depth': (None, 3, 6, 12),
+        'min_samples_leaf': (5, 20, 50, 100),
+        'max_features': (1.0, 0.6, 0.4)
+    }
+}
+
+# The parameter of each model that sets its number of trees
+TREE_PARAMS = {'random_forest': 'n_estimators', 'hist_gradient_boosting': 'max_iter'}
+
+# The budgets a search can grow: the training rows, the trees or both
+RESOURCES = ('rows', 'trees', 'both')
+
+# The fewest training rows a candidate is fitted on
+MIN_ROWS = 100
+
+# The arrays of a worker process, attached once per process by
+# attach_arrays rather than sent with every task
+WORKER_ARRAYS = {}
+WORKER_BLOCKS = []
+
+# The thread limits of a worker process, kept so they stay in force
+WORKER_LIMITS = []
+
+
+# Returns every combination of the hyperparameters of the given models
+
+# Parameters:
+#   - models (tuple): the model names (keys of SEARCH_SPACES)
+#   - spaces (dict): the hyperparameter values of each model
+
+# Returns a list of {model, params}
+
+def candidate_grid(models : tuple = ('random_forest', 'hist_gradient_boosting'),
+                   spaces : dict = None):
+    spaces = spaces or SEARCH_SPACES
+    candidates = []
+
+    for model in models:
+        names = list(spaces[model])
+        for values in itertools.product(*(spaces[model][name] for name in names)):
+            candidates.append({'model': model, 'params': dict(zip(names, values))})
+
+    return candidates
+
+
+# Returns a random sample of candidates
+
+# Parameters:
+#   - candidates (list): the candidates to sample from
+#   - n_candidates (int): the number to sample (all when None or larger)
+#   - seed (int): the seed of the sample
+
+def sample_candidates(candidates : list, n_candidates : int = None, seed : int = 0):
+    if n_candidates is None or n_candidates >= len(candidates):
+        return list(candidates)
+
+    rows = np.random.default_rng(seed).choice(len(candidates), n_candidates, replace=False)
+
+    return [candidates[row] for row in sorted(rows)]
+
+
+# Attaches read-only views of arrays held in shared memory in a worker
+# process and limits its native thread pools to one thread. The pool
+# already runs one process per core, and HistGradientBoostingClassifier
+# would otherwise start an OpenMP thread per core in every worker.
+
+# Parameters:
+#   - specs (dict): name to (shared memory name, shape, dtype)
+
+def attach_arrays(specs : dict):
+    WORKER_LIMITS.append(threadpool_limits(limits=1))
+
+    for name, (block_name, shape, dtype) in specs.items():
+        block = SharedMemory(name=block_name)
+        view = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+        view.flags.writeable = False
+
+        WORKER_BLOCKS.append(block)
+        WORKER_ARRAYS[name] = view
+
+
+# Fits one candidate on a budget of the training rows (the first rows of
+# the shuffled training set) or of its trees and scores it on the
+# validation set
+
+# Parameters:
+#   - candidate (dict): {model, params}
+#   - fraction (float): the share of the full budget to use
+#   - resource (str): one of RESOURCES
+#   - random_state (int): the seed for the model
+
+# Returns a dictionary of the accuracy, AUC, CPU seconds, rows and trees
+
+def evaluate_candidate(candidate : dict, fraction : float, resource : str,
+                       random_state : int = 42):
+    X_train, y_train = WORKER_ARRAYS['X_train'], WORKER_ARRAYS['y_train']
+    X_val, y_val = WORKER_ARRAYS['X_val'], WORKER_ARRAYS['y_val']
+
+    params = dict(candidate['params'])
+    rows = len(y_train)
+    if resource in ('rows', 'both'):
+        rows = min(max(int(round(rows * fraction)), MIN_ROWS), rows)
+    if resource in ('trees', 'both'):
+        tree_param = TREE_PARAMS[candidate['model']]
+        params[tree_param] = max(int(round(params[tree_param] * fraction)), 1)
+
+    model = make_classifier(candidate['model'], random_state).set_params(**params)
+
+    # CPU time of this process, which runs its models on one thread so
+    # every candidate's time is comparable
+    start = time.process_time()
+    model.fit(X_train[:rows], y_train[:rows])
+    probabilities = model.predict_proba(X_val)[:, 1]
+    cpu_seconds = time.process_time() - start
+
+    return {
+        'accuracy': float(np.mean((probabilities > 0.5) == y_val)),
+        'auc': float(roc_auc_score(y_val, probabilities)),
+        'cpu_seconds': cpu_seconds,
+        'rows': rows,
+        'trees': params[TREE_PARAMS[candidate['model']]]
+    }
+
+
+# A process pool for evaluating candidates on one training and validation
+# split. The arrays are copied once into shared memory and every worker
+# attaches read-only views of them when it starts, so no task pickles the
+# data. The training rows are shuffled so any leading slice of them is a
+# random sample for the row budgets.
+
+# Parameters:
+#   - X (array): the features
+#   - y (array): the binary target
+#   - test_size (float): the share of rows held out for validation
+#   - random_state (int): the seed for the split, shuffle and models
+#   - max_workers (int): the number of processes (1 runs in this process,
+#                        None uses every core)
+
+class SearchPool:
+
+    def __init__(self, X, y, test_size : float = 0.2, random_state : int = 42,
+                 max_workers : int = None):
+        X = np.asarray(X, dtype=float)
+        y = np.asarray(y, dtype=np.int64)
+
+        X_train, X_val, y_train, y_val = train_test_split(X, y, test_size=test_size,
+                                                          random_state=random_state, stratify=y)
+        order = np.random.default_rng(random_state).permutation(len(y_train))
+
+        self.arrays = {'X_train': np.ascontiguousarray(X_train[order]),
+                       'y_train': np.ascontiguousarray(y_train[order]),
+                       'X_val': np.ascontiguousarray(X_val),
+                       'y_val': np.ascontiguousarray(y_val)}
+        self.random_state = random_state
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.blocks = []
+        self.executor = None
+        self.start = time.perf_counter()
+
+        if self.max_workers > 1:
+            specs = {}
+            for name, array in self.arrays.items():
+                block = SharedMemory(create=True, size=max(array.nbytes, 1))
+                np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[:] = array
+                self.blocks.append(block)
+                specs[name] = (block.name, array.shape, array.dtype.str)
+
+            self.executor = ProcessPoolExecutor(max_workers=self.max_workers,
+                                                initializer=attach_arrays, initargs=(specs,))
+
+    # Evaluates candidates on a budget, returning each result with the
+    # wall-clock seconds since the pool started when it finished
+
+    # Parameters:
+    #   - candidates (list): the {model, params} to evaluate
+    #   - fraction (float): the share of the full budget to use
+    #   - resource (str): one of RESOURCES
+
+    def evaluate(self, candidates : list, fraction : float, resource : str):
+        if resource not in RESOURCES:
+            raise ValueError(f'resource must be one of {RESOURCES}')
+
+        results = [None] * len(candidates)
+
+        with span('evaluate_candidates', candidates=len(candidates), fraction=fraction):
+            if self.executor is None:
+                WORKER_ARRAYS.update(self.arrays)
+                with threadpool_limits(limits=1):
+                    for i, candidate in enumerate(candidates):
+                        results[i] = evaluate_candidate(candidate, fraction, resource,
+                                                        self.random_state)
+                        results[i]['wall_seconds'] = time.perf_counter() - self.start
+            else:
+                futures = {self.executor.submit(evaluate_candidate, candidate, fraction,
+                                                resource, self.random_state): i
+                           for i, candidate in enumerate(candidates)}
+                for future in as_completed(futures):
+                    results[futures[future]] = future.result()
+                    results[futures[future]]['wall_seconds'] = time.perf_counter() - self.start
+
+        return results
+
+    # Shuts the workers down and frees the shared memory
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
+        WORKER_ARRAYS.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# Returns the best score reached so far against the cumulative CPU and
+# wall-clock seconds, counting only full-budget evaluations as reached
+# (a score on part of the budget is not the score of the final model)
+
+# Parameters:
+#   - evaluations (list): the evaluations of a search
+#   - scoring (str): 'accuracy' or 'auc'
+
+def time_to_accuracy(evaluations : list, scoring : str = 'accuracy'):
+    curve = []
+    cpu_seconds = 0.0
+    best = None
+
+    for evaluation in sorted(evaluations, key=lambda evaluation: evaluation['wall_seconds']):
+        cpu_seconds += evaluation['cpu_seconds']
+        if evaluation['fraction'] >= 1.0:
+            best = max(best, evaluation[scoring]) if best is not None else evaluation[scoring]
+        if best is not None:
+            curve.append({'cpu_seconds': round(cpu_seconds, 4),
+                          'wall_seconds': round(evaluation['wall_seconds'], 4),
+                          'best': best})
+
+    return curve
+
+
+# Runs one bracket of successive halving. Every candidate is fitted on the
+# smallest budget, the best 1 / eta of them move on to a budget eta times
+# larger and so on until the last rung uses the full budget.
+
+# Parameters:
+#   - pool (SearchPool): the pool evaluating the candidates
+#   - candidates (list): the {model, params} to search
+#   - eta (int): the factor the budget grows and the candidates shrink by
+#   - min_fraction (float): the budget of the first rung (None picks it so
+#                           the candidates halve down to about one)
+#   - resource (str): one of RESOURCES
+#   - scoring (str): 'accuracy' or 'auc'
+#   - bracket (int): the number of this bracket (recorded on evaluations)
+
+# Returns the evaluations of every rung
+
+def successive_halving_bracket(pool : SearchPool, candidates : list, eta : int = 3,
+                               min_fraction : float = None, resource : str = 'both',
+                               scoring : str = 'accuracy', bracket : int = 0):
+    n_rungs = int(math.floor(math.log(len(candidates), eta) + 1e-9)) + 1
+    if min_fraction is None:
+        min_fraction = eta ** -(n_rungs - 1)
+    else:
+        n_rungs = int(round(math.log(1 / min_fraction, eta))) + 1
+
+    evaluations = []
+    survivors = list(range(len(candidates)))
+
+    for rung in range(n_rungs):
+        fraction = min(min_fraction * eta ** rung, 1.0)
+        results = pool.evaluate([candidates[i] for i in survivors], fraction, resource)
+
+        for i, result in zip(survivors, results):
+            evaluations.append({'bracket': bracket, 'rung': rung, 'fraction': fraction,
+                                'candidate': i, **candidates[i], **result})
+
+        if rung < n_rungs - 1:
+            keep = max(len(survivors) // eta, 1)
+            order = np.argsort([-result[scoring] for result in results], kind='stable')
+            survivors = [survivors[i] for i in order[:keep]]
+
+    return evaluations
+
+
+# Returns the summary of a search: the best full-budget candidate, the total
+# CPU and wall-clock seconds, every evaluation and the time-to-accuracy curve
+
+# Parameters:
+#   - method (str): the name of the search
+#   - evaluations (list): the evaluations of the search
+#   - scoring (str): 'accuracy' or 'auc'
+#   - wall_seconds (float): the wall-clock time of the search
+
+def search_summary(method : str, evaluations : list, scoring : str, wall_seconds : float):
+    final = [evaluation for evaluation in evaluations if evaluation['fraction'] >= 1.0]
+    best = max(final, key=lambda evaluation: evaluation[scoring])
+
+    return {
+        'method': method,
+        'best_model': best['model'],
+        'best_params': best['params'],
+        'best_accuracy': best['accuracy'],
+        'best_auc': best['auc'],
+        'evaluations': evaluations,
+        'fits': len(evaluations),
+        'cpu_seconds': round(sum(evaluation['cpu_seconds'] for evaluation in evaluations), 4),
+        'wall_seconds': round(wall_seconds, 4),
+        'curve': time_to_accuracy(evaluations, scoring)
+    }
+
+
+# Hyperparameter search for the second date model on the ratings received.
+# 'grid' fits every candidate on the full budget. 'successive_halving' runs
+# one bracket starting from every candidate on a small budget.
+# 'hyperband' runs brackets from many candidates on a small budget to a
+# few on the full budget, each on a fresh sample of the candidates, which
+# hedges against small budgets ranking the candidates badly.
+
+# Parameters:
+#   - X (array): the ratings received on each date (unused when a pool is
+#                given)
+#   - y (array): the partner's decision on each date (unused when a pool is
+#                given)
+#   - method (str): 'grid', 'successive_halving' or 'hyperband'
+#   - candidates (list): the {model, params} to search (None samples
+#                        n_candidates from candidate_grid())
+#   - n_candidates (int): the candidates per search (or per largest
+#                         Hyperband bracket)
+#   - eta (int): the factor the budget grows by between rungs
+#   - resource (str): one of RESOURCES ('both' shrinks the cost of a fit
+#                     the most, since a forest's fit and predict time grows
+#                     with its trees as well as its rows)
+#   - scoring (str): 'accuracy' or 'auc'
+#   - random_state (int): the seed for the split, samples and models
+#   - max_workers (int): the number of processes
+#   - pool (SearchPool): a pool to reuse (created and closed here if None)
+
+# Returns the summary of the search (see search_summary)
+
+def search(X, y, method : str = 'successive_halving', candidates : list = None,
+           n_candidates : int = 27, eta : int = 3, resource : str = 'both',
+           scoring : str = 'accuracy', random_state : int = 42, max_workers : int = None,
+           pool : SearchPool = None):
+    own_pool = pool is None
+    pool = pool or SearchPool(X, y, random_state=random_state, max_workers=max_workers)
+    grid = candidates if candidates is not None else candidate_grid()
+    start = time.perf_counter()
+
+    # Evaluation times are measured from the start of this search
+    pool.start = start
+
+    try:
+        with span('hyperparameter_search', method=method, resource=resource):
+            if method == 'grid':
+                sampled = sample_candidates(grid, n_candidates, random_state)
+                results = pool.evaluate(sampled, 1.0, resource)
+                evaluations = [{'bracket': 0, 'rung': 0, 'fraction': 1.0, 'candidate': i,
+                                **candidate, **result}
+                               for i, (candidate, result) in enumerate(zip(sampled, results))]
+            elif method == 'successive_halving':
+                evaluations = successive_halving_bracket(
+                    pool, sample_candidates(grid, n_candidates, random_state), eta,
+                    resource=resource, scoring=scoring)
+            elif method == 'hyperband':
+                evaluations = []
+                s_max = int(math.floor(math.log(n_candidates, eta) + 1e-9))
+                for s in range(s_max, -1, -1):
+                    bracket_size = int(math.ceil((s_max + 1) / (s + 1) * eta ** s))
+                    bracket_candidates = sample_candidates(grid, bracket_size, random_state + s)
+                    evaluations.extend(successive_halving_bracket(
+                        pool, bracket_candidates, eta, min_fraction=eta ** -s,
+                        resource=resource, scoring=scoring, bracket=s_max - s))
+            else:
+                raise ValueError("method must be 'grid', 'successive_halving' or 'hyperband'")
+    finally:
+        if own_pool:
+            pool.close()
+
+    return search_summary(method, evaluations, scoring, time.perf_counter() - start)
+
+
+# Runs a full grid, successive halving and Hyperband on the same pool for
+# each gender so their best scores and CPU time can be compared. The grid and
+# successive halving share one sample of candidates; Hyperband samples each
+# bracket's candidates separately.
+
+# Parameters:
+#   - rating_data (dict): ratings per date created by fetch_rating_data
+#   - gender_labels (list): the genders to be included
+#   - methods (tuple): the searches to run
+#   - max_workers (int): the number of processes
+#   - random_state (int): the seed for the split, samples and models
+#   - kwargs: passed to search (e.g. n_candidates, resource)
+
+# Returns a dictionary of {gender: {method: summary}}
+
+def compare_searches(rating_data, gender_labels : list,
+                     methods : tuple = ('grid', 'successive_halving', 'hyperband'),
+                     max_workers : int = None, random_state : int = 42, **kwargs):
+    results = {}
+
+    for i, gender in enumerate(gender_labels):
+        results[gender] = {}
+        with SearchPool(rating_data[i][0], rating_data[i][1], random_state=random_state,
+                        max_workers=max_workers) as pool:
+            for method in methods:
+                results[gender][method] = search(None, None, method, pool=pool,
+                                                 random_state=random_state, **kwargs)
+
+    return results
@@ -0,0 +1,204 @@
+import numpy as np
+
+from speed_dating.analysis_store import GENDER_LABELS
+from speed_dating.query_pool import shared_pool
+from speed_dating.tracing import span
+
+# The attributes participants rated themselves on ({attribute}3_1) and were
+# rated on by their partners ({attribute}_o). Column names cannot be bound
+# as parameters so only these are accepted.
+SELF_RATED_ATTRIBUTES = ('attr', 'sinc', 'intel', 'fun', 'amb')
+
+# The self-rating bands of the self-perception plots, as label to
+# (lower bound, upper bound) with lower <= rating < upper (None for
+# unbounded)
+SELF_RATING_BANDS = {
+    'Self Ratings 0 - 5': (None, 6),
+    'Self Ratings 6 - 10': (6, None)
+}
+
+
+# Checks the attributes are self-rated attributes since they are spliced
+# into the query as column names
+
+# Parameters:
+#   - attributes (list): the attribute base names (e.g. columns_base)
+
+def check_attributes(attributes : list):
+    unknown = [attribute for attribute in attributes if attribute not in SELF_RATED_ATTRIBUTES]
+    if unknown:
+        raise ValueError(f'Unknown attributes {unknown}, expected some of {SELF_RATED_ATTRIBUTES}')
+
+
+# Returns the query computing every participant's self-ratings, average
+# ratings received, successes and dates with one scan of the join, plus a
+# flag for each attribute and band. The band bounds are placeholders so the
+# query text only depends on the attributes and the number of bands, and a
+# pooled connection compiles it once for any bounds.
+
+# Parameters:
+#   - attributes (list): the attribute base names
+#   - n_bands (int): the number of self-rating bands
+
+def self_perception_query(attributes : list, n_bands : int):
+    check_attributes(attributes)
+
+    columns = [f'p.{attribute}3_1 AS self_{attribute}' for attribute in attributes]
+    columns += [f'AVG(d.{attribute}_o) AS received_{attribute}' for attribute in attributes]
+    columns += [f'(p.{attribute}3_1 >= ? AND p.{attribute}3_1 < ?) AS band_{attribute}_{band}'
+                for attribute in attributes for band in range(n_bands)]
+
+    return f'''
+        SELECT p.iid, p.gender, SUM(d.dec_o) AS successes, COUNT(*) AS dates,
+               {', '.join(columns)}
+        FROM participants AS p
+        JOIN dates AS d ON p.iid = d.iid
+        GROUP BY p.iid
+    '''
+
+
+# Returns the bound values of the band placeholders (unbounded ends become
+# infinities)
+
+# Parameters:
+#   - attributes (list): the attribute base names
+#   - bands (dict): band label to (lower, upper)
+
+def band_params(attributes : list, bands : dict):
+    params = []
+
+    for _ in attributes:
+        for lower, upper in bands.values():
+            params.append(float('-inf') if lower is None else float(lower))
+            params.append(float('inf') if upper is None else float(upper))
+
+    return tuple(params)
+
+
+# Reads the per-participant columns of self_perception_query from the
+# in-memory store instead of the database (the same columns, computed with
+# vectorised reductions)
+
+# Parameters:
+#   - store (AnalysisStore): the in-memory store
+#   - attributes (list): the attribute base names
+#   - bands (dict): band label to (lower, upper)
+
+def store_columns(store, attributes : list, bands : dict):
+    check_attributes(attributes)
+
+    stats = store.participant_stats(tuple(f'{attribute}_o' for attribute in attributes))
+    dated = store._dated()
+
+    columns = {'iid': store.iid[dated].astype(float), 'gender': store.gender[dated].astype(float),
+               'successes': stats.successes[dated].astype(float),
+               'dates': stats.count[dated].astype(float)}
+
+    for attribute in attributes:
+        self_rating = store.participants[f'{attribute}3_1'][dated]
+        columns[f'self_{attribute}'] = self_rating
+        columns[f'received_{attribute}'] = stats.average(f'{attribute}_o')[dated]
+
+        for band, (lower, upper) in enumerate(bands.values()):
+            lower = -np.inf if lower is None else lower
+            upper = np.inf if upper is None else upper
+            in_band = (self_rating >= lower) & (self_rating < upper)
+            # NULL self-ratings give a NULL flag in SQL
+            columns[f'band_{attribute}_{band}'] = np.where(np.isnan(self_rating), np.nan,
+                                                           in_band.astype(float))
+
+    return columns
+
+
+# Computes the self-perception gap (self-rating minus the average rating
+# received) and the proportion of successful second dates of every
+# participant for every attribute and self-rating band in one pass, instead
+# of one query per attribute and band with a spliced WHERE clause
+
+# Parameters:
+#   - database_path (str): the path to your database
+#   - attributes (list): the attribute base names (e.g. columns_base)
+#   - bands (dict): band label to (lower, upper) with lower <= rating <
+#                   upper (None for unbounded)
+#   - store (AnalysisStore): the in-memory store to read from instead of
+#                            the database (optional)
+
+# Returns a dictionary keyed by (attribute, band, gender label) of
+# {iid, gap, success_ratio} arrays sorted by gap, the layout of each
+# gender's [x, y] in fetch_attr_diff_data
+
+def self_perception(database_path : str, attributes : list = SELF_RATED_ATTRIBUTES,
+                    bands : dict = None, store = None):
+    attributes = list(attributes)
+    bands = bands or SELF_RATING_BANDS
+
+    with span('self_perception', attributes=len(attributes), bands=len(bands)) as pass_span:
+        if store is None:
+            columns = shared_pool(database_path).fetch_columns(
+                self_perception_query(attributes, len(bands)), band_params(attributes, bands))
+        else:
+            columns = store_columns(store, attributes, bands)
+
+        success_ratio = columns['successes'] / columns['dates']
+        result = {}
+
+        for attribute in attributes:
+            gap = columns[f'self_{attribute}'] - columns[f'received_{attribute}']
+
+            for band, label in enumerate(bands):
+                in_band = columns[f'band_{attribute}_{band}'] == 1
+
+                for gender, gender_label in GENDER_LABELS.items():
+                    rows = np.flatnonzero(in_band & (columns['gender'] == gender))
+                    rows = rows[np.argsort(gap[rows], kind='stable')]
+
+                    result[(attribute, label, gender_label)] = {
+                        'iid': columns['iid'][rows].astype(np.int64),
+                        'gap': gap[rows],
+                        'success_ratio': success_ratio[rows]
+                    }
+
+        pass_span.set(rows_out=len(columns['iid']))
+
+    return result
+
+
+# Returns one attribute and band of a self_perception result in the
+# {gender: [gap, success_ratio]} layout used by create_scatter_traces
+
+# Parameters:
+#   - result (dict): the result of self_perception
+#   - attribute (str): the attribute base name
+#   - band (str): the band label
+
+def by_gender(result : dict, attribute : str, band : str):
+    return {gender_label: [result[(attribute, band, gender_label)]['gap'],
+                           result[(attribute, band, gender_label)]['success_ratio']]
+            for gender_label in GENDER_LABELS.values()}
+
+
+# Returns a summary row per (attribute, band, gender): the participants,
+# mean gap, mean success ratio and the least squares slope of success ratio
+# on gap (how much a point of overestimation changes the success ratio)
+
+# Parameters:
+#   - result (dict): the result of self_perception
+
+def summarise(result : dict):
+    rows = []
+
+    for (attribute, band, gender_label), values in result.items():
+        gap, success_ratio = values['gap'], values['success_ratio']
+        slope = np.polyfit(gap, success_ratio, 1)[0] if len(np.unique(gap)) > 1 else np.nan
+
+        rows.append({
+            'attribute': attribute,
+            'band': band,
+            'gender': gender_label,
+            'participants': len(gap),
+            'mean_gap': float(gap.mean()) if len(gap) else np.nan,
+            'mean_success_ratio': float(success_ratio.mean()) if len(gap) else np.nan,
+            'slope': float(slope)
+        })
+
+    return rows
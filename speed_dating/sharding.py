@@ -0,0 +1,237 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import reduce
+
+import numpy as np
+import pandas as pd
+
+from speed_dating.aggregation import aggregate
+from speed_dating.analysis_store import AnalysisStore
+from speed_dating.fingerprint import file_fingerprint
+from speed_dating.pipeline import notebook_pipeline
+from speed_dating.tracing import span
+
+# The stages of a shard's pipeline, all rerun when a wave is reprocessed
+SHARD_STAGES = ('create_db', 'select_n_neighbors', 'preprocess', 'build_schema', 'build_pairs',
+                'build_summaries')
+
+
+# Splits the .csv into one .csv per wave in a single streamed pass. Values
+# are copied as text so a shard parses exactly like the original. A wave's
+# file is only replaced when its rows change, so the pipelines of the other
+# waves see an unchanged input and skip.
+
+# Parameters:
+#   - csv_file (str): the name of the .csv
+#   - encoding_type (str): the encoding of the csv
+#   - csv_columns (list): the columns to include from the original database
+#   - shard_dir (str): the directory of the shards
+#   - wave_column (str): the column holding the wave
+#   - chunk_size (int): the number of .csv rows read at a time
+
+# Returns a dictionary of {wave: (path of the wave's .csv, whether it changed)}
+
+def partition_by_wave(csv_file : str, encoding_type : str, csv_columns : list, shard_dir : str,
+                      wave_column : str = 'wave', chunk_size : int = 50000):
+    os.makedirs(shard_dir, exist_ok=True)
+
+    usecols = list(dict.fromkeys(list(csv_columns) + [wave_column]))
+    chunks = pd.read_csv(csv_file, encoding=encoding_type, usecols=usecols, dtype=str,
+                         keep_default_na=False, chunksize=chunk_size)
+
+    files = {}
+
+    try:
+        for chunk in chunks:
+            if (chunk[wave_column] == '').any():
+                raise ValueError(f'Every row must have a {wave_column}')
+
+            for wave, rows in chunk.groupby(chunk[wave_column].astype(float).astype(int)):
+                if wave not in files:
+                    path = os.path.join(shard_dir, f'wave_{wave}.csv')
+                    files[wave] = open(f'{path}.partial', 'w', encoding=encoding_type, newline='')
+                    rows[csv_columns].to_csv(files[wave], index=False)
+                else:
+                    rows[csv_columns].to_csv(files[wave], index=False, header=False)
+    finally:
+        for file in files.values():
+            file.close()
+
+    shards = {}
+    for wave in sorted(files):
+        path = os.path.join(shard_dir, f'wave_{wave}.csv')
+
+        changed = (not os.path.exists(path)
+                   or file_fingerprint(path) != file_fingerprint(f'{path}.partial'))
+        if changed:
+            os.replace(f'{path}.partial', path)
+        else:
+            os.remove(f'{path}.partial')
+
+        shards[wave] = (path, changed)
+
+    return shards
+
+
+# Returns the mergeable partial statistics of one shard: per participant
+# and per gender (counts, sums through the means, M2 and successes of the
+# ratings received) and per gender and self-rating of attractiveness
+# (dates and successes)
+
+# Parameters:
+#   - store (AnalysisStore): the in-memory store of the shard
+#   - columns_o (list): list of attributes ending in _o (ratings received)
+
+def shard_partials(store, columns_o : list):
+    values = {column: store.dates[column] for column in columns_o}
+
+    return {
+        'participants': store.participant_stats(tuple(columns_o)),
+        'genders': aggregate({'gender': store.date_gender}, values, store.dates['dec_o']),
+        'self_ratings': aggregate({'gender': store.date_gender,
+                                   'attr3_1': store.participants['attr3_1'][store.date_participant]},
+                                  {}, store.dates['dec_o'])
+    }
+
+
+# Merges the partial statistics of every shard exactly with Chan's formula
+
+# Parameters:
+#   - partials (list): the shard_partials of each shard
+
+# Returns a dictionary of {name: GroupStats}
+
+def merge_partials(partials : list):
+    return {name: reduce(lambda merged, part: merged.merge(part), [p[name] for p in partials])
+            for name in partials[0]}
+
+
+# Runs the pipeline of one wave (ingest, cleaning, imputation and the
+# tables) on its own database and computes its partial statistics. Runs in
+# a worker process.
+
+# Parameters:
+#   - wave (int): the wave
+#   - csv_file (str): the wave's .csv
+#   - database_path (str): the wave's .db
+#   - settings (dict): the arguments of notebook_pipeline shared by every
+#                      shard
+#   - force (bool): whether to rerun every stage even if unchanged
+
+# Returns a dictionary of {wave, report, n_neighbors, partials}
+
+def run_shard(wave : int, csv_file : str, database_path : str, settings : dict,
+              force : bool = False):
+    pipeline = notebook_pipeline(csv_file, database_path, n_jobs=1, **settings)
+    report = pipeline.run(force=SHARD_STAGES if force else ())
+
+    return {
+        'wave': wave,
+        'report': report,
+        'n_neighbors': pipeline.result('select_n_neighbors')['n_neighbors'],
+        'partials': shard_partials(AnalysisStore.from_database(database_path),
+                                   settings['columns_o'])
+    }
+
+
+# Reads the partial statistics of a shard without running its pipeline
+
+# Parameters:
+#   - database_path (str): the wave's .db
+#   - columns_o (list): list of attributes ending in _o (ratings received)
+
+def read_shard(database_path : str, columns_o : list):
+    return shard_partials(AnalysisStore.from_database(database_path), columns_o)
+
+
+# Sharded execution of the data preparation. Dates never cross waves, so
+# the .csv is partitioned by wave and each wave is ingested, cleaned,
+# imputed and aggregated on its own database in a separate process. Each
+# shard's pipeline skips the stages whose inputs are unchanged, and the
+# shards' partial statistics are merged exactly into the global figures.
+# Imputation draws its neighbours from the same wave, so imputed values
+# can differ from an unsharded run.
+
+# Parameters:
+#   - csv_file (str): the name of the .csv
+#   - shard_dir (str): the directory of the shards' .csv and .db files
+#   - csv_columns (list): the columns to include from the original database
+#   - columns_o (list): list of attributes ending in _o (ratings received)
+#   - columns_3_1 (list): list of attributes ending in 3_1 (self ratings given)
+#   - columns_pf_o (list): list of attributes in the form
+#                          pf_o_{attribute} (attribute preferences)
+#   - null_no (int): the threshold number of NULL values for row deletion
+#   - encoding_type (str): the encoding of the csv
+#   - waves (list): the waves to reprocess (every stage rerun). The other
+#                   waves are only read. None runs every wave's pipeline,
+#                   which skips the unchanged ones.
+#   - max_workers (int): the number of processes (1 runs in this process)
+
+# Returns the merged {name: GroupStats} of shard_partials and a list of
+# {wave, stage, status, seconds}
+
+def run_sharded(csv_file : str, shard_dir : str, csv_columns : list, columns_o : list,
+                columns_3_1 : list, columns_pf_o : list, null_no : int = 3,
+                encoding_type : str = 'latin', waves : list = None, max_workers : int = None):
+    start = time.perf_counter()
+
+    with span('partition_by_wave'):
+        shards = partition_by_wave(csv_file, encoding_type, csv_columns, shard_dir)
+    reports = [{'wave': None, 'stage': 'partition_by_wave', 'status': 'ran',
+                'seconds': round(time.perf_counter() - start, 4)}]
+
+    unknown = sorted(set(waves or ()) - set(shards))
+    if unknown:
+        raise ValueError(f'Unknown waves {unknown}, expected some of {sorted(shards)}')
+
+    settings = {'csv_columns': csv_columns, 'columns_o': columns_o, 'columns_3_1': columns_3_1,
+                'columns_pf_o': columns_pf_o, 'null_no': null_no, 'encoding_type': encoding_type}
+    database_paths = {wave: os.path.join(shard_dir, f'wave_{wave}.db') for wave in shards}
+    run_waves = sorted(shards) if waves is None else sorted(waves)
+
+    tasks = [(wave, shards[wave][0], database_paths[wave], settings, waves is not None)
+             for wave in run_waves]
+    max_workers = max_workers or min(os.cpu_count() or 1, len(tasks))
+
+    with span('run_shards', shards=len(tasks), workers=max_workers):
+        if max_workers == 1:
+            results = [run_shard(*task) for task in tasks]
+        else:
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                results = list(executor.map(run_shard, *zip(*tasks)))
+
+    partials = {result['wave']: result['partials'] for result in results}
+    for result in results:
+        reports += [{'wave': result['wave'], **stage} for stage in result['report']]
+
+    # The waves not reprocessed are read from their databases
+    for wave in sorted(set(shards) - set(run_waves)):
+        read_start = time.perf_counter()
+        partials[wave] = read_shard(database_paths[wave], columns_o)
+        reports.append({'wave': wave, 'stage': 'read_shard', 'status': 'read',
+                        'seconds': round(time.perf_counter() - read_start, 4)})
+
+    with span('merge_partials', shards=len(partials)):
+        merged = merge_partials([partials[wave] for wave in sorted(partials)])
+
+    return merged, reports
+
+
+# Returns an in-memory store of every shard's participants and dates
+# (iids are unique across waves, so the tables are concatenated)
+
+# Parameters:
+#   - shard_dir (str): the directory of the shards
+
+def store_from_shards(shard_dir : str):
+    stores = [AnalysisStore.from_database(os.path.join(shard_dir, name))
+              for name in sorted(os.listdir(shard_dir))
+              if name.startswith('wave_') and name.endswith('.db')]
+
+    participants = {name: np.concatenate([store.participants[name] for store in stores])
+                    for name in stores[0].participants}
+    dates = {name: np.concatenate([store.dates[name] for store in stores])
+             for name in stores[0].dates}
+
+    return AnalysisStore(participants, dates)
@@ -0,0 +1,281 @@
+import json
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+
+from speed_dating.analysis_store import AnalysisStore, load_columns
+from speed_dating.fingerprint import table_fingerprint
+from speed_dating.tracing import peak_rss_mb
+
+SNAPSHOT_FORMAT = 'speed_dating-snapshot'
+SNAPSHOT_VERSION = 1
+
+# The tables in the snapshot and the order their rows are stored in
+SNAPSHOT_TABLES = {
+    'participants': 'SELECT * FROM participants ORDER BY iid',
+    'dates': 'SELECT * FROM dates WHERE iid IN (SELECT iid FROM participants) '
+             'ORDER BY iid, date_id'
+}
+
+# Integer types from smallest to largest
+INTEGER_TYPES = (np.int8, np.int16, np.int32, np.int64)
+
+
+# Returns the resident set size of this process in megabytes
+# (None where /proc is unavailable)
+
+def current_rss_mb():
+    try:
+        with open('/proc/self/statm') as file:
+            pages = int(file.read().split()[1])
+    except OSError:
+        return None
+
+    return round(pages * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024), 2)
+
+
+# Returns a column with the smallest type that holds it exactly.
+# INTEGER columns without NULL values become the smallest integer type,
+# everything else stays float64 (NaN for NULL).
+
+# Parameters:
+#   - values (array): the column as loaded by load_columns
+#   - declared_type (str): the declared SQLite type of the column
+
+def typed_column(values, declared_type : str):
+    if 'INT' not in declared_type.upper() or np.isnan(values).any():
+        return values
+
+    low, high = (values.min(), values.max()) if len(values) else (0, 0)
+    for integer_type in INTEGER_TYPES:
+        info = np.iinfo(integer_type)
+        if info.min <= low and high <= info.max:
+            return values.astype(integer_type)
+
+    return values
+
+
+# Writes a columnar snapshot of the participants and dates tables: one .npy
+# file per column and a manifest.json describing the columns and the table
+# fingerprints they were written from. The snapshot is written to a
+# temporary directory and swapped in so readers never see a partial one.
+
+# Parameters:
+#   - database_path (str): the path to your database
+#   - snapshot_dir (str): the directory of the snapshot
+
+# Returns the manifest
+
+def write_snapshot(database_path : str, snapshot_dir : str = 'speed_dating.snapshot'):
+    # Connect to database
+    conn = sqlite3.connect(database_path)
+
+    partial_dir = f'{snapshot_dir}.partial'
+    shutil.rmtree(partial_dir, ignore_errors=True)
+
+    manifest = {
+        'format': SNAPSHOT_FORMAT,
+        'version': SNAPSHOT_VERSION,
+        'created': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'tables': {}
+    }
+
+    try:
+        for table, query in SNAPSHOT_TABLES.items():
+            declared = {row[1]: row[2] for row in conn.execute(f'PRAGMA table_info({table})')}
+            columns = load_columns(conn, query)
+
+            os.makedirs(os.path.join(partial_dir, table))
+            manifest['tables'][table] = {
+                'rows': len(columns['iid']),
+                'fingerprint': table_fingerprint(conn, table),
+                'columns': {}
+            }
+
+            for name, values in columns.items():
+                values = typed_column(values, declared[name])
+                file = f'{table}/{name}.npy'
+                np.save(os.path.join(partial_dir, file), values)
+                manifest['tables'][table]['columns'][name] = {'dtype': values.dtype.str,
+                                                              'file': file}
+    finally:
+        # Close the connection
+        conn.close()
+
+    with open(os.path.join(partial_dir, 'manifest.json'), 'w') as file:
+        json.dump(manifest, file, indent=2)
+
+    shutil.rmtree(snapshot_dir, ignore_errors=True)
+    os.replace(partial_dir, snapshot_dir)
+
+    return manifest
+
+
+# Returns the manifest of a snapshot
+
+# Parameters:
+#   - snapshot_dir (str): the directory of the snapshot
+
+def read_manifest(snapshot_dir : str):
+    with open(os.path.join(snapshot_dir, 'manifest.json')) as file:
+        manifest = json.load(file)
+
+    if manifest.get('format') != SNAPSHOT_FORMAT or manifest.get('version') != SNAPSHOT_VERSION:
+        raise ValueError(f'{snapshot_dir} is not a version {SNAPSHOT_VERSION} snapshot')
+
+    return manifest
+
+
+# Memory-maps every column of a snapshot. Nothing is read until a column
+# is used and the arrays share the operating system's page cache, so they
+# are not copied into the process.
+
+# Parameters:
+#   - snapshot_dir (str): the directory of the snapshot
+
+# Returns a dictionary of {table: {column: read-only array}}
+
+def open_snapshot(snapshot_dir : str):
+    manifest = read_manifest(snapshot_dir)
+
+    return {
+        table: {name: np.load(os.path.join(snapshot_dir, column['file']), mmap_mode='r')
+                for name, column in details['columns'].items()}
+        for table, details in manifest['tables'].items()
+    }
+
+
+# Returns whether a snapshot was written from the tables currently in the
+# database
+
+# Parameters:
+#   - snapshot_dir (str): the directory of the snapshot
+#   - database_path (str): the path to your database
+
+def snapshot_is_current(snapshot_dir : str, database_path : str):
+    try:
+        manifest = read_manifest(snapshot_dir)
+    except (OSError, ValueError):
+        return False
+
+    # Connect to database
+    conn = sqlite3.connect(database_path)
+
+    current = all(table_fingerprint(conn, table) == details['fingerprint']
+                  for table, details in manifest['tables'].items())
+
+    # Close the connection
+    conn.close()
+
+    return current
+
+
+# Drops a file's pages from the operating system's page cache so the next
+# read comes from disk (where posix_fadvise is available)
+
+# Parameters:
+#   - path (str): the path of the file
+
+def evict_from_page_cache(path : str):
+    if not hasattr(os, 'posix_fadvise'):
+        return
+
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+# Loads the analysis store from the database or a snapshot, runs the
+# rating and per-participant queries so every column is read and returns
+# the time taken and memory used (run in a fresh process by
+# benchmark_load)
+
+# Parameters:
+#   - source (str): 'sqlite' or 'snapshot'
+#   - path (str): the path of the database or snapshot
+
+def measure_load(source : str, path : str):
+    rss_before = current_rss_mb()
+    start = time.perf_counter()
+
+    if source == 'sqlite':
+        store = AnalysisStore.from_database(path)
+    else:
+        store = AnalysisStore.from_snapshot(path)
+    load_seconds = time.perf_counter() - start
+
+    store.fetch_rating_data(['attr_o', 'sinc_o', 'intel_o', 'fun_o', 'amb_o'])
+    store.fetch_var_attr_data()
+    total_seconds = time.perf_counter() - start
+
+    return {
+        'load_seconds': round(load_seconds, 6),
+        'load_and_query_seconds': round(total_seconds, 6),
+        'rss_increase_mb': (round(current_rss_mb() - rss_before, 2)
+                            if rss_before is not None else None),
+        'peak_rss_mb': peak_rss_mb()
+    }
+
+
+# Compares loading the analysis store from the database and from the
+# snapshot. Each load runs in a fresh process. Cold loads first drop the
+# files from the page cache, warm loads follow a load of the same files.
+
+# Parameters:
+#   - database_path (str): the path to your database
+#   - snapshot_dir (str): the directory of the snapshot
+#   - repeats (int): the loads of each kind (the median is reported)
+
+# Returns a dictionary of {(source, cache): measurements}
+
+def benchmark_load(database_path : str, snapshot_dir : str = 'speed_dating.snapshot',
+                   repeats : int = 3):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = {**os.environ, 'PYTHONPATH': os.pathsep.join(
+        filter(None, [root, os.environ.get('PYTHONPATH')]))}
+
+    files = {
+        'sqlite': [database_path],
+        'snapshot': [os.path.join(snapshot_dir, column['file'])
+                     for details in read_manifest(snapshot_dir)['tables'].values()
+                     for column in details['columns'].values()]
+    }
+    paths = {'sqlite': database_path, 'snapshot': snapshot_dir}
+
+    results = {}
+    for source in ('sqlite', 'snapshot'):
+        for cache in ('cold', 'warm'):
+            runs = []
+            for _ in range(repeats):
+                if cache == 'cold':
+                    for file in files[source]:
+                        evict_from_page_cache(file)
+
+                output = subprocess.run([sys.executable, '-m', 'speed_dating.snapshot', 'measure',
+                                         source, paths[source]],
+                                        capture_output=True, text=True, check=True, env=env)
+                runs.append(json.loads(output.stdout))
+
+            results[(source, cache)] = {
+                name: (float(np.median([run[name] for run in runs]))
+                       if runs[0][name] is not None else None)
+                for name in runs[0]
+            }
+
+    return results
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 4 and sys.argv[1] == 'measure':
+        print(json.dumps(measure_load(sys.argv[2], sys.argv[3])))
+    else:
+        print('usage: python -m speed_dating.snapshot measure sqlite|snapshot PATH')
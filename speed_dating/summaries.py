@@ -0,0 +1,478 @@
+import time
+
+import numpy as np
+import pandas as pd
+
+from speed_dating.imputation import KNNImputationEngine, impute_null_values
+from speed_dating.ingest import COLUMN_MAPPING, column_dtypes
+from speed_dating.pairs import insert_pairs
+from speed_dating.preprocessing import delete_missing_pairs_indexed, null_values_query
+from speed_dating.schema import time_queries
+from speed_dating.self_perception import band_params
+from speed_dating.tracing import connect, span
+
+# The summary tables kept up to date by the triggers
+SUMMARY_TABLES = ('participant_summary', 'self_rating_summary')
+
+
+# Returns the summary columns: the dates and successes, then the non-NULL
+# count, sum and sum of squares of each rating column
+
+# Parameters:
+#   - columns_o (list): list of attributes ending in _o (ratings received)
+
+def summary_columns(columns_o : list):
+    columns = ['dates', 'successes']
+    for column in columns_o:
+        columns += [f'{column}_n', f'{column}_sum', f'{column}_sumsq']
+
+    return columns
+
+
+# Returns the change one dates row makes to each summary column
+
+# Parameters:
+#   - row (str): the trigger row ('NEW' or 'OLD')
+#   - columns_o (list): list of attributes ending in _o (ratings received)
+
+def row_deltas(row : str, columns_o : list):
+    deltas = {'dates': '1', 'successes': f'{row}.dec_o'}
+    for column in columns_o:
+        deltas[f'{column}_n'] = f'({row}.{column} IS NOT NULL)'
+        deltas[f'{column}_sum'] = f'COALESCE({row}.{column}, 0.0)'
+        deltas[f'{column}_sumsq'] = f'COALESCE({row}.{column} * {row}.{column}, 0.0)'
+
+    return deltas
+
+
+# Returns the statements adding (or subtracting) deltas to the
+# self_rating_summary row of a (gender, attr3_1) group, creating the row if
+# needed. attr3_1 can be NULL, which is its own group as in GROUP BY, so the
+# group is matched with IS instead of an upsert on a unique key.
+
+# Parameters:
+#   - gender (str): the SQL expression of the group's gender
+#   - attr3_1 (str): the SQL expression of the group's self-rating
+#   - deltas (dict): summary column to the SQL expression of its change
+#   - sign (str): '+' or '-'
+
+def group_statements(gender : str, attr3_1 : str, deltas : dict, sign : str = '+'):
+    return f'''
+        INSERT INTO self_rating_summary (gender, attr3_1, {', '.join(deltas)})
+        SELECT {gender}, {attr3_1}, {', '.join('0' for _ in deltas)}
+        WHERE {gender} IS NOT NULL AND NOT EXISTS (
+            SELECT 1 FROM self_rating_summary
+            WHERE gender = {gender} AND attr3_1 IS {attr3_1});
+        UPDATE self_rating_summary
+        SET {', '.join(f'{column} = {column} {sign} {delta}' for column, delta in deltas.items())}
+        WHERE gender = {gender} AND attr3_1 IS {attr3_1};
+    '''
+
+
+# Returns the triggers that keep the summaries up to date:
+#   - dates rows add to or subtract from their participant's summary
+#   - changes to a participant's summary are applied to their group
+#   - a participant changing gender or self-rating moves their summary
+#     between groups
+
+# Parameters:
+#   - columns_o (list): list of attributes ending in _o (ratings received)
+
+def summary_triggers(columns_o : list):
+    columns = summary_columns(columns_o)
+    new, old = row_deltas('NEW', columns_o), row_deltas('OLD', columns_o)
+
+    add_new = f'''
+        INSERT INTO participant_summary (iid, {', '.join(columns)})
+        VALUES (NEW.iid, {', '.join(new.values())})
+        ON CONFLICT (iid) DO UPDATE
+        SET {', '.join(f'{column} = {column} + excluded.{column}' for column in columns)};
+    '''
+    subtract_old = f'''
+        UPDATE participant_summary
+        SET {', '.join(f'{column} = {column} - {old[column]}' for column in columns)}
+        WHERE iid = OLD.iid;
+    '''
+
+    # The group of a participant_summary row and of a participants row
+    def group_of(row):
+        return (f'(SELECT gender FROM participants WHERE iid = {row}.iid)',
+                f'(SELECT attr3_1 FROM participants WHERE iid = {row}.iid)')
+
+    def summary_of(row):
+        return {column: f'COALESCE((SELECT {column} FROM participant_summary '
+                        f'WHERE iid = {row}.iid), 0)' for column in columns}
+
+    changes = {column: f'(NEW.{column} - OLD.{column})' for column in columns}
+
+    triggers = {
+        'dates_insert': ('AFTER INSERT ON dates', add_new),
+        'dates_delete': ('AFTER DELETE ON dates', subtract_old),
+        'dates_update': ('AFTER UPDATE ON dates', subtract_old + add_new),
+        'participant_summary_insert': (
+            'AFTER INSERT ON participant_summary',
+            group_statements(*group_of('NEW'), {column: f'NEW.{column}' for column in columns})),
+        'participant_summary_update': (
+            'AFTER UPDATE ON participant_summary',
+            group_statements(*group_of('NEW'), changes)),
+        'participant_summary_delete': (
+            'AFTER DELETE ON participant_summary',
+            group_statements(*group_of('OLD'), {column: f'OLD.{column}' for column in columns},
+                             '-')),
+        'participants_insert': (
+            'AFTER INSERT ON participants',
+            group_statements('NEW.gender', 'NEW.attr3_1', summary_of('NEW'))),
+        'participants_update': (
+            'AFTER UPDATE OF gender, attr3_1 ON participants '
+            'WHEN OLD.gender IS NOT NEW.gender OR OLD.attr3_1 IS NOT NEW.attr3_1',
+            group_statements('OLD.gender', 'OLD.attr3_1', summary_of('OLD'), '-')
+            + group_statements('NEW.gender', 'NEW.attr3_1', summary_of('NEW'))),
+        'participants_delete': (
+            'AFTER DELETE ON participants',
+            group_statements('OLD.gender', 'OLD.attr3_1', summary_of('OLD'), '-'))
+    }
+
+    return {f'trg_{name}': f'CREATE TRIGGER trg_{name} {event} BEGIN {body} END'
+            for name, (event, body) in triggers.items()}
+
+
+# Creates the per-participant and per-(gender, attr3_1) summary tables from
+# the dates and participants tables, then the triggers that keep them up to
+# date as rows are appended
+
+# Parameters:
+#   - cursor (sqlite3.Cursor): a cursor in the open transaction
+#   - columns_o (list): list of attributes ending in _o (ratings received)
+
+def create_summary_tables(cursor, columns_o : list):
+    columns = summary_columns(columns_o)
+
+    triggers = summary_triggers(columns_o)
+
+    # Drop the summary tables and triggers if they exist
+    for trigger in triggers:
+        cursor.execute(f'DROP TRIGGER IF EXISTS {trigger}')
+    for table in SUMMARY_TABLES:
+        cursor.execute(f'DROP TABLE IF EXISTS {table}')
+
+    definitions = ', '.join(
+        f"{column} {'REAL' if column.endswith(('_sum', '_sumsq')) else 'INTEGER'} NOT NULL"
+        for column in columns)
+
+    cursor.execute(f'''
+        CREATE TABLE participant_summary(
+            iid INTEGER PRIMARY KEY,
+            {definitions}
+            ) STRICT
+    ''')
+    cursor.execute(f'''
+        CREATE TABLE self_rating_summary(
+            gender INTEGER NOT NULL,
+            attr3_1 REAL,
+            {definitions}
+            ) STRICT
+    ''')
+    cursor.execute('CREATE INDEX idx_self_rating_summary ON self_rating_summary (gender, attr3_1)')
+
+    aggregates = ['COUNT(*)', 'SUM(d.dec_o)']
+    for column in columns_o:
+        aggregates += [f'COUNT(d.{column})', f'TOTAL(d.{column})',
+                       f'TOTAL(d.{column} * d.{column})']
+
+    cursor.execute(f'''
+        INSERT INTO participant_summary (iid, {', '.join(columns)})
+        SELECT d.iid, {', '.join(aggregates)}
+        FROM dates AS d
+        GROUP BY d.iid
+    ''')
+
+    # The dates of participants missing from participants are left out by
+    # the join, as in the analysis queries
+    cursor.execute(f'''
+        INSERT INTO self_rating_summary (gender, attr3_1, {', '.join(columns)})
+        SELECT p.gender, p.attr3_1, {', '.join(f'SUM(s.{column})' for column in columns)}
+        FROM participant_summary AS s
+        JOIN participants AS p ON p.iid = s.iid
+        GROUP BY p.gender, p.attr3_1
+    ''')
+
+    for trigger in triggers.values():
+        cursor.execute(trigger)
+
+    return cursor.execute('SELECT COUNT(*) FROM participant_summary').fetchone()[0]
+
+
+# Builds the summary tables and their triggers in one transaction
+
+# Parameters:
+#   - database_path (str): the path to your database
+#   - columns_o (list): list of attributes ending in _o (ratings received)
+
+# Returns a list of {stage, seconds, rows}
+
+def build_summaries(database_path : str, columns_o : list):
+    # Connect to database
+    conn = connect(database_path)
+
+    # Create a cursor object
+    cursor = conn.cursor()
+
+    try:
+        cursor.execute('BEGIN')
+
+        stage_start = time.perf_counter()
+        with span('create_summaries') as stage_span:
+            rows = create_summary_tables(cursor, columns_o)
+            stage_span.set(rows_out=rows)
+
+        # Commit the changes
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        # Close the connection
+        conn.close()
+
+    seconds = round(time.perf_counter() - stage_start, 4)
+    print(f'create_summaries: {rows} rows in {seconds} seconds.')
+
+    return [{'stage': 'create_summaries', 'seconds': seconds, 'rows': rows}]
+
+
+# Appends a new .csv of dates (e.g. one night) to a database built by the
+# pipeline without rebuilding it. The rows are added to speed_dating, and
+# only the new rows are cleaned: rows with too many NULL values and rows
+# missing their pair are deleted, and the remaining NULL ratings are imputed
+# with the complete rows as donors. An engine passed in is reused: after its
+# first append it only adds the complete rows appended since as donors
+# rather than refitting on the table. New participants and the dates are then
+# inserted, which updates the summaries through the triggers, and their
+# pairs are added to the pairs table. Both rows of a date must be in the
+# same .csv.
+# The pipeline sees these tables as changed outside it, so its next run
+# rebuilds them from its .csv.
+
+# Parameters:
+#   - csv_file (str): the .csv of the new dates
+#   - database_path (str): the path to your database
+#   - csv_columns (list): the columns to include from the original database
+#   - columns_o (list): list of attributes ending in _o (ratings received)
+#   - columns_3_1 (list): list of attributes ending in 3_1 (self ratings given)
+#   - columns_pf_o (list): list of attributes in the form
+#                          pf_o_{attribute} (attribute preferences)
+#   - null_no (int): the threshold number of NULL values for row deletion
+#   - encoding_type (str): the encoding of the csv
+#   - n_neighbors (int): the number of neighbours used for each imputation
+#   - engine (KNNImputationEngine): the engine of earlier appends to this
+#                                   database with its own n_neighbors,
+#                                   updated in place (None fits a new one on
+#                                   every complete row). A rebuilt database
+#                                   needs a new engine.
+
+# Returns a list of {stage, seconds, rows} for each stage
+
+def append_dates(csv_file : str, database_path : str, csv_columns : list, columns_o : list,
+                 columns_3_1 : list, columns_pf_o : list, null_no : int = 3,
+                 encoding_type : str = 'latin', n_neighbors : int = 5,
+                 engine : KNNImputationEngine = None):
+    table_columns = [COLUMN_MAPPING.get(column, column) for column in csv_columns]
+
+    # Connect to database
+    conn = connect(database_path)
+
+    # Create a cursor object
+    cursor = conn.cursor()
+
+    report = []
+
+    # Times a stage and records how many rows it affected
+    def run_stage(name, stage, *args):
+        stage_start = time.perf_counter()
+        with span(name) as stage_span:
+            rows = stage(*args)
+            stage_span.set(rows_out=rows)
+        report.append({
+            'stage': name,
+            'seconds': round(time.perf_counter() - stage_start, 4),
+            'rows': rows
+        })
+
+    def insert_rows():
+        chunk = pd.read_csv(csv_file, encoding=encoding_type, usecols=csv_columns,
+                            dtype=column_dtypes(csv_columns))
+        chunk = chunk[csv_columns].astype(object)
+        chunk = chunk.where(chunk.notna(), None)
+
+        cursor.executemany(
+            f'INSERT INTO speed_dating ({", ".join(table_columns)}) '
+            f'VALUES ({", ".join(["?"] * len(table_columns))})',
+            chunk.itertuples(index=False, name=None))
+        return len(chunk)
+
+    def delete_null_rows():
+        cursor.execute(*null_values_query([columns_o, columns_3_1, columns_pf_o], null_no,
+                                          last_rowid))
+        return cursor.rowcount
+
+    def insert_participants():
+        cursor.execute(f'''
+            INSERT INTO participants (iid, gender, {', '.join(columns_3_1)})
+            SELECT DISTINCT iid, gender, {', '.join(columns_3_1)}
+            FROM speed_dating
+            WHERE rowid > ? AND iid NOT IN (SELECT iid FROM participants)
+        ''', (last_rowid,))
+        rows = cursor.rowcount
+
+        # The preferences of each participant are recorded on the rows where
+        # they are the pid
+        cursor.execute(f'''
+            UPDATE participants
+            SET {', '.join(f'{attr} = s.{attr}' for attr in columns_pf_o)}
+            FROM
+                speed_dating AS s
+            WHERE
+                participants.iid = s.pid AND s.rowid > ?
+        ''', (last_rowid,))
+        return rows
+
+    def insert_dates():
+        cursor.execute(f'''
+            INSERT INTO dates (iid, date_id, pid, match, dec_o, {', '.join(columns_o)})
+            SELECT iid, ? + ROW_NUMBER() OVER (ORDER BY rowid), pid, match, dec_o,
+                   {', '.join(columns_o)}
+            FROM speed_dating
+            WHERE rowid > ?
+            ORDER BY iid, rowid
+        ''', (last_date_id, last_rowid))
+        return cursor.rowcount
+
+    try:
+        cursor.execute('BEGIN')
+
+        last_rowid = cursor.execute('SELECT COALESCE(MAX(rowid), 0) FROM speed_dating').fetchone()[0]
+        last_date_id = cursor.execute('SELECT COALESCE(MAX(date_id), 0) FROM dates').fetchone()[0]
+        has_pairs = cursor.execute("SELECT COUNT(*) FROM sqlite_master "
+                                   "WHERE type = 'table' AND name = 'pairs'").fetchone()[0]
+
+        run_stage('insert_rows', insert_rows)
+        run_stage('delete_null_values', delete_null_rows)
+        run_stage('delete_missing_pairs', delete_missing_pairs_indexed, cursor, last_rowid)
+        run_stage('data_imputation',
+                  lambda: impute_null_values(cursor, columns_o, n_neighbors, engine)[0])
+        run_stage('insert_participants', insert_participants)
+        run_stage('insert_dates', insert_dates)
+        if has_pairs:
+            run_stage('insert_pairs', insert_pairs, cursor, columns_o, last_date_id)
+
+        # Commit the changes
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        # Close the connection
+        conn.close()
+
+    for stage in report:
+        print(f"{stage['stage']}: {stage['rows']} rows in {stage['seconds']} seconds.")
+
+    return report
+
+
+# Returns the SQL and bound values of each aggregate analysis query reading
+# the summaries instead of grouping the dates, with the same output as
+# analysis_queries. Each reads one row per participant or group, however
+# many dates there are. The self-rating band of fetch_attr_diff_data is
+# bound as placeholders like self_perception_query, so no condition is
+# spliced into the SQL.
+
+# Parameters:
+#   - band (tuple): the (lower, upper) self-rating of attractiveness of
+#                   fetch_attr_diff_data with lower <= attr3_1 < upper
+#                   (None for unbounded)
+
+# Returns a dictionary of {name: (query, params)}
+
+def summary_queries(band : tuple = (6, None)):
+    return {
+        'fetch_avg_attr_data': ('''
+            SELECT p.gender, s.attr_o_sum / s.attr_o_n, ((s.successes * 1.0) / s.dates) * 100
+            FROM participant_summary AS s
+            JOIN participants AS p ON p.iid = s.iid
+            WHERE s.dates > 0
+            ORDER BY p.gender, s.iid
+        ''', ()),
+        'fetch_avg_self_attr_data': ('''
+            SELECT gender, attr3_1, (successes * 1.0) / dates
+            FROM self_rating_summary
+            WHERE dates > 0
+            ORDER BY gender, attr3_1
+        ''', ()),
+        'fetch_self_attr_data': ('''
+            SELECT p.gender, p.attr3_1, (s.successes * 1.0) / s.dates
+            FROM participant_summary AS s
+            JOIN participants AS p ON p.iid = s.iid
+            WHERE s.dates > 0
+            ORDER BY p.gender, p.attr3_1, s.iid
+        ''', ()),
+        'fetch_attr_diff_data': ('''
+            SELECT p.gender, p.attr3_1 - s.attr_o_sum / s.attr_o_n, (s.successes * 1.0) / s.dates
+            FROM participant_summary AS s
+            JOIN participants AS p ON p.iid = s.iid
+            WHERE s.dates > 0 AND p.attr3_1 >= ? AND p.attr3_1 < ?
+            ORDER BY p.gender, p.attr3_1 - s.attr_o_sum / s.attr_o_n, s.iid
+        ''', band_params(['attr'], {'band': band})),
+        # The population variance from the sums (clipped at 0 for rounding)
+        'fetch_var_attr_data': ('''
+            SELECT p.gender,
+                MAX(s.attr_o_sumsq / s.attr_o_n - (s.attr_o_sum / s.attr_o_n) * (s.attr_o_sum / s.attr_o_n), 0.0)
+            FROM participant_summary AS s
+            JOIN participants AS p ON p.iid = s.iid
+            WHERE s.dates > 0
+            ORDER BY p.gender, s.iid
+        ''', ())
+    }
+
+
+# Compares each summary query with the analysis query it replaces: the best
+# time of each and whether their rows agree (sorted, as the analysis queries
+# only order by gender)
+
+# Parameters:
+#   - database_path (str): the path to your database
+#   - queries (dict): query name to the SQL of the analysis query, e.g. from
+#                     analysis_queries (with the default attr3_1 >= 6, the
+#                     band of summary_queries)
+#   - repeats (int): the number of runs per query
+
+# Returns a dictionary of {name: {'group_by': seconds, 'summary': seconds,
+# 'identical': bool}}
+
+def compare_summaries(database_path : str, queries : dict, repeats : int = 5):
+    summaries = {name: query for name, query in summary_queries().items() if name in queries}
+    queries = {name: queries[name] for name in summaries}
+
+    group_by_times = time_queries(database_path, queries, repeats)
+    summary_times = time_queries(database_path, summaries, repeats)
+
+    conn = connect(database_path)
+
+    comparison = {}
+    for name in summaries:
+        rows = []
+        for query, params in ((queries[name], ()), summaries[name]):
+            values = np.array(conn.execute(query, params).fetchall(), dtype=float)
+            # Rounded so sums in a different order do not change the order
+            rows.append(values[np.lexsort(np.round(values, 9).T[::-1])])
+        comparison[name] = {
+            'group_by': group_by_times[name],
+            'summary': summary_times[name],
+            'identical': rows[0].shape == rows[1].shape
+                         and bool(np.allclose(rows[0], rows[1], equal_nan=True))
+        }
+
+    # Close the connection
+    conn.close()
+
+    return comparison
@@ -0,0 +1,443 @@
+import json
+import re
+import sqlite3
+import threading
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:  # resource is not available on Windows
+    resource = None
+
+# The number of SQLite virtual machine instructions between progress callbacks
+PROGRESS_STEPS = 1000
+
+# The literals sqlite3 expands the parameters of a statement into before
+# passing it to the trace callback: strings, numbers and NULL values (not
+# IS NULL conditions)
+LITERALS = re.compile(r"'(?:[^']|'')*'|(?<![\w.])-?\d+(?:\.\d*)?(?:[eE][-+]?\d+)?\b|"
+                      r"(?<!IS )(?<!NOT )\bNULL\b")
+
+
+# Returns the peak resident set size of this process in megabytes
+# (None where the resource module is unavailable)
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+
+    # ru_maxrss is reported in kilobytes on Linux
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 2)
+
+
+# The state of the tracer. Spans are only recorded while enabled is True,
+# otherwise span() returns a shared no-op span and connect() adds no
+# callbacks, so leaving the instrumentation in place costs one attribute
+# lookup per call.
+
+class Tracer:
+
+    def __init__(self):
+        self.enabled = False
+        self.memory = False
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        # The instrumented connections by id, cleared by disable_tracing
+        self.connections = {}
+        self.reset()
+
+    # Clears the recorded spans
+
+    def reset(self):
+        self.origin = time.perf_counter()
+        self.spans = []
+        self.next_id = 0
+        self.statements = {}
+
+    # Returns the next span id
+
+    def new_id(self):
+        with self.lock:
+            self.next_id += 1
+            return self.next_id
+
+    # Returns the stack of open spans of the current thread
+
+    def stack(self):
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    # Records a finished span
+
+    # Parameters:
+    #   - record (dict): the span
+
+    def record(self, record : dict):
+        with self.lock:
+            self.spans.append(record)
+
+
+TRACER = Tracer()
+
+
+# A span that does nothing, returned by span() while tracing is off
+
+class NullSpan:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def set(self, **attributes):
+        pass
+
+
+NULL_SPAN = NullSpan()
+
+
+# A timed section of code. Spans opened inside it on the same thread become
+# its children. When memory tracing is on the span records the peak memory
+# allocated by Python while it was open.
+
+# Parameters:
+#   - name (str): the name of the span
+#   - category (str): e.g. 'stage' or 'sql'
+#   - attributes (dict): extra values to record such as rows_in and rows_out
+
+class Span:
+
+    def __init__(self, name : str, category : str, attributes : dict):
+        self.name = name
+        self.category = category
+        self.attributes = attributes
+        self.peak = 0
+
+    def __enter__(self):
+        stack = TRACER.stack()
+        self.id = TRACER.new_id()
+        close_statements(threading.get_ident(), time.perf_counter())
+        self.parent = stack[-1] if stack else None
+
+        if TRACER.memory and tracemalloc.is_tracing():
+            # Carry the peak so far to the open spans before resetting it
+            current, peak = tracemalloc.get_traced_memory()
+            for open_span in stack:
+                open_span.peak = max(open_span.peak, peak)
+            self.memory_start = current
+            tracemalloc.reset_peak()
+
+        stack.append(self)
+        self.start = time.perf_counter()
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        end = time.perf_counter()
+        TRACER.stack().pop()
+        close_statements(threading.get_ident(), end)
+
+        record = {
+            'id': self.id,
+            'parent': self.parent.id if self.parent is not None else None,
+            'name': self.name,
+            'category': self.category,
+            'thread': threading.get_ident(),
+            'start': round(self.start - TRACER.origin, 6),
+            'seconds': round(end - self.start, 6),
+            'peak_rss_mb': peak_rss_mb(),
+            **self.attributes
+        }
+
+        if TRACER.memory and tracemalloc.is_tracing():
+            self.peak = max(self.peak, tracemalloc.get_traced_memory()[1])
+            record['peak_mb'] = round((self.peak - self.memory_start) / (1024 * 1024), 3)
+            if self.parent is not None:
+                self.parent.peak = max(self.parent.peak, self.peak)
+
+        if exc_type is not None:
+            record['error'] = exc_type.__name__
+
+        TRACER.record(record)
+
+        return False
+
+    # Adds attributes to the span (e.g. rows_out once they are known)
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+
+# Returns a span to use in a with block
+
+# Parameters:
+#   - name (str): the name of the span
+#   - category (str): e.g. 'stage' or 'sql'
+#   - attributes: extra values to record such as rows_in and rows_out
+
+def span(name : str, category : str = 'stage', **attributes):
+    if not TRACER.enabled:
+        return NULL_SPAN
+
+    return Span(name, category, attributes)
+
+
+# Starts recording spans, clearing any recorded before
+
+# Parameters:
+#   - memory (bool): whether to record the peak memory of each span with
+#                    tracemalloc (this slows allocation-heavy code)
+
+def enable_tracing(memory : bool = False):
+    TRACER.reset()
+    TRACER.memory = memory
+
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+    TRACER.enabled = True
+
+
+# Stops recording spans
+
+# Returns the recorded spans ordered by start time
+
+def disable_tracing():
+    TRACER.enabled = False
+    close_statements(None, time.perf_counter())
+
+    # Remove the callbacks so pooled connections stop paying for them
+    with TRACER.lock:
+        connections = list(TRACER.connections.values())
+        TRACER.connections.clear()
+
+    for conn in connections:
+        try:
+            conn.set_trace_callback(None)
+            conn.set_progress_handler(None, 0)
+        except sqlite3.ProgrammingError:  # closed or owned by another thread
+            pass
+
+    if TRACER.memory and tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+    return recorded_spans()
+
+
+# Returns the recorded spans ordered by start time
+
+def recorded_spans():
+    with TRACER.lock:
+        return sorted(TRACER.spans, key=lambda record: (record['start'], record['id']))
+
+
+# Ends the open SQL statement of a thread (or of every thread when thread
+# is None). A statement ends at the next statement or span boundary on its
+# thread, so its time includes fetching its rows.
+
+# Parameters:
+#   - thread (int): the ident of the thread
+#   - end (float): the perf_counter time the statement ended
+
+def close_statements(thread, end : float):
+    with TRACER.lock:
+        threads = list(TRACER.statements) if thread is None else [thread]
+        statements = [TRACER.statements.pop(key) for key in threads if key in TRACER.statements]
+
+    for statement in statements:
+        start = statement.pop('perf_start')
+        statement['seconds'] = round(end - start, 6)
+        statement['vm_steps'] = statement.pop('progress_calls') * PROGRESS_STEPS
+        TRACER.record(statement)
+
+
+# Returns the name of a statement's span: the statement on one line with its
+# literals replaced by ?, so runs with different parameters share a name
+
+# Parameters:
+#   - statement (str): the statement passed to the trace callback
+
+def statement_name(statement : str):
+    return LITERALS.sub('?', ' '.join(statement.split()))[:200]
+
+
+# Records every statement run on a connection as an 'sql' span using the
+# sqlite3 trace callback, and counts the virtual machine instructions each
+# one runs with the progress handler. Repeats of the same statement in a
+# row (e.g. from executemany) are recorded as one span with a call count.
+
+# Parameters:
+#   - conn (sqlite3.Connection): the connection to trace
+
+def trace_connection(conn):
+
+    def on_statement(statement):
+        if not TRACER.enabled:
+            return
+
+        now = time.perf_counter()
+        thread = threading.get_ident()
+        stack = TRACER.stack()
+        parent = stack[-1].id if stack else None
+        name = statement_name(statement)
+
+        current = TRACER.statements.get(thread)
+        if current is not None and current['name'] == name and current['parent'] == parent:
+            current['calls'] += 1
+            return
+
+        close_statements(thread, now)
+
+        record = {
+            'id': TRACER.new_id(),
+            'parent': parent,
+            'name': name,
+            'category': 'sql',
+            'thread': thread,
+            'start': round(now - TRACER.origin, 6),
+            'calls': 1,
+            'perf_start': now,
+            'progress_calls': 0
+        }
+
+        with TRACER.lock:
+            TRACER.statements[thread] = record
+
+    def on_progress():
+        statement = TRACER.statements.get(threading.get_ident())
+        if statement is not None:
+            statement['progress_calls'] += 1
+        return 0
+
+    conn.set_trace_callback(on_statement)
+    conn.set_progress_handler(on_progress, PROGRESS_STEPS)
+
+    with TRACER.lock:
+        TRACER.connections[id(conn)] = conn
+
+    return conn
+
+
+# A connection that ends its thread's open statement when it is closed so
+# the work done after closing it is not counted as SQL
+
+class TracedConnection(sqlite3.Connection):
+
+    def close(self):
+        close_statements(threading.get_ident(), time.perf_counter())
+        super().close()
+
+
+# Opens a connection that is traced while tracing is enabled
+
+# Parameters:
+#   - database_path (str): the path to your database
+#   - kwargs: passed to sqlite3.connect
+
+def connect(database_path : str, **kwargs):
+    if not TRACER.enabled:
+        return sqlite3.connect(database_path, **kwargs)
+
+    return trace_connection(sqlite3.connect(database_path, factory=TracedConnection, **kwargs))
+
+
+# Returns the time of each span not spent in its children
+
+# Parameters:
+#   - spans (list): the recorded spans
+
+def self_seconds(spans : list):
+    remaining = {record['id']: record['seconds'] for record in spans}
+
+    for record in spans:
+        if record['parent'] in remaining:
+            remaining[record['parent']] -= record['seconds']
+
+    return {span_id: max(seconds, 0.0) for span_id, seconds in remaining.items()}
+
+
+# Returns the total and self time, calls, rows and peak memory of each span
+# name, slowest self time first
+
+# Parameters:
+#   - spans (list): the recorded spans
+
+def summarise_spans(spans : list):
+    own = self_seconds(spans)
+    summary = {}
+
+    for record in spans:
+        entry = summary.setdefault(record['name'], {
+            'name': record['name'], 'category': record['category'], 'calls': 0,
+            'seconds': 0.0, 'self_seconds': 0.0, 'rows_out': None, 'peak_mb': None
+        })
+        entry['calls'] += record.get('calls', 1)
+        entry['seconds'] += record['seconds']
+        entry['self_seconds'] += own[record['id']]
+
+        for name in ('rows_out', 'peak_mb'):
+            if record.get(name) is not None:
+                entry[name] = max(entry[name] or 0, record[name])
+
+    for entry in summary.values():
+        entry['seconds'] = round(entry['seconds'], 6)
+        entry['self_seconds'] = round(entry['self_seconds'], 6)
+
+    return sorted(summary.values(), key=lambda entry: entry['self_seconds'], reverse=True)
+
+
+# Writes the spans as JSON in the Chrome trace event format, which can be
+# opened in chrome://tracing, Perfetto or speedscope. Each span's fields are
+# kept in its args.
+
+# Parameters:
+#   - spans (list): the recorded spans
+#   - path (str): the path of the .json
+
+def export_json(spans : list, path : str = 'trace.json'):
+    events = [{
+        'name': record['name'],
+        'cat': record['category'],
+        'ph': 'X',
+        'ts': round(record['start'] * 1e6, 3),
+        'dur': round(record['seconds'] * 1e6, 3),
+        'pid': 1,
+        'tid': record['thread'],
+        'args': {name: value for name, value in record.items()
+                 if name not in ('name', 'category', 'start', 'seconds', 'thread')}
+    } for record in spans]
+
+    with open(path, 'w') as file:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, file)
+
+
+# Writes the spans as folded stacks ("outer;inner;sql self_microseconds"),
+# the input format of flamegraph.pl, inferno and speedscope
+
+# Parameters:
+#   - spans (list): the recorded spans
+#   - path (str): the path of the folded stacks
+
+def export_folded(spans : list, path : str = 'trace.folded'):
+    by_id = {record['id']: record for record in spans}
+    own = self_seconds(spans)
+    stacks = {}
+
+    for record in spans:
+        frames = []
+        current = record
+        while current is not None:
+            frames.append(current['name'].replace(';', ',').replace('\n', ' '))
+            current = by_id.get(current['parent'])
+
+        stack = ';'.join(reversed(frames))
+        stacks[stack] = stacks.get(stack, 0) + own[record['id']]
+
+    with open(path, 'w') as file:
+        for stack, seconds in stacks.items():
+            microseconds = int(round(seconds * 1e6))
+            if microseconds > 0:
+                file.write(f'{stack} {microseconds}\n')
@@ -0,0 +1,204 @@
+import hashlib
+import json
+import os
+import pickle
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from sklearn.ensemble import RandomForestRegressor
+from sklearn.metrics import mean_squared_error, accuracy_score
+from sklearn.model_selection import train_test_split
+
+from speed_dating.tracing import span
+
+# Where fitted models are cached between notebook runs
+MODEL_CACHE_DIR = '.model_cache'
+
+
+# Returns a content hash of a training matrix, its target and the
+# parameters used to fit it
+
+# Parameters:
+#   - X (array): the feature matrix
+#   - y (array): the target values
+#   - params (dict): the split and model parameters
+
+def content_hash(X, y, params : dict):
+    X = np.ascontiguousarray(X, dtype=np.float64)
+    y = np.ascontiguousarray(y, dtype=np.float64)
+
+    digest = hashlib.sha256()
+    digest.update(str(X.shape).encode())
+    digest.update(X.tobytes())
+    digest.update(y.tobytes())
+    digest.update(json.dumps(params, sort_keys=True).encode())
+
+    return digest.hexdigest()
+
+
+# Fits (or reuses) the random forest for one gender.
+# The model is cached on disk under a hash of the data and every parameter
+# except n_estimators. A cached forest with fewer trees is grown with
+# warm_start and one with more trees is truncated (the first trees of a
+# forest do not depend on how many trees follow them).
+
+# Parameters:
+#   - X (array): the ratings received on each date
+#   - y (array): the partner's decision on each date
+#   - n_estimators (int): the number of trees
+#   - random_state (int): the seed for the split and the forest
+#   - cache_dir (str): the directory of cached models (None disables caching)
+#   - n_jobs (int): the number of cores used by the forest
+
+# Returns the model, the train/test split (X_train, X_test, y_train, y_test)
+# and a dictionary of the fit time and cache details
+
+def fit_model(X, y, n_estimators : int = 200, random_state : int = 42,
+              cache_dir : str = MODEL_CACHE_DIR, n_jobs : int = 1):
+    X = np.asarray(X, dtype=float)
+    y = np.asarray(y, dtype=float)
+
+    # Split data into training and test data
+    split = train_test_split(X, y, test_size=0.2, random_state=random_state)
+    X_train, X_test, y_train, y_test = split
+
+    params = {'model': 'RandomForestRegressor', 'test_size': 0.2,
+              'random_state': random_state}
+    model_path = None
+    model = None
+    cache = 'disabled'
+
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        model_path = os.path.join(cache_dir, f'{content_hash(X, y, params)}.pkl')
+        cache = 'miss'
+
+        if os.path.exists(model_path):
+            with open(model_path, 'rb') as file:
+                model = pickle.load(file)
+
+    fit_start = time.perf_counter()
+
+    if model is None:
+        model = RandomForestRegressor(n_estimators=n_estimators,
+                                      random_state=random_state, n_jobs=n_jobs)
+        model.fit(X_train, y_train)
+    elif len(model.estimators_) < n_estimators:
+        # Grow the cached forest with the extra trees only
+        model.set_params(warm_start=True, n_estimators=n_estimators, n_jobs=n_jobs)
+        model.fit(X_train, y_train)
+        cache = 'warm_start'
+    else:
+        # Use the first n_estimators trees of the cached forest
+        if len(model.estimators_) > n_estimators:
+            model = pickle.loads(pickle.dumps(model))
+            model.estimators_ = model.estimators_[:n_estimators]
+        model.set_params(n_estimators=n_estimators, n_jobs=n_jobs)
+        cache = 'hit'
+
+    fit_seconds = time.perf_counter() - fit_start
+
+    # Only write the cache when the stored forest has changed
+    if model_path is not None and cache in ('miss', 'warm_start'):
+        with open(model_path, 'wb') as file:
+            pickle.dump(model, file)
+
+    report = {
+        'fit_seconds': round(fit_seconds, 4),
+        'cache': cache,
+        'model_path': model_path
+    }
+
+    return model, split, report
+
+
+# Fits (or reuses) the random forest for one gender and evaluates it
+# (see fit_model for the caching)
+
+# Parameters:
+#   - X (array): the ratings received on each date
+#   - y (array): the partner's decision on each date
+#   - n_estimators (int): the number of trees
+#   - random_state (int): the seed for the split and the forest
+#   - cache_dir (str): the directory of cached models (None disables caching)
+#   - n_jobs (int): the number of cores used by the forest
+
+# Returns the mean squared error, accuracy, feature importances and a
+# dictionary of timings and cache details
+
+def fit_and_evaluate(X, y, n_estimators : int = 200, random_state : int = 42,
+                     cache_dir : str = MODEL_CACHE_DIR, n_jobs : int = 1):
+    model, (_, X_test, _, y_test), fit_report = fit_model(X, y, n_estimators, random_state,
+                                                          cache_dir, n_jobs)
+
+    # Predict on the test data
+    predict_start = time.perf_counter()
+    y_pred = model.predict(X_test)
+    predict_seconds = time.perf_counter() - predict_start
+
+    # Get the feature importances from the random forest model
+    importance_start = time.perf_counter()
+    feature_importance = model.feature_importances_.tolist()
+    importance_seconds = time.perf_counter() - importance_start
+
+    # Convert the continuous predictions to binary class labels
+    y_pred_binary = (y_pred > 0.5).astype(int)
+
+    report = {
+        'fit_seconds': fit_report['fit_seconds'],
+        'predict_seconds': round(predict_seconds, 4),
+        'importance_seconds': round(importance_seconds, 4),
+        'cache': fit_report['cache'],
+        'model_path': fit_report['model_path']
+    }
+
+    return (mean_squared_error(y_test, y_pred), accuracy_score(y_test, y_pred_binary),
+            feature_importance, report)
+
+
+# Returns the feature importances on second date success based on rating data.
+# The per-gender models are fitted in parallel processes and cached on disk.
+
+# Parameters:
+#   - rating_data (dict): ratings per date created by fetch_rating_data
+#   - gender_labels (list): the genders to be included
+#   - n_estimators (int): the number of trees per forest
+#   - random_state (int): the seed for the split and the forests
+#   - cache_dir (str): the directory of cached models (None disables caching)
+#   - max_workers (int): the number of processes (None uses one per gender)
+
+# Returns the same mean squared errors, accuracies and feature importances as
+# train_and_evaluate plus the timings and cache details for each gender
+
+def train_and_evaluate_parallel(rating_data, gender_labels : list, n_estimators : int = 200,
+                                random_state : int = 42, cache_dir : str = MODEL_CACHE_DIR,
+                                max_workers : int = None):
+    max_workers = max_workers or len(gender_labels)
+
+    jobs = [(rating_data[i][0], rating_data[i][1], n_estimators, random_state, cache_dir)
+            for i in range(len(gender_labels))]
+
+    with span('train_and_evaluate', rows_in=sum(len(job[1]) for job in jobs),
+              workers=max_workers) as training_span:
+        if max_workers == 1:
+            results = [fit_and_evaluate(*job) for job in jobs]
+        else:
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                results = list(executor.map(fit_and_evaluate, *zip(*jobs)))
+
+        # The fits run in other processes so their timings are attached here
+        training_span.set(fits={gender: result[3] for gender, result in zip(gender_labels, results)})
+
+    mse = []
+    accuracies = []
+    feature_importances = {}
+    reports = {}
+
+    for gender, (error, accuracy, feature_importance, report) in zip(gender_labels, results):
+        mse.append(error)
+        accuracies.append(accuracy)
+        feature_importances[gender] = feature_importance
+        reports[gender] = report
+
+    return mse, accuracies, feature_importances, reports
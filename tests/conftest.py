@@ -0,0 +1,34 @@
+import pytest
+
+from speed_dating.benchmark import COLUMNS_3_1, COLUMNS_O, COLUMNS_PF_O, CSV_COLUMNS, generate_csv
+from speed_dating.ingest import create_db_streaming
+from speed_dating.preprocessing import preprocess
+from speed_dating.schema import build_schema
+
+# NULL rates of the synthetic data, with more missing self-ratings than the
+# benchmark so every gender has a NULL attr3_1 group
+NULL_RATES = {'_o': 0.02, '3_1': 0.05, 'pf_o': 0.01}
+
+
+# Writes a synthetic .csv whose attr3_1 has NULL values (only the _o columns
+# are imputed, so they reach the tables)
+
+@pytest.fixture(scope='session')
+def analysis_csv(tmp_path_factory):
+    csv_file = str(tmp_path_factory.mktemp('csv') / 'speed_dating.csv')
+    generate_csv(csv_file, 3_000, null_rates=NULL_RATES, seed=2)
+
+    return csv_file
+
+
+# Builds a cleaned database with the pipeline's tables from the synthetic
+# .csv. Tests that write to it take a copy.
+
+@pytest.fixture(scope='session')
+def analysis_database(analysis_csv, tmp_path_factory):
+    database_path = str(tmp_path_factory.mktemp('analysis') / 'speed_dating.db')
+    create_db_streaming(analysis_csv, 'latin', database_path, CSV_COLUMNS)
+    preprocess(database_path, COLUMNS_O, COLUMNS_3_1, COLUMNS_PF_O, 3, COLUMNS_O)
+    build_schema(database_path, COLUMNS_O, COLUMNS_3_1, COLUMNS_PF_O)
+
+    return database_path
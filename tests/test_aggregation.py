@@ -0,0 +1,108 @@
+import sqlite3
+
+import numpy as np
+
+from speed_dating.aggregation import aggregate
+from speed_dating.analysis_store import AnalysisStore, load_columns
+from speed_dating.benchmark import COLUMNS_O, COLUMNS_PF_O
+from speed_dating.schema import analysis_queries
+
+# Every date with the self-rating of the participant rated, as read by the
+# GROUP BY queries
+DATES_QUERY = f'''
+    SELECT p.gender, p.attr3_1, p.iid, d.dec_o, {', '.join(f'd.{column}' for column in COLUMNS_O)}
+    FROM participants AS p
+    JOIN dates AS d ON p.iid = d.iid
+    ORDER BY d.date_id
+'''
+
+
+# Returns the rows of a query as a 2D float array (NULL values become NaN)
+
+def fetch(database_path : str, query : str):
+    conn = sqlite3.connect(database_path)
+    rows = conn.execute(query).fetchall()
+    conn.close()
+
+    return np.array(rows, dtype=float)
+
+
+# Returns the dates columns read by DATES_QUERY
+
+def fetch_dates(database_path : str):
+    conn = sqlite3.connect(database_path)
+    columns = load_columns(conn, DATES_QUERY)
+    conn.close()
+
+    return columns
+
+
+def test_null_keys_form_one_group_sorted_first():
+    stats = aggregate({'attr3_1': np.array([np.nan, 7, np.nan, 3, 7])}, {},
+                      np.array([1, 0, 0, 1, 1]))
+
+    np.testing.assert_array_equal(stats.key('attr3_1'), [np.nan, 3, 7])
+    np.testing.assert_array_equal(stats.count, [2, 1, 2])
+    np.testing.assert_array_equal(stats.successes, [1, 1, 1])
+
+
+def test_aggregate_matches_group_by(analysis_database):
+    dates = fetch_dates(analysis_database)
+    assert np.isnan(dates['attr3_1']).any()
+
+    stats = aggregate({'gender': dates['gender'], 'attr3_1': dates['attr3_1']},
+                      {'attr_o': dates['attr_o'], 'sinc_o': dates['sinc_o']},
+                      dates['dec_o'], chunk_size=500)
+
+    expected = fetch(analysis_database, '''
+        SELECT gender, attr3_1, COUNT(*), SUM(dec_o), AVG(attr_o),
+            AVG(attr_o * attr_o) - AVG(attr_o) * AVG(attr_o), AVG(sinc_o)
+        FROM participants AS p
+        JOIN dates AS d ON p.iid = d.iid
+        GROUP BY gender, attr3_1
+        ORDER BY gender, attr3_1
+    ''')
+
+    np.testing.assert_array_equal(stats.keys, expected[:, :2])
+    np.testing.assert_array_equal(stats.count, expected[:, 2])
+    np.testing.assert_array_equal(stats.successes, expected[:, 3])
+    np.testing.assert_allclose(stats.average('attr_o'), expected[:, 4])
+    np.testing.assert_allclose(stats.variance('attr_o'), expected[:, 5], atol=1e-9)
+    np.testing.assert_allclose(stats.average('sinc_o'), expected[:, 6])
+
+
+def test_merge_matches_single_pass(analysis_database):
+    dates = fetch_dates(analysis_database)
+    keys = {'gender': dates['gender'], 'attr3_1': dates['attr3_1']}
+    values = {'attr_o': dates['attr_o']}
+
+    whole = aggregate(keys, values, dates['dec_o'])
+
+    halves = [np.arange(len(dates['iid'])) % 2 == half for half in (0, 1)]
+    parts = [aggregate({name: key[rows] for name, key in keys.items()},
+                       {name: value[rows] for name, value in values.items()},
+                       dates['dec_o'][rows])
+             for rows in halves]
+    merged = parts[0].merge(parts[1])
+
+    np.testing.assert_array_equal(merged.keys, whole.keys)
+    np.testing.assert_array_equal(merged.count, whole.count)
+    np.testing.assert_array_equal(merged.successes, whole.successes)
+    np.testing.assert_allclose(merged.average('attr_o'), whole.average('attr_o'))
+    np.testing.assert_allclose(merged.variance('attr_o'), whole.variance('attr_o'), atol=1e-9)
+
+
+def test_store_avg_self_attr_data_matches_sql(analysis_database):
+    store = AnalysisStore.from_database(analysis_database)
+    query = analysis_queries(COLUMNS_O, COLUMNS_PF_O)['fetch_avg_self_attr_data']
+    rows = fetch(analysis_database, query)
+
+    avg_self_attr_data = store.fetch_avg_self_attr_data()
+
+    for gender, label in ((0, 'Female'), (1, 'Male')):
+        expected = rows[rows[:, 0] == gender]
+        # NULL first, as GROUP BY sorts it
+        expected = expected[np.lexsort([expected[:, 1], ~np.isnan(expected[:, 1])])]
+
+        np.testing.assert_array_equal(avg_self_attr_data[label][0], expected[:, 1])
+        np.testing.assert_allclose(avg_self_attr_data[label][1], expected[:, 2])
@@ -0,0 +1,86 @@
+import sqlite3
+
+import numpy as np
+import pytest
+
+from speed_dating.analysis_store import GENDER_LABELS, AnalysisStore, band_filter
+from speed_dating.benchmark import COLUMNS_O, COLUMNS_PF_O
+from speed_dating.schema import analysis_queries
+
+
+# Returns the rows of an analysis query as a 2D float array (NULL values
+# become NaN)
+
+def fetch(database_path : str, name : str, custom_where : str = 'attr3_1 >= 6'):
+    conn = sqlite3.connect(database_path)
+    rows = conn.execute(analysis_queries(COLUMNS_O, COLUMNS_PF_O, custom_where)[name]).fetchall()
+    conn.close()
+
+    return np.array(rows, dtype=float)
+
+
+# Returns the rows of a 2D array in a fixed order (the analysis queries only
+# order by some of their columns)
+
+def sort_rows(rows):
+    return rows[np.lexsort(rows.T[::-1])]
+
+
+# Checks a {gender: [x, y]} result of the store holds the same rows as the
+# (gender, x, y) rows of a query
+
+def assert_same_rows(data : dict, rows):
+    for gender, label in GENDER_LABELS.items():
+        expected = rows[rows[:, 0] == gender][:, 1:]
+        actual = np.column_stack([np.asarray(values, dtype=float) for values in data[label]])
+
+        np.testing.assert_allclose(sort_rows(actual.reshape(-1, expected.shape[1])),
+                                   sort_rows(expected), err_msg=label)
+
+
+@pytest.fixture(scope='module')
+def store(analysis_database):
+    return AnalysisStore.from_database(analysis_database)
+
+
+def test_pref_data_matches_sql(analysis_database, store):
+    rows = fetch(analysis_database, 'fetch_pref_data')
+    pref_data = store.fetch_pref_data(COLUMNS_PF_O, ['Female', 'Male'])
+
+    for row, label in zip(rows, ['Female', 'Male']):
+        np.testing.assert_allclose(pref_data[label], row[1:])
+
+
+def test_rating_data_matches_sql(analysis_database, store):
+    rows = fetch(analysis_database, 'fetch_rating_data')
+    rating_data = store.fetch_rating_data(COLUMNS_O)
+
+    for gender in GENDER_LABELS:
+        expected = rows[rows[:, 0] == gender]
+        ratings, dec_o = rating_data[gender]
+
+        np.testing.assert_array_equal(ratings, expected[:, 2:])
+        np.testing.assert_array_equal(dec_o, expected[:, 1])
+
+
+@pytest.mark.parametrize('name', ['fetch_avg_attr_data', 'fetch_avg_self_attr_data',
+                                  'fetch_self_attr_data'])
+def test_per_participant_data_matches_sql(analysis_database, store, name):
+    assert_same_rows(getattr(store, name)(), fetch(analysis_database, name))
+
+
+@pytest.mark.parametrize('custom_where, band', [('attr3_1 >= 6', (6, None)),
+                                                ('attr3_1 < 6', (None, 6)),
+                                                ('attr3_1 >= 3 AND attr3_1 < 8', (3, 8))])
+def test_attr_diff_data_matches_sql(analysis_database, store, custom_where, band):
+    assert_same_rows(store.fetch_attr_diff_data(band_filter(band)),
+                     fetch(analysis_database, 'fetch_attr_diff_data', custom_where))
+
+
+def test_var_attr_data_matches_sql(analysis_database, store):
+    rows = fetch(analysis_database, 'fetch_var_attr_data')
+    var_attr_data = store.fetch_var_attr_data()
+
+    for gender, label in GENDER_LABELS.items():
+        np.testing.assert_allclose(np.sort(var_attr_data[label]),
+                                   np.sort(rows[rows[:, 0] == gender][:, 1]), atol=1e-9)
@@ -0,0 +1,91 @@
+import json
+import sqlite3
+
+import pandas as pd
+import pytest
+
+from speed_dating.benchmark import (COLUMNS_3_1, CSV_COLUMNS, compare_versions, generate_csv,
+                                    run_benchmark)
+from speed_dating.ingest import create_db_streaming
+
+
+# Returns the single value of a query
+
+def scalar(conn, query : str):
+    return conn.execute(query).fetchone()[0]
+
+
+def test_generated_csv_has_the_structure_of_the_original(tmp_path):
+    csv_file = str(tmp_path / 'speed_dating.csv')
+    generated = generate_csv(csv_file, 5_000, {'_o': 0.1, '3_1': 0.0, 'pf_o': 0.0},
+                             missing_pair_rate=0, seed=1, batch_rows=2_000)
+
+    frame = pd.read_csv(csv_file, encoding='latin')
+    assert list(frame.columns) == CSV_COLUMNS + ['wave']
+    assert generated['rows'] == len(frame) >= 5_000
+    assert generated['participants'] == frame['iid'].nunique()
+    assert generated['waves'] == frame['wave'].nunique()
+
+    database_path = str(tmp_path / 'speed_dating.db')
+    create_db_streaming(csv_file, 'latin', database_path, CSV_COLUMNS)
+    conn = sqlite3.connect(database_path)
+
+    # Every (iid, pid) row has its (pid, iid) row, between different
+    # genders, with the same match
+    unpaired = scalar(conn, '''
+        SELECT COUNT(*) FROM speed_dating AS a
+        LEFT JOIN speed_dating AS b ON b.iid = a.pid AND b.pid = a.iid
+        WHERE b.iid IS NULL OR b.gender = a.gender OR b.match != a.match
+    ''')
+    assert unpaired == 0
+
+    # A match needs both decisions
+    assert scalar(conn, '''
+        SELECT COUNT(*) FROM speed_dating AS a
+        JOIN speed_dating AS b ON b.iid = a.pid AND b.pid = a.iid
+        WHERE a.match != a.dec_o * b.dec_o
+    ''') == 0
+
+    # Self ratings are per participant
+    assert scalar(conn, f'''
+        SELECT COUNT(*) FROM (
+            SELECT iid FROM speed_dating GROUP BY iid
+            HAVING {' OR '.join(f'COUNT(DISTINCT {column}) > 1' for column in COLUMNS_3_1)}
+        )
+    ''') == 0
+
+    null_rate = scalar(conn, 'SELECT AVG(attr_o IS NULL) FROM speed_dating')
+    conn.close()
+
+    assert null_rate == pytest.approx(0.1, abs=0.02)
+
+    # Within a wave every woman dates every man
+    rows = frame.groupby('wave').size()
+    people = frame.drop_duplicates('iid').groupby(['wave', 'gender']).size().unstack()
+    assert (rows == 2 * people[0] * people[1]).all()
+
+
+def test_benchmark_results_compare_between_versions(tmp_path):
+    output_path = str(tmp_path / 'results.jsonl')
+    results = run_benchmark((1_000,), output_path, train=False, work_dir=str(tmp_path),
+                            shard_workers=[1])
+
+    with open(output_path) as file:
+        lines = [json.loads(line) for line in file]
+
+    assert lines == results
+    stages = {line['stage'] for line in lines}
+    assert {'generate_csv', 'create_db', 'load_store', 'fetch_rating_data',
+            'run_sharded'} <= stages
+    assert {line['variant'] for line in lines if line['stage'] == 'fetch_rating_data'} == \
+        {'sql', 'store'}
+
+    # A second version twice as slow
+    with open(output_path, 'a') as file:
+        for line in lines:
+            file.write(json.dumps({**line, 'version': 'candidate',
+                                   'seconds': line['seconds'] * 2}) + '\n')
+
+    seconds = compare_versions(output_path, lines[0]['version'], 'candidate')
+    assert len(seconds) == len(lines)
+    assert (seconds['ratio'][seconds[lines[0]['version']] > 0] == 2).all()
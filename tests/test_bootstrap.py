@@ -0,0 +1,108 @@
+import sqlite3
+
+import numpy as np
+import pytest
+
+from speed_dating.analysis_store import AnalysisStore
+from speed_dating.benchmark import COLUMNS_O, COLUMNS_PF_O
+from speed_dating.bootstrap import (grouped_intervals, intervals_by_gender,
+                                    participant_outcomes)
+from speed_dating.query_pool import close_shared_pools
+from speed_dating.schema import analysis_queries
+
+
+@pytest.fixture(scope='module')
+def outcomes(analysis_database):
+    try:
+        yield participant_outcomes(analysis_database)
+    finally:
+        close_shared_pools()
+
+
+# Returns the replicates of one group drawn one resample at a time with the
+# seeds grouped_intervals gives its batches
+
+def looped_replicates(successes, trials, n_resamples : int, batch_size : int, seed : int,
+                      position : int, sizes : list):
+    seeds = np.random.SeedSequence(seed).spawn(-(-n_resamples // batch_size))
+    replicates = []
+
+    for start, batch_seed in zip(range(0, n_resamples, batch_size), seeds):
+        rng = np.random.default_rng(batch_seed)
+        size = min(batch_size, n_resamples - start)
+        # The groups before this one draw from the same generator first
+        for earlier in sizes[:position]:
+            rng.integers(0, earlier, size=(size, earlier))
+
+        for _ in range(size):
+            index = rng.integers(0, len(successes), size=len(successes))
+            replicates.append(successes[index].sum() / trials[index].sum())
+
+    return np.array(replicates)
+
+
+def test_estimates_match_success_by_self_rating(analysis_database, outcomes):
+    conn = sqlite3.connect(analysis_database)
+    rows = conn.execute(analysis_queries(COLUMNS_O, COLUMNS_PF_O)['fetch_avg_self_attr_data'])
+    rows = np.array([row for row in rows if row[1] is not None], dtype=float)
+    conn.close()
+
+    intervals = intervals_by_gender(outcomes, n_resamples=50, max_workers=1)
+
+    for gender, label in enumerate(['Female', 'Male']):
+        expected = rows[rows[:, 0] == gender]
+        expected = expected[np.argsort(expected[:, 1])]
+
+        np.testing.assert_array_equal(intervals[label]['group'], expected[:, 1])
+        np.testing.assert_allclose(intervals[label]['estimate'], expected[:, 2])
+        assert np.all(intervals[label]['low'] <= intervals[label]['high'])
+
+
+def test_store_outcomes_match_database(analysis_database, outcomes):
+    store_outcomes = participant_outcomes(analysis_database,
+                                          AnalysisStore.from_database(analysis_database))
+
+    for name, values in outcomes.items():
+        np.testing.assert_allclose(store_outcomes[name], values, err_msg=name)
+
+
+def test_percentile_intervals_match_looped_resampling(outcomes):
+    rows = outcomes['gender'] == 1
+    groups = outcomes['attr3_1'][rows]
+    successes, trials = outcomes['successes'][rows], outcomes['trials'][rows]
+
+    kwargs = dict(n_resamples=300, method='percentile', seed=7, batch_size=120)
+    intervals = grouped_intervals(groups, successes, trials, max_workers=1, **kwargs)
+
+    # The same replicates across processes
+    parallel = grouped_intervals(groups, successes, trials, max_workers=2, **kwargs)
+    for name in ('estimate', 'low', 'high'):
+        np.testing.assert_array_equal(parallel[name], intervals[name])
+
+    labels = intervals['group']
+    sizes = [int((groups == label).sum()) for label in labels]
+    for i, label in enumerate(labels):
+        members = groups == label
+        replicates = looped_replicates(successes[members], trials[members], 300, 120, 7, i,
+                                       sizes)
+
+        assert (intervals['low'][i], intervals['high'][i]) == \
+            pytest.approx(tuple(np.quantile(replicates, [0.025, 0.975])))
+
+
+def test_bca_interval_of_a_large_group():
+    rng = np.random.default_rng(0)
+    trials = rng.integers(5, 20, 2_000).astype(float)
+    successes = rng.binomial(trials.astype(int), 0.4).astype(float)
+
+    intervals = grouped_intervals(np.zeros(2_000), successes, trials, n_resamples=1_000,
+                                  max_workers=1)
+    estimate = successes.sum() / trials.sum()
+    standard_error = np.sqrt(estimate * (1 - estimate) / trials.sum())
+
+    assert intervals['estimate'][0] == pytest.approx(estimate)
+    assert intervals['low'][0] == pytest.approx(estimate - 1.96 * standard_error, abs=0.005)
+    assert intervals['high'][0] == pytest.approx(estimate + 1.96 * standard_error, abs=0.005)
+
+    with pytest.raises(ValueError):
+        grouped_intervals([1], [1], [1], statistic='mean')
@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+from sklearn.metrics import accuracy_score, roc_auc_score
+from sklearn.model_selection import StratifiedKFold
+
+from speed_dating.analysis_store import AnalysisStore
+from speed_dating.benchmark import COLUMNS_O
+from speed_dating.classification import evaluate_classifiers, make_classifier
+
+GENDER_LABELS = ['Female', 'Male']
+MODELS = ('hist_gradient_boosting', 'logistic_regression')
+
+
+@pytest.fixture(scope='module')
+def rating_data(analysis_database):
+    return AnalysisStore.from_database(analysis_database).fetch_rating_data(COLUMNS_O)
+
+
+# Returns the mean accuracy and AUC of a classifier over the folds, fitted one
+# after another
+
+def sequential_scores(name : str, X, y, n_splits : int, random_state : int):
+    folds = StratifiedKFold(n_splits=n_splits, shuffle=True, random_state=random_state)
+    accuracies, aucs = [], []
+
+    for train, test in folds.split(X, y):
+        model = make_classifier(name, random_state).fit(X[train], y[train])
+        accuracies.append(accuracy_score(y[test], model.predict(X[test])))
+        aucs.append(roc_auc_score(y[test], model.predict_proba(X[test])[:, 1]))
+
+    return np.mean(accuracies), np.mean(aucs)
+
+
+def test_parallel_folds_match_sequential_folds(rating_data):
+    results = evaluate_classifiers(rating_data, GENDER_LABELS, MODELS, n_splits=3, n_jobs=2)
+
+    for i, gender in enumerate(GENDER_LABELS):
+        X = np.asarray(rating_data[i][0], dtype=float)
+        y = np.asarray(rating_data[i][1], dtype=int)
+
+        for name in MODELS:
+            accuracy, auc = sequential_scores(name, X, y, 3, 42)
+            result = results[gender][name]
+
+            assert result['accuracy'] == pytest.approx(accuracy), (gender, name)
+            assert result['auc'] == pytest.approx(auc), (gender, name)
+            assert result['fit_seconds'] > 0 and result['predict_seconds'] > 0
+
+
+def test_unknown_classifier():
+    with pytest.raises(ValueError):
+        make_classifier('svm')
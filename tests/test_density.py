@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+from scipy.stats import gaussian_kde
+
+from speed_dating.density import (isj_bandwidth, kde, linear_bin, select_bandwidth,
+                                  silverman_bandwidth)
+
+
+# Returns scipy's direct Gaussian KDE with a bandwidth of h
+
+def direct_kde(values, h : float):
+    return gaussian_kde(values, bw_method=h / values.std(ddof=1))
+
+
+def test_fft_kde_matches_gaussian_kde():
+    rng = np.random.default_rng(0)
+    values = np.concatenate([rng.gamma(2.0, 1.0, 4_000), rng.normal(7.0, 0.8, 2_000)])
+    values[::500] = np.nan
+
+    grid, density, h = kde(values)
+    values = values[~np.isnan(values)]
+    expected = direct_kde(values, h)(grid)
+
+    assert np.abs(density - expected).max() < 0.01 * expected.max()
+    # The kernel is cut at 3 bandwidths
+    assert np.trapezoid(density, grid) == pytest.approx(1, abs=0.005)
+
+
+def test_bounded_kde_matches_reflected_gaussian_kde():
+    rng = np.random.default_rng(1)
+    values = rng.gamma(1.0, 1.0, 5_000)
+
+    grid, density, h = kde(values, bounds=(0, None))
+    reference = direct_kde(values, h)
+    expected = reference(grid) + reference(-grid)
+
+    assert grid[0] == 0
+    assert np.abs(density - expected).max() < 0.01 * expected.max()
+    assert np.trapezoid(density, grid) == pytest.approx(1, abs=0.005)
+
+
+def test_bandwidths():
+    rng = np.random.default_rng(2)
+    values = rng.normal(0, 1, 5_000)
+
+    # On normal values ISJ is close to the normal reference rule
+    assert isj_bandwidth(values) == pytest.approx(1.059 * values.std() * 5_000 ** -0.2,
+                                                  rel=0.15)
+    assert select_bandwidth(values, 'silverman') == silverman_bandwidth(values)
+    assert select_bandwidth(values, 0.3) == 0.3
+    # A single value or a constant sample still has a usable bandwidth
+    assert silverman_bandwidth([4.0]) > 0
+    assert kde(np.full(10, 4.0))[2] > 0
+
+    with pytest.raises(ValueError):
+        select_bandwidth(values, 'normal')
+
+
+def test_linear_bin_keeps_every_value():
+    values = np.array([0.0, 0.25, 1.0, 2.5, 4.0])
+    weights = linear_bin(values, 0, 4, 5)
+
+    assert weights.sum() == len(values)
+    np.testing.assert_allclose(weights, [1.75, 1.25, 0.5, 0.5, 1.0])
@@ -0,0 +1,117 @@
+from itertools import combinations
+from math import factorial
+
+import numpy as np
+import pytest
+from sklearn.ensemble import RandomForestRegressor
+from sklearn.inspection import permutation_importance
+from sklearn.model_selection import train_test_split
+
+from speed_dating.analysis_store import AnalysisStore
+from speed_dating.benchmark import COLUMNS_O
+from speed_dating.importance import feature_importance, tree_shap_values
+
+
+# Fits a small forest on the ratings received by men and returns it with
+# the held-out split
+
+@pytest.fixture(scope='module')
+def forest(analysis_database):
+    X, y = AnalysisStore.from_database(analysis_database).fetch_rating_data(COLUMNS_O)[1]
+    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=42)
+    model = RandomForestRegressor(n_estimators=8, max_depth=6, random_state=42)
+
+    return model.fit(X_train, y_train), X_test, y_test.astype(float)
+
+
+# Returns the expected prediction of a tree for a sample given the features
+# in a subset, following the sample on those features and averaging the
+# children by training samples on the others (TreeSHAP's EXPVALUE)
+
+def expected_value(tree, x, subset : set, node : int = 0):
+    left, right = tree.children_left[node], tree.children_right[node]
+    if left == -1:
+        return tree.value[node].ravel()[0]
+
+    feature = tree.feature[node]
+    if feature in subset:
+        child = left if x[feature] <= tree.threshold[node] else right
+        return expected_value(tree, x, subset, child)
+
+    cover = tree.weighted_n_node_samples
+    return (cover[left] * expected_value(tree, x, subset, left)
+            + cover[right] * expected_value(tree, x, subset, right)) / cover[node]
+
+
+# Returns the SHAP values of one sample from the Shapley formula over every
+# subset of the other features
+
+def shapley_values(tree, x):
+    n = len(x)
+    values = np.zeros(n)
+
+    for feature in range(n):
+        others = [f for f in range(n) if f != feature]
+        for size in range(n):
+            weight = factorial(size) * factorial(n - size - 1) / factorial(n)
+            for subset in combinations(others, size):
+                values[feature] += weight * (expected_value(tree, x, {*subset, feature})
+                                             - expected_value(tree, x, set(subset)))
+
+    return values
+
+
+def test_tree_shap_matches_shapley_formula(forest):
+    model, X_test, y_test = forest
+    X = X_test[:20]
+
+    for estimator in model.estimators_[:3]:
+        shap, base = tree_shap_values(estimator, X)
+
+        assert base == pytest.approx(expected_value(estimator.tree_, X[0], set()))
+        for row, x in enumerate(X):
+            np.testing.assert_allclose(shap[row], shapley_values(estimator.tree_, x),
+                                       atol=1e-9)
+
+    result = feature_importance(model, X_test, y_test, 'tree_shap',
+                                max_samples=100, batch_size=3, cache_dir=None, max_workers=2)
+    assert result['additivity_error'] < 1e-9
+    assert len(result['importances_mean']) == len(COLUMNS_O)
+
+
+def test_permutation_matches_looped_shuffles(forest, tmp_path):
+    model, X_test, y_test = forest
+    cache_dir = str(tmp_path / 'cache')
+
+    result = feature_importance(model, X_test, y_test, n_repeats=6, batch_size=4,
+                                cache_dir=cache_dir, max_workers=2)
+    assert result['cache'] == 'miss'
+
+    # The same shuffles one at a time with the seed of each task
+    seeds = iter(np.random.SeedSequence(0).spawn(len(COLUMNS_O) * 2))
+    baseline = np.mean((model.predict(X_test) - y_test) ** 2)
+    scores = np.empty((6, len(COLUMNS_O)))
+    for feature in range(len(COLUMNS_O)):
+        repeat = 0
+        for size in (4, 2):
+            rng = np.random.default_rng(next(seeds))
+            for _ in range(size):
+                shuffled = X_test.copy()
+                shuffled[:, feature] = rng.permutation(X_test[:, feature])
+                scores[repeat, feature] = np.mean((model.predict(shuffled) - y_test) ** 2) \
+                    - baseline
+                repeat += 1
+
+    np.testing.assert_allclose(result['importances_mean'], scores.mean(axis=0))
+    np.testing.assert_allclose(result['importances_std'], scores.std(axis=0))
+
+    # sklearn's shuffles differ but measure the same increase in error
+    expected = permutation_importance(model, X_test, y_test, scoring='neg_mean_squared_error',
+                                      n_repeats=30, random_state=0)
+    np.testing.assert_allclose(result['importances_mean'], expected.importances_mean,
+                               atol=4 * expected.importances_std.max())
+
+    cached = feature_importance(model, X_test, y_test, n_repeats=6, batch_size=4,
+                                cache_dir=cache_dir, max_workers=1)
+    assert cached['cache'] == 'hit'
+    assert cached['importances_mean'] == result['importances_mean']
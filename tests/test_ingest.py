@@ -0,0 +1,46 @@
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+from speed_dating.benchmark import CSV_COLUMNS
+from speed_dating.ingest import COLUMN_MAPPING, ID_COLUMNS, create_db_streaming
+
+
+# Returns the speed_dating table in insertion order with its column names
+
+def read_table(database_path : str):
+    conn = sqlite3.connect(database_path)
+    cursor = conn.execute('SELECT * FROM speed_dating ORDER BY rowid')
+    names = [description[0] for description in cursor.description]
+    rows = np.array(cursor.fetchall(), dtype=float)
+    conn.close()
+
+    return names, rows
+
+
+def test_streaming_ingest_matches_to_sql(analysis_csv, tmp_path):
+    streamed = str(tmp_path / 'streamed.db')
+    report = create_db_streaming(analysis_csv, 'latin', streamed, CSV_COLUMNS, chunk_size=500)
+
+    # The previous create_db: the whole .csv through pandas' to_sql
+    loaded = str(tmp_path / 'to_sql.db')
+    conn = sqlite3.connect(loaded)
+    rows = pd.read_csv(analysis_csv, encoding='latin')[CSV_COLUMNS].rename(columns=COLUMN_MAPPING)
+    rows.to_sql('speed_dating', conn, index=False)
+    conn.close()
+
+    names, streamed_rows = read_table(streamed)
+    expected_names, expected_rows = read_table(loaded)
+
+    assert names == expected_names
+    assert report['rows'] == len(expected_rows)
+    np.testing.assert_array_equal(streamed_rows, expected_rows)
+
+    # Identifiers are stored as integers rather than REAL
+    conn = sqlite3.connect(streamed)
+    for column in ID_COLUMNS:
+        types = {row[0] for row in conn.execute(f'SELECT DISTINCT typeof({column}) '
+                                                f'FROM speed_dating')}
+        assert types <= {'integer', 'null'}, column
+    conn.close()
@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+from sklearn.ensemble import RandomForestRegressor
+
+from speed_dating.analysis_store import AnalysisStore
+from speed_dating.benchmark import COLUMNS_3_1, COLUMNS_O, COLUMNS_PF_O
+from speed_dating.pair_scoring import pair_features, participant_waves, score_all_pairs
+from speed_dating.scoring import ScoringModel
+
+
+@pytest.fixture(scope='module')
+def store(analysis_database):
+    return AnalysisStore.from_database(analysis_database)
+
+
+# Saves a small scoring model fitted on the ratings received per gender
+
+@pytest.fixture(scope='module')
+def model_path(store, tmp_path_factory):
+    rating_data = store.fetch_rating_data(COLUMNS_O)
+    models = {gender: RandomForestRegressor(n_estimators=5, random_state=42).fit(X, y)
+              for gender, (X, y) in rating_data.items()}
+
+    path = str(tmp_path_factory.mktemp('pair_scoring') / 'model.npz')
+    ScoringModel.from_models(models).save(path)
+
+    return path
+
+
+def test_waves_hold_every_date(store):
+    waves = participant_waves(store.iid, store.dates['iid'], store.dates['pid'])
+    date_wave = waves[np.searchsorted(store.iid, store.dates['iid'])]
+    partner_wave = waves[np.searchsorted(store.iid, store.dates['pid'])]
+
+    np.testing.assert_array_equal(date_wave, partner_wave)
+
+
+@pytest.mark.parametrize('max_workers', [1, 2])
+def test_all_pairs_match_pair_by_pair_scoring(store, model_path, max_workers):
+    results = score_all_pairs(store, model_path, COLUMNS_3_1, COLUMNS_PF_O, k=3, chunk_size=4,
+                              max_workers=max_workers)
+    model = ScoringModel.load(model_path)
+    rows = {iid: row for row, iid in enumerate(store.iid)}
+
+    # Returns the self-ratings and preferences of a participant
+    def participant(iid):
+        row = rows[iid]
+        self_ratings = np.array([store.participants[column][row] for column in COLUMNS_3_1])
+        preferences = np.array([store.participants[column][row] for column in COLUMNS_PF_O])
+
+        return self_ratings, np.where(np.isnan(preferences), 100 / 5, preferences)
+
+    assert results
+    for result in results.values():
+        for m, male in enumerate(result['males']):
+            male_self, male_prefs = participant(male)
+
+            for f, female in enumerate(result['females']):
+                female_self, female_prefs = participant(female)
+                female_yes = model.score(pair_features(male_self, female_prefs)[None], 1)[0]
+                male_yes = model.score(pair_features(female_self, male_prefs)[None], 0)[0]
+
+                assert result['female_yes'][m, f] == pytest.approx(female_yes)
+                assert result['male_yes'][m, f] == pytest.approx(male_yes)
+                assert result['mutual'][m, f] == pytest.approx(female_yes * male_yes)
+
+        # The recommended partners have the largest mutual probabilities
+        best = np.sort(result['mutual'], axis=1)[:, ::-1][:, :3]
+        columns = np.searchsorted(result['females'], result['top_females_for_male'])
+        np.testing.assert_allclose(np.take_along_axis(result['mutual'], columns, axis=1), best)
@@ -0,0 +1,75 @@
+import shutil
+import sqlite3
+
+import numpy as np
+import pytest
+
+from speed_dating.analysis_store import AnalysisStore
+from speed_dating.benchmark import COLUMNS_O
+from speed_dating.pairs import MatchGraph, build_pairs, pairs_from_store
+from speed_dating.query_pool import close_shared_pools
+
+
+# Returns the rows of a query as a 2D float array (NULL values become NaN)
+
+def fetch(database_path : str, query : str):
+    conn = sqlite3.connect(database_path)
+    rows = np.array(conn.execute(query).fetchall(), dtype=float)
+    conn.close()
+
+    return rows
+
+
+# Builds the pairs table on a copy of the analysis database
+
+@pytest.fixture(scope='module')
+def database_path(analysis_database, tmp_path_factory):
+    path = str(tmp_path_factory.mktemp('pairs') / 'speed_dating.db')
+    shutil.copy(analysis_database, path)
+    build_pairs(path, COLUMNS_O)
+
+    yield path
+
+    close_shared_pools()
+
+
+def test_pairs_table_matches_self_join(database_path):
+    attributes = [column[:-2] for column in COLUMNS_O]
+    joined = fetch(database_path, f'''
+        SELECT a.iid, a.pid, a.date_id, b.date_id, b.dec_o, a.dec_o, a.match,
+               {', '.join(f'b.{attribute}_o, a.{attribute}_o' for attribute in attributes)}
+        FROM dates AS a
+        JOIN dates AS b ON b.iid = a.pid AND b.pid = a.iid
+        WHERE a.iid < a.pid
+        ORDER BY a.iid, a.pid
+    ''')
+    pairs = fetch(database_path, 'SELECT * FROM pairs ORDER BY iid_a, iid_b')
+
+    np.testing.assert_array_equal(pairs, joined)
+
+    store_pairs = pairs_from_store(AnalysisStore.from_database(database_path), COLUMNS_O)
+    np.testing.assert_array_equal(np.column_stack(list(store_pairs.values())), joined)
+
+
+def test_graph_matches_self_join(database_path):
+    joined = fetch(database_path, '''
+        SELECT b.pid, COUNT(*), SUM(b.dec_o), SUM(a.dec_o), SUM(a.dec_o * b.dec_o), SUM(a.match)
+        FROM dates AS a
+        JOIN dates AS b ON b.iid = a.pid AND b.pid = a.iid
+        GROUP BY b.pid
+        ORDER BY b.pid
+    ''')
+
+    for graph in (MatchGraph.from_database(database_path),
+                  MatchGraph.from_store(AnalysisStore.from_database(database_path))):
+        stats = graph.participant_stats()
+        rows = np.searchsorted(stats['iid'], joined[:, 0].astype(np.int64))
+
+        np.testing.assert_array_equal(stats['iid'][rows], joined[:, 0])
+        for i, name in enumerate(['dates', 'yes_given', 'yes_received', 'mutual', 'matches'],
+                                 start=1):
+            np.testing.assert_array_equal(stats[name][rows], joined[:, i], err_msg=name)
+
+        summary = graph.summary()
+        assert summary['pairs'] * 2 == joined[:, 1].sum()
+        assert summary['mutual_pairs'] * 2 == joined[:, 4].sum()
@@ -0,0 +1,106 @@
+import shutil
+import sqlite3
+
+import numpy as np
+import pytest
+
+from speed_dating.benchmark import COLUMNS_3_1, COLUMNS_O, COLUMNS_PF_O, CSV_COLUMNS
+from speed_dating.ingest import create_db_streaming
+from speed_dating.pairs import build_pairs
+from speed_dating.pipeline import notebook_pipeline
+from speed_dating.preprocessing import preprocess
+from speed_dating.schema import build_schema
+from speed_dating.summaries import build_summaries
+
+# The tables built by the pipeline and the order their rows are compared in
+TABLES = {
+    'participants': 'iid',
+    'dates': 'iid, date_id',
+    'pairs': 'iid_a, iid_b',
+    'participant_summary': 'iid',
+    'self_rating_summary': 'gender, attr3_1'
+}
+
+
+# Returns every table of TABLES as a 2D float array (NULL values become NaN)
+
+def read_tables(database_path : str):
+    conn = sqlite3.connect(database_path)
+    tables = {table: np.array(conn.execute(f'SELECT * FROM {table} ORDER BY {key}').fetchall(),
+                              dtype=float)
+              for table, key in TABLES.items()}
+    conn.close()
+
+    return tables
+
+
+# Returns the arguments of notebook_pipeline for a database
+
+def pipeline_settings(csv_file : str, database_path : str):
+    return (csv_file, database_path, CSV_COLUMNS, COLUMNS_O, COLUMNS_3_1, COLUMNS_PF_O)
+
+
+# Runs the pipeline once on the synthetic .csv
+
+@pytest.fixture(scope='module')
+def pipeline_database(analysis_csv, tmp_path_factory):
+    database_path = str(tmp_path_factory.mktemp('pipeline') / 'speed_dating.db')
+    pipeline = notebook_pipeline(*pipeline_settings(analysis_csv, database_path), n_jobs=1)
+    pipeline.run()
+
+    return database_path, pipeline.result('select_n_neighbors')['n_neighbors']
+
+
+# Returns a copy of the pipeline's database for one test
+
+@pytest.fixture
+def database_path(pipeline_database, tmp_path):
+    path = str(tmp_path / 'speed_dating.db')
+    shutil.copy(pipeline_database[0], path)
+    return path
+
+
+def test_pipeline_matches_stages_run_by_hand(analysis_csv, pipeline_database, tmp_path):
+    database_path, n_neighbors = pipeline_database
+
+    by_hand = str(tmp_path / 'by_hand.db')
+    create_db_streaming(analysis_csv, 'latin', by_hand, CSV_COLUMNS)
+    preprocess(by_hand, COLUMNS_O, COLUMNS_3_1, COLUMNS_PF_O, 3, COLUMNS_O, n_neighbors)
+    build_schema(by_hand, COLUMNS_O, COLUMNS_3_1, COLUMNS_PF_O)
+    build_pairs(by_hand, COLUMNS_O)
+    build_summaries(by_hand, COLUMNS_O)
+
+    expected = read_tables(by_hand)
+    for table, rows in read_tables(database_path).items():
+        np.testing.assert_array_equal(rows, expected[table], err_msg=table)
+
+
+def test_unchanged_run_skips_every_stage(analysis_csv, database_path):
+    report = notebook_pipeline(*pipeline_settings(analysis_csv, database_path), n_jobs=1).run()
+
+    assert {stage['status'] for stage in report} == {'skipped'}
+
+
+def test_changed_parameter_reruns_dependent_stages(analysis_csv, database_path):
+    pipeline = notebook_pipeline(*pipeline_settings(analysis_csv, database_path), null_no=2,
+                                 n_jobs=1)
+    statuses = {stage['stage']: stage['status'] for stage in pipeline.run()}
+
+    # preprocess changed speed_dating in place, so the ingest is restored
+    # to clean it again
+    assert statuses['create_db'] == 'restored'
+    assert statuses['select_n_neighbors'] == 'ran'
+    assert statuses['preprocess'] == 'ran'
+
+
+def test_table_changed_outside_is_rebuilt(analysis_csv, pipeline_database, database_path):
+    conn = sqlite3.connect(database_path)
+    conn.execute('UPDATE dates SET attr_o = attr_o + 1')
+    conn.commit()
+    conn.close()
+
+    report = notebook_pipeline(*pipeline_settings(analysis_csv, database_path), n_jobs=1).run()
+
+    assert {stage['stage']: stage['status'] for stage in report}['build_schema'] == 'ran'
+    np.testing.assert_array_equal(read_tables(database_path)['dates'],
+                                  read_tables(pipeline_database[0])['dates'])
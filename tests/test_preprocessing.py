@@ -0,0 +1,69 @@
+import shutil
+import sqlite3
+
+import numpy as np
+
+from speed_dating.benchmark import COLUMNS_3_1, COLUMNS_O, COLUMNS_PF_O, CSV_COLUMNS
+from speed_dating.ingest import create_db_streaming
+from speed_dating.notebook import load_notebook_functions
+from speed_dating.preprocessing import (delete_missing_pairs_indexed, fetch_cleaned_rows,
+                                        null_values_query, preprocess)
+from speed_dating.tracing import connect
+
+
+# Returns the rowids and _o ratings of speed_dating
+
+def read_rows(database_path : str):
+    conn = sqlite3.connect(database_path)
+    rows = conn.execute(f"SELECT rowid, {', '.join(COLUMNS_O)} FROM speed_dating "
+                        f"ORDER BY rowid").fetchall()
+    conn.close()
+
+    return np.array(rows, dtype=float)
+
+
+def test_preprocess_deletes_the_rows_of_the_notebook_queries(analysis_csv, tmp_path):
+    database_path = str(tmp_path / 'speed_dating.db')
+    create_db_streaming(analysis_csv, 'latin', database_path, CSV_COLUMNS)
+    notebook_path = str(tmp_path / 'notebook.db')
+    shutil.copy(database_path, notebook_path)
+
+    report = preprocess(database_path, COLUMNS_O, COLUMNS_3_1, COLUMNS_PF_O, 3, COLUMNS_O)
+
+    # The notebook's separate DELETE queries, each in its own transaction
+    functions = load_notebook_functions()
+    functions['delete_null_values'](notebook_path, COLUMNS_O, COLUMNS_3_1, COLUMNS_PF_O, 3)
+    functions['delete_missing_pairs'](notebook_path)
+
+    rows = read_rows(database_path)
+    expected = read_rows(notebook_path)
+
+    np.testing.assert_array_equal(rows[:, 0], expected[:, 0])
+    # Only the NULL ratings were changed, by the imputation
+    present = ~np.isnan(expected)
+    np.testing.assert_array_equal(rows[present], expected[present])
+    assert not np.isnan(rows).any()
+    assert report[-1]['rows'] == int(np.isnan(expected).any(axis=1).sum())
+
+
+def test_cleaned_rows_match_rows_kept_by_cleaning(analysis_csv, tmp_path):
+    database_path = str(tmp_path / 'speed_dating.db')
+    create_db_streaming(analysis_csv, 'latin', database_path, CSV_COLUMNS)
+
+    donors = fetch_cleaned_rows(database_path, COLUMNS_O, COLUMNS_3_1, COLUMNS_PF_O, 3,
+                                COLUMNS_O)
+
+    # The complete rows left by the deletions of preprocess
+    conn = connect(database_path)
+    cursor = conn.cursor()
+    cursor.execute('BEGIN')
+    cursor.execute(*null_values_query([COLUMNS_O, COLUMNS_3_1, COLUMNS_PF_O], 3))
+    assert delete_missing_pairs_indexed(cursor) > 0
+    kept = cursor.execute(
+        f"SELECT {', '.join(COLUMNS_O)} FROM speed_dating "
+        f"WHERE {' AND '.join(f'{column} IS NOT NULL' for column in COLUMNS_O)}").fetchall()
+    conn.rollback()
+    conn.close()
+
+    kept = np.array(kept, dtype=float)
+    np.testing.assert_array_equal(donors[np.lexsort(donors.T)], kept[np.lexsort(kept.T)])
@@ -0,0 +1,59 @@
+import sqlite3
+
+import pytest
+
+from speed_dating.benchmark import COLUMNS_3_1, COLUMNS_O, COLUMNS_PF_O, CSV_COLUMNS
+from speed_dating.ingest import create_db_streaming
+from speed_dating.pipeline import notebook_pipeline
+from speed_dating.query_pool import QueryPool, close_shared_pools, shared_pool
+
+
+# Returns the rows of a query read with a plain connection
+
+def fetch(database_path : str, query : str):
+    conn = sqlite3.connect(database_path)
+    rows = conn.execute(query).fetchall()
+    conn.close()
+
+    return rows
+
+
+def test_pool_matches_plain_connection(analysis_database):
+    query = 'SELECT iid, gender, attr3_1 FROM participants ORDER BY iid'
+
+    with QueryPool(analysis_database, size=2) as pool:
+        assert pool.journal_mode == 'wal'
+        assert pool.fetch(query) == fetch(analysis_database, query)
+
+
+def test_rebuild_after_wal(analysis_csv, tmp_path):
+    database_path = str(tmp_path / 'speed_dating.db')
+    settings = (analysis_csv, database_path, CSV_COLUMNS, COLUMNS_O, COLUMNS_3_1, COLUMNS_PF_O)
+
+    notebook_pipeline(*settings, n_jobs=1).run()
+    rows = shared_pool(database_path).fetch('SELECT COUNT(*) FROM dates')
+
+    try:
+        # The database is rebuilt with the pipeline's state connection and
+        # the shared pool open on it
+        report = notebook_pipeline(*settings, n_jobs=1).run(force=('create_db',))
+
+        assert report[0]['stage'] == 'create_db' and report[0]['status'] == 'ran'
+        assert shared_pool(database_path).fetch('SELECT COUNT(*) FROM dates') == rows
+        assert fetch(database_path, 'PRAGMA journal_mode') == [('wal',)]
+    finally:
+        close_shared_pools()
+
+
+def test_failed_load_releases_lock(tmp_path):
+    csv_file = tmp_path / 'speed_dating.csv'
+    csv_file.write_text('iid,pid\n1,not a number\n')
+    database_path = str(tmp_path / 'speed_dating.db')
+
+    with pytest.raises(ValueError):
+        create_db_streaming(str(csv_file), 'latin', database_path, ['iid', 'pid'])
+
+    conn = sqlite3.connect(database_path, timeout=0)
+    conn.execute('CREATE TABLE written (value INTEGER)')
+    conn.commit()
+    conn.close()
@@ -0,0 +1,111 @@
+import numpy as np
+import pandas as pd
+import plotly.graph_objects as go
+import pytest
+
+from speed_dating.rendering import (AGGREGATE_THRESHOLD, WEBGL_THRESHOLD, benchmark_rendering,
+                                    box_stats, box_traces, hex_bins, lttb, rect_bins,
+                                    scatter_trace)
+
+
+# Returns the points kept by the reference LTTB loop, one bucket at a time
+
+def reference_lttb(x, y, n_out : int):
+    order = np.argsort(x, kind='stable')
+    x, y = list(x[order]), list(y[order])
+    n = len(x)
+    every = (n - 2) / (n_out - 2)
+
+    kept = [0]
+    a = 0
+    for i in range(n_out - 2):
+        next_start = int((i + 1) * every) + 1
+        next_end = min(int((i + 2) * every) + 1, n)
+        next_x = sum(x[next_start:next_end]) / (next_end - next_start)
+        next_y = sum(y[next_start:next_end]) / (next_end - next_start)
+
+        best, best_area = None, -1
+        for j in range(int(i * every) + 1, next_start):
+            area = abs((x[a] - next_x) * (y[j] - y[a]) - (x[a] - x[j]) * (next_y - y[a]))
+            if area > best_area:
+                best, best_area = j, area
+        kept.append(best)
+        a = best
+    kept.append(n - 1)
+
+    return np.array(x)[kept], np.array(y)[kept]
+
+
+def test_lttb_matches_reference_loop():
+    rng = np.random.default_rng(0)
+    x = rng.random(5_003)
+    y = np.sin(x * 20) + rng.normal(0, 0.1, len(x))
+
+    for n_out in (3, 10, 257):
+        expected = reference_lttb(x, y, n_out)
+        for actual, values in zip(lttb(x, y, n_out), expected):
+            np.testing.assert_array_equal(actual, values)
+
+
+def test_bins_count_every_point():
+    rng = np.random.default_rng(1)
+    x = rng.normal(6.5, 1.5, 20_000)
+    y = 5 * x + rng.normal(0, 15, len(x))
+
+    x_centres, y_centres, counts = rect_bins(x, y, 20)
+    expected, _, _ = np.histogram2d(x, y, bins=20)
+    assert counts.sum() == len(x)
+    np.testing.assert_array_equal(np.sort(counts), np.sort(expected[expected > 0]))
+
+    x_centres, y_centres, counts = hex_bins(x, y, 20)
+    assert counts.sum() == len(x)
+    assert len(np.unique(np.column_stack([x_centres, y_centres]), axis=0)) == len(counts)
+
+
+def test_box_stats_match_pandas():
+    rng = np.random.default_rng(2)
+    groups = rng.integers(1, 6, 3_000).astype(float)
+    values = np.round(rng.gamma(2, 10, len(groups)), 1)
+    values[::97] = np.nan
+
+    stats = box_stats(groups, values)
+
+    frame = pd.DataFrame({'group': groups, 'value': values}).dropna()
+    outliers = []
+    for i, (group, rows) in enumerate(frame.groupby('group')['value']):
+        q1, median, q3 = rows.quantile([0.25, 0.5, 0.75])
+        low, high = q1 - 1.5 * (q3 - q1), q3 + 1.5 * (q3 - q1)
+
+        assert stats['x'][i] == group
+        assert (stats['q1'][i], stats['median'][i], stats['q3'][i]) == \
+            pytest.approx((q1, median, q3))
+        assert stats['lowerfence'][i] == rows[rows >= low].min()
+        assert stats['upperfence'][i] == rows[rows <= high].max()
+        assert stats['mean'][i] == pytest.approx(rows.mean())
+        outliers.extend(sorted(rows[(rows < low) | (rows > high)]))
+
+    np.testing.assert_array_equal(stats['outlier_y'], outliers)
+
+
+def test_render_mode_follows_size():
+    rng = np.random.default_rng(3)
+
+    for points, trace_type in ((WEBGL_THRESHOLD, go.Scatter), (WEBGL_THRESHOLD + 1, go.Scattergl)):
+        x = rng.random(points)
+        assert type(scatter_trace(x, x, 'points', 'red')) is trace_type
+
+    x = rng.random(AGGREGATE_THRESHOLD + 1)
+    binned = scatter_trace(x, x, 'points', 'red')
+    assert binned.name == 'points (binned)' and binned.customdata.sum() == len(x)
+    assert len(scatter_trace(x, x, 'line', 'red', line_plot=True, max_points=500).x) == 500
+
+    with pytest.raises(ValueError):
+        scatter_trace(x, x, 'points', 'red', render_mode='canvas')
+
+
+def test_precomputed_boxes_are_smaller_than_raw():
+    results = benchmark_rendering(20_000)
+
+    assert results['box_precomputed']['json_kb'] < results['box_raw']['json_kb']
+    assert results['hexbin']['points'] < results['svg']['points'] == 20_000
+    assert len(box_traces([1, 1, 2], [1.0, 2.0, 3.0], 'box', 'red')) == 2
@@ -0,0 +1,97 @@
+import base64
+import json
+import sqlite3
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+from speed_dating.benchmark import COLUMNS_O, COLUMNS_PF_O
+from speed_dating.query_pool import close_shared_pools
+from speed_dating.report import (GENDER_LABELS, HEAVY_MODULES, WORKER_STATE, build_report,
+                                 build_section, plotly_js)
+from speed_dating.schema import analysis_queries
+
+# Sections that build quickly (no training or bootstrap)
+SECTIONS = ['preferences', 'avg_attr', 'attraction_variance']
+
+
+@pytest.fixture(scope='module')
+def settings(analysis_database):
+    yield {'database_path': analysis_database, 'snapshot_dir': None, 'model_cache_dir': None}
+
+    WORKER_STATE.clear()
+    close_shared_pools()
+
+
+# Returns a trace's values, decoding plotly's base64 typed arrays
+
+def values(data):
+    if isinstance(data, dict) and 'bdata' in data:
+        return np.frombuffer(base64.b64decode(data['bdata']), dtype=data['dtype'])
+
+    return np.asarray(data, dtype=float)
+
+
+# Returns the traces of a section's figure
+
+def figure_data(name : str, settings : dict):
+    return json.loads(build_section(name, settings)['figure'])['data']
+
+
+def test_importing_the_report_loads_no_heavy_library():
+    loaded = subprocess.run(
+        [sys.executable, '-c', 'import sys, speed_dating.report; '
+                               f'print([name for name in {HEAVY_MODULES!r} '
+                               'if name in sys.modules])'],
+        capture_output=True, text=True, check=True).stdout
+
+    assert loaded.strip() == '[]'
+
+
+def test_figures_match_notebook_queries(analysis_database, settings):
+    queries = analysis_queries(COLUMNS_O, COLUMNS_PF_O)
+    conn = sqlite3.connect(analysis_database)
+    pref_rows = np.array(conn.execute(queries['fetch_pref_data']).fetchall(), dtype=float)
+    avg_attr_rows = np.array(conn.execute(queries['fetch_avg_attr_data']).fetchall(),
+                             dtype=float)
+    conn.close()
+
+    for trace in figure_data('preferences', settings):
+        gender = GENDER_LABELS.index(trace['name'])
+        expected = pref_rows[pref_rows[:, 0] == gender][0, 1:]
+        np.testing.assert_allclose(values(trace['y']), expected)
+
+    for trace in figure_data('avg_attr', settings):
+        gender = GENDER_LABELS.index(trace['name'])
+        actual = np.column_stack([values(trace['x']), values(trace['y'])])
+        expected = avg_attr_rows[avg_attr_rows[:, 0] == gender][:, 1:]
+        # Ties between participants may come in either order
+        np.testing.assert_allclose(actual[np.lexsort(actual.T)],
+                                   expected[np.lexsort(expected.T)])
+
+
+def test_bundle_embeds_plotly_once(settings, tmp_path):
+    output_dir = str(tmp_path / 'report')
+    serial = build_report(output_dir, settings['database_path'], sections=SECTIONS,
+                          max_workers=1)
+    parallel = build_report(output_dir, settings['database_path'], sections=SECTIONS,
+                            max_workers=2)
+
+    with open(tmp_path / 'report' / 'index.html', encoding='utf-8') as file:
+        page = file.read()
+
+    assert page.count(plotly_js()) == 1
+    assert page.count('Plotly.newPlot') == len(SECTIONS)
+    for name in SECTIONS:
+        assert f'<section id="{name}">' in page
+
+    assert [section['section'] for section in parallel['sections']] == SECTIONS
+    assert [section['json_kb'] for section in parallel['sections']] == \
+        [section['json_kb'] for section in serial['sections']]
+    assert [stage['stage'] for stage in serial['stages']] == \
+        ['import_figure_modules', 'build_figures', 'write_html']
+
+    with pytest.raises(ValueError):
+        build_report(output_dir, settings['database_path'], sections=['summary'])
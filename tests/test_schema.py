@@ -0,0 +1,37 @@
+import shutil
+import sqlite3
+
+import numpy as np
+import pytest
+
+from speed_dating.benchmark import COLUMNS_3_1, COLUMNS_O, COLUMNS_PF_O
+from speed_dating.schema import analysis_queries, check_query_plans, create_previous_tables
+
+QUERIES = analysis_queries(COLUMNS_O, COLUMNS_PF_O)
+
+
+# Returns the rows of a query as a 2D float array in a fixed order (the
+# analysis queries only order by some of their columns)
+
+def fetch_sorted(database_path : str, query : str):
+    conn = sqlite3.connect(database_path)
+    rows = np.array(conn.execute(query).fetchall(), dtype=float)
+    conn.close()
+
+    return rows[np.lexsort(rows.T[::-1])]
+
+
+@pytest.mark.parametrize('name', list(QUERIES))
+def test_queries_match_previous_schema(analysis_database, tmp_path, name):
+    previous = str(tmp_path / 'previous.db')
+    shutil.copy(analysis_database, previous)
+    create_previous_tables(previous, COLUMNS_O, COLUMNS_3_1, COLUMNS_PF_O)
+
+    np.testing.assert_allclose(fetch_sorted(analysis_database, QUERIES[name]),
+                               fetch_sorted(previous, QUERIES[name]), atol=1e-9)
+
+
+def test_queries_read_through_indexes(analysis_database):
+    plans = check_query_plans(analysis_database, QUERIES)
+
+    assert {name: plan['full_scans'] for name, plan in plans.items() if plan['full_scans']} == {}
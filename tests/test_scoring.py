@@ -0,0 +1,87 @@
+import json
+import sqlite3
+import threading
+import urllib.error
+import urllib.request
+from http.server import ThreadingHTTPServer
+
+import numpy as np
+import pytest
+from sklearn.ensemble import RandomForestRegressor
+
+from speed_dating.benchmark import COLUMNS_O, COLUMNS_PF_O
+from speed_dating.schema import analysis_queries
+from speed_dating.scoring import ScoringModel, make_handler
+
+
+# Fits a small forest per gender on the rows of the fetch_rating_data query
+
+@pytest.fixture(scope='module')
+def forests(analysis_database):
+    conn = sqlite3.connect(analysis_database)
+    rows = np.array(conn.execute(analysis_queries(COLUMNS_O, COLUMNS_PF_O)['fetch_rating_data'])
+                    .fetchall(), dtype=float)
+    conn.close()
+
+    models = {}
+    for gender in (0, 1):
+        selected = rows[rows[:, 0] == gender]
+        models[gender] = RandomForestRegressor(n_estimators=10, random_state=42)
+        models[gender].fit(selected[:, 2:], selected[:, 1])
+
+    return models, rows[:, 2:], rows[:, 0].astype(int)
+
+
+# Returns the sklearn prediction of each row with its gender's forest
+
+def predict(models : dict, ratings, gender):
+    expected = np.empty(len(ratings))
+    for value, model in models.items():
+        if (gender == value).any():
+            expected[gender == value] = model.predict(ratings[gender == value])
+
+    return expected
+
+
+def test_score_matches_sklearn(forests):
+    models, ratings, gender = forests
+
+    np.testing.assert_allclose(ScoringModel.from_models(models).score(ratings, gender),
+                               predict(models, ratings, gender))
+
+
+def test_saved_model_matches_sklearn(forests, tmp_path):
+    models, ratings, gender = forests
+    ScoringModel.from_models(models).save(str(tmp_path / 'model.npz'))
+
+    np.testing.assert_allclose(ScoringModel.load(str(tmp_path / 'model.npz')).score(ratings,
+                                                                                     gender),
+                               predict(models, ratings, gender))
+
+
+def test_server_matches_sklearn(forests):
+    models, ratings, gender = forests
+    server = ThreadingHTTPServer(('127.0.0.1', 0), make_handler(ScoringModel.from_models(models)))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_address[1]}/score'
+
+    # Sends a scoring request and returns the decoded response
+    def post(payload):
+        request = urllib.request.Request(url, data=json.dumps(payload).encode(),
+                                         headers={'Content-Type': 'application/json'})
+        with urllib.request.urlopen(request) as response:
+            return json.loads(response.read())
+
+    try:
+        # Rows of both genders in one request
+        sample = slice(None, None, 15)
+        response = post({'ratings': ratings[sample].tolist(), 'gender': gender[sample].tolist()})
+        np.testing.assert_allclose(response['dec_o'],
+                                   predict(models, ratings[sample], gender[sample]))
+
+        with pytest.raises(urllib.error.HTTPError) as error:
+            post({'ratings': ratings[:1].tolist(), 'gender': [2]})
+        assert error.value.code == 400
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,87 @@
+import numpy as np
+import pytest
+from sklearn.metrics import accuracy_score, roc_auc_score
+
+from speed_dating.analysis_store import AnalysisStore
+from speed_dating.benchmark import COLUMNS_O
+from speed_dating.classification import make_classifier
+from speed_dating.search import (SearchPool, candidate_grid, search,
+                                 successive_halving_bracket)
+
+# A small space so every fit is quick
+SPACES = {
+    'random_forest': {'n_estimators': (9, 27), 'max_depth': (None, 4),
+                      'min_samples_leaf': (1, 20)},
+    'hist_gradient_boosting': {'max_iter': (9, 27), 'max_depth': (None, 3),
+                               'min_samples_leaf': (5, 50)}
+}
+
+
+@pytest.fixture(scope='module')
+def rating_data(analysis_database):
+    return AnalysisStore.from_database(analysis_database).fetch_rating_data(COLUMNS_O)[0]
+
+
+def test_shared_memory_pool_matches_direct_fits(rating_data):
+    candidates = candidate_grid(spaces=SPACES)[::3]
+
+    with SearchPool(*rating_data, max_workers=1) as pool:
+        arrays = dict(pool.arrays)
+        serial = pool.evaluate(candidates, 1.0, 'both')
+        halved = pool.evaluate(candidates, 1 / 3, 'both')
+    with SearchPool(*rating_data, max_workers=2) as pool:
+        parallel = pool.evaluate(candidates, 1.0, 'both')
+
+    for candidate, result, other, small in zip(candidates, serial, parallel, halved):
+        # The fit the search replaces: the whole model on the whole split
+        model = make_classifier(candidate['model']).set_params(**candidate['params'])
+        model.fit(arrays['X_train'], arrays['y_train'])
+        probabilities = model.predict_proba(arrays['X_val'])[:, 1]
+
+        assert result['accuracy'] == accuracy_score(arrays['y_val'], probabilities > 0.5)
+        assert result['auc'] == pytest.approx(roc_auc_score(arrays['y_val'], probabilities))
+        assert (other['accuracy'], other['auc']) == (result['accuracy'], result['auc'])
+
+        # A third of the budget is a third of the rows and of the trees
+        assert small['rows'] == round(len(arrays['y_train']) / 3)
+        assert small['trees'] == round(result['trees'] / 3)
+
+
+def test_successive_halving_keeps_the_best(rating_data):
+    candidates = candidate_grid(spaces=SPACES)[:9]
+
+    with SearchPool(*rating_data, max_workers=1) as pool:
+        evaluations = successive_halving_bracket(pool, candidates, eta=3, resource='rows')
+
+    rungs = [[evaluation for evaluation in evaluations if evaluation['rung'] == rung]
+             for rung in range(3)]
+    assert [len(rung) for rung in rungs] == [9, 3, 1]
+    assert [rung[0]['fraction'] for rung in rungs] == pytest.approx([1 / 9, 1 / 3, 1.0])
+
+    for rung, following in zip(rungs, rungs[1:]):
+        scores = sorted((evaluation['accuracy'] for evaluation in rung), reverse=True)
+        kept = [evaluation['accuracy'] for evaluation in rung
+                if evaluation['candidate'] in {other['candidate'] for other in following}]
+        assert sorted(kept, reverse=True) == scores[:len(following)]
+
+
+def test_searches_use_less_cpu_than_the_grid(rating_data):
+    candidates = candidate_grid(spaces=SPACES)
+
+    with SearchPool(*rating_data, max_workers=2) as pool:
+        grid = search(None, None, 'grid', candidates, n_candidates=None, pool=pool)
+        halving = search(None, None, 'successive_halving', candidates, n_candidates=9,
+                         pool=pool)
+        hyperband = search(None, None, 'hyperband', candidates, n_candidates=9, pool=pool)
+
+    assert grid['fits'] == len(candidates)
+    assert halving['fits'] == 9 + 3 + 1
+    assert {evaluation['bracket'] for evaluation in hyperband['evaluations']} == {0, 1, 2}
+    assert halving['cpu_seconds'] < grid['cpu_seconds']
+
+    for summary in (grid, halving, hyperband):
+        best = [point['best'] for point in summary['curve']]
+        assert best == sorted(best) and best[-1] == summary['best_accuracy']
+
+    with pytest.raises(ValueError):
+        search(*rating_data, 'random', candidates, max_workers=1)
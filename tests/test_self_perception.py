@@ -0,0 +1,69 @@
+import sqlite3
+
+import numpy as np
+import pytest
+
+from speed_dating.analysis_store import GENDER_LABELS, AnalysisStore
+from speed_dating.query_pool import close_shared_pools
+from speed_dating.self_perception import SELF_RATED_ATTRIBUTES, self_perception
+
+# The bands compared, including a closed one
+BANDS = {'low': (None, 6), 'high': (6, None), 'middle': (3, 8)}
+
+
+@pytest.fixture(scope='module')
+def result(analysis_database):
+    try:
+        yield self_perception(analysis_database, SELF_RATED_ATTRIBUTES, BANDS)
+    finally:
+        close_shared_pools()
+
+
+# Returns the (gender, gap, success ratio) rows of one attribute and band
+# with the query per attribute and band that self_perception replaces
+
+def fetch_band(database_path : str, attribute : str, band : tuple):
+    lower, upper = band
+    conditions = [f'{attribute}3_1 >= {lower}' if lower is not None else '1 = 1',
+                  f'{attribute}3_1 < {upper}' if upper is not None else '1 = 1']
+
+    conn = sqlite3.connect(database_path)
+    rows = conn.execute(f'''
+        SELECT gender, {attribute}3_1 - AVG({attribute}_o), (SUM(dec_o) * 1.0) / COUNT(*)
+        FROM participants AS p
+        JOIN dates AS d ON p.iid = d.iid
+        WHERE {' AND '.join(conditions)}
+        GROUP BY p.iid
+    ''').fetchall()
+    conn.close()
+
+    return np.array(rows, dtype=float).reshape(-1, 3)
+
+
+@pytest.mark.parametrize('attribute', SELF_RATED_ATTRIBUTES)
+def test_one_pass_matches_query_per_band(analysis_database, result, attribute):
+    for label, band in BANDS.items():
+        rows = fetch_band(analysis_database, attribute, band)
+
+        for gender, gender_label in GENDER_LABELS.items():
+            values = result[(attribute, label, gender_label)]
+            expected = rows[rows[:, 0] == gender][:, 1:]
+            expected = expected[np.lexsort(expected.T[::-1])]
+
+            # The gaps are sorted, ties in any order
+            actual = np.column_stack([values['gap'], values['success_ratio']])
+            np.testing.assert_allclose(actual[np.lexsort(actual.T[::-1])], expected,
+                                       err_msg=f'{attribute} {label} {gender_label}')
+            assert np.all(np.diff(values['gap']) >= 0)
+
+
+def test_store_matches_database(analysis_database, result):
+    store = AnalysisStore.from_database(analysis_database)
+    store_result = self_perception(analysis_database, SELF_RATED_ATTRIBUTES, BANDS, store)
+
+    assert list(store_result) == list(result)
+    for key, values in result.items():
+        np.testing.assert_array_equal(store_result[key]['iid'], values['iid'], err_msg=str(key))
+        np.testing.assert_allclose(store_result[key]['gap'], values['gap'], err_msg=str(key))
+        np.testing.assert_allclose(store_result[key]['success_ratio'], values['success_ratio'],
+                                   err_msg=str(key))
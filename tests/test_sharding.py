@@ -0,0 +1,23 @@
+import numpy as np
+
+from speed_dating.benchmark import COLUMNS_3_1, COLUMNS_O, COLUMNS_PF_O, CSV_COLUMNS
+from speed_dating.sharding import run_sharded, shard_partials, store_from_shards
+
+
+def test_sharded_matches_unsharded(analysis_csv, tmp_path):
+    shard_dir = str(tmp_path / 'shards')
+    merged, _ = run_sharded(analysis_csv, shard_dir, CSV_COLUMNS, COLUMNS_O, COLUMNS_3_1,
+                            COLUMNS_PF_O, max_workers=1)
+
+    # The same rows aggregated in one pass
+    whole = shard_partials(store_from_shards(shard_dir), COLUMNS_O)
+
+    assert np.isnan(whole['self_ratings'].key('attr3_1')).any()
+
+    for name, stats in whole.items():
+        np.testing.assert_array_equal(merged[name].keys, stats.keys, err_msg=name)
+        np.testing.assert_array_equal(merged[name].count, stats.count, err_msg=name)
+        np.testing.assert_array_equal(merged[name].successes, stats.successes, err_msg=name)
+        np.testing.assert_array_equal(merged[name].n, stats.n, err_msg=name)
+        np.testing.assert_allclose(merged[name].mean, stats.mean, err_msg=name)
+        np.testing.assert_allclose(merged[name].m2, stats.m2, atol=1e-9, err_msg=name)
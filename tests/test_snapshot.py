@@ -0,0 +1,74 @@
+import shutil
+import sqlite3
+
+import numpy as np
+import pytest
+
+from speed_dating.analysis_store import AnalysisStore, band_filter
+from speed_dating.benchmark import COLUMNS_O, COLUMNS_PF_O
+from speed_dating.snapshot import (SNAPSHOT_TABLES, open_snapshot, snapshot_is_current,
+                                   write_snapshot)
+
+
+@pytest.fixture(scope='module')
+def snapshot_dir(analysis_database, tmp_path_factory):
+    snapshot_dir = str(tmp_path_factory.mktemp('snapshot') / 'speed_dating.snapshot')
+    write_snapshot(analysis_database, snapshot_dir)
+
+    return snapshot_dir
+
+
+def test_snapshot_columns_match_tables(analysis_database, snapshot_dir):
+    tables = open_snapshot(snapshot_dir)
+
+    conn = sqlite3.connect(analysis_database)
+    for table, query in SNAPSHOT_TABLES.items():
+        cursor = conn.execute(query)
+        names = [description[0] for description in cursor.description]
+        rows = np.array(cursor.fetchall(), dtype=float)
+
+        assert list(tables[table]) == names
+        for i, name in enumerate(names):
+            np.testing.assert_array_equal(tables[table][name].astype(float), rows[:, i],
+                                          err_msg=f'{table}.{name}')
+    conn.close()
+
+
+def test_snapshot_store_matches_database_store(analysis_database, snapshot_dir):
+    snapshot_store = AnalysisStore.from_snapshot(snapshot_dir)
+    database_store = AnalysisStore.from_database(analysis_database)
+
+    calls = {
+        'fetch_pref_data': (COLUMNS_PF_O, ['Female', 'Male']),
+        'fetch_avg_attr_data': (),
+        'fetch_avg_self_attr_data': (),
+        'fetch_self_attr_data': (),
+        'fetch_attr_diff_data': (band_filter((6, None)),),
+        'fetch_var_attr_data': ()
+    }
+    for name, args in calls.items():
+        expected = getattr(database_store, name)(*args)
+        actual = getattr(snapshot_store, name)(*args)
+
+        for label in expected:
+            np.testing.assert_array_equal(np.asarray(actual[label], dtype=float),
+                                          np.asarray(expected[label], dtype=float),
+                                          err_msg=f'{name} {label}')
+
+    ratings = snapshot_store.fetch_rating_data(COLUMNS_O)
+    for gender, (values, dec_o) in database_store.fetch_rating_data(COLUMNS_O).items():
+        np.testing.assert_array_equal(ratings[gender][0], values)
+        np.testing.assert_array_equal(ratings[gender][1], dec_o)
+
+
+def test_snapshot_is_stale_after_update(analysis_database, snapshot_dir, tmp_path):
+    assert snapshot_is_current(snapshot_dir, analysis_database)
+
+    database_path = str(tmp_path / 'speed_dating.db')
+    shutil.copy(analysis_database, database_path)
+    conn = sqlite3.connect(database_path)
+    conn.execute('UPDATE dates SET attr_o = attr_o + 1 WHERE date_id = 1')
+    conn.commit()
+    conn.close()
+
+    assert not snapshot_is_current(snapshot_dir, database_path)
@@ -0,0 +1,157 @@
+import shutil
+import sqlite3
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from speed_dating.benchmark import COLUMNS_3_1, COLUMNS_O, COLUMNS_PF_O, CSV_COLUMNS, generate_csv
+from speed_dating.imputation import KNNImputationEngine
+from speed_dating.ingest import create_db_streaming
+from speed_dating.pairs import build_pairs
+from speed_dating.preprocessing import preprocess
+from speed_dating.schema import build_schema
+from speed_dating.summaries import SUMMARY_TABLES, append_dates, build_summaries
+
+# The order the summary tables are compared in
+SUMMARY_KEYS = {'participant_summary': 'iid', 'self_rating_summary': 'gender, attr3_1'}
+
+
+# Builds a database with the pipeline's tables, summaries and triggers from
+# the earlier waves of a synthetic .csv, keeping the last wave as one night
+# to append
+
+@pytest.fixture(scope='module')
+def base_database(tmp_path_factory):
+    directory = tmp_path_factory.mktemp('summaries')
+    csv_file = directory / 'speed_dating.csv'
+    generate_csv(str(csv_file), 3_000, seed=1)
+
+    rows = pd.read_csv(csv_file, encoding='latin')
+    last_wave = rows['wave'].max()
+    rows[rows['wave'] < last_wave].to_csv(directory / 'base.csv', index=False, encoding='latin')
+    rows[rows['wave'] == last_wave].to_csv(directory / 'night.csv', index=False, encoding='latin')
+
+    database_path = str(directory / 'base.db')
+    create_db_streaming(str(directory / 'base.csv'), 'latin', database_path, CSV_COLUMNS)
+    preprocess(database_path, COLUMNS_O, COLUMNS_3_1, COLUMNS_PF_O, 3, COLUMNS_O)
+    build_schema(database_path, COLUMNS_O, COLUMNS_3_1, COLUMNS_PF_O)
+    build_pairs(database_path, COLUMNS_O)
+    build_summaries(database_path, COLUMNS_O)
+
+    return directory
+
+
+# Returns a copy of the base database for one test
+
+@pytest.fixture
+def database_path(base_database, tmp_path):
+    path = str(tmp_path / 'speed_dating.db')
+    shutil.copy(base_database / 'base.db', path)
+    return path
+
+
+# Returns the rows of each summary table with dates, in key order (groups
+# emptied by deletions keep a row of zeros that a rebuild leaves out)
+
+def read_summaries(database_path : str):
+    conn = sqlite3.connect(database_path)
+    summaries = {table: pd.read_sql(f'SELECT * FROM {table} WHERE dates > 0 ORDER BY {key}',
+                                    conn)
+                 for table, key in SUMMARY_KEYS.items()}
+    conn.close()
+
+    return summaries
+
+
+# Checks the summaries kept by the triggers equal the summaries rebuilt from
+# the dates and participants tables
+
+def assert_matches_rebuild(database_path : str, tmp_path):
+    incremental = read_summaries(database_path)
+
+    rebuilt_path = str(tmp_path / 'rebuilt.db')
+    shutil.copy(database_path, rebuilt_path)
+    build_summaries(rebuilt_path, COLUMNS_O)
+    rebuilt = read_summaries(rebuilt_path)
+
+    for table in SUMMARY_TABLES:
+        assert list(incremental[table].columns) == list(rebuilt[table].columns)
+        assert incremental[table].shape == rebuilt[table].shape, table
+        np.testing.assert_allclose(incremental[table].to_numpy(dtype=float),
+                                   rebuilt[table].to_numpy(dtype=float), rtol=1e-9, atol=1e-9,
+                                   err_msg=table)
+
+
+def test_append_dates_matches_rebuild(base_database, database_path, tmp_path):
+    conn = sqlite3.connect(database_path)
+    dates_before = conn.execute('SELECT COUNT(*) FROM dates').fetchone()[0]
+    conn.close()
+
+    append_dates(str(base_database / 'night.csv'), database_path, CSV_COLUMNS, COLUMNS_O,
+                 COLUMNS_3_1, COLUMNS_PF_O)
+
+    conn = sqlite3.connect(database_path)
+    assert conn.execute('SELECT COUNT(*) FROM dates').fetchone()[0] > dates_before
+    conn.close()
+
+    assert_matches_rebuild(database_path, tmp_path)
+
+
+def test_append_dates_reuses_engine(base_database, database_path, tmp_path):
+    # The night split in two, with both rows of each date in the same half
+    rows = pd.read_csv(base_database / 'night.csv', encoding='latin')
+    halves = rows[['iid', 'pid']].min(axis=1) % 2
+    for half in (0, 1):
+        rows[halves == half].to_csv(tmp_path / f'half_{half}.csv', index=False,
+                                    encoding='latin')
+
+    engine = KNNImputationEngine(5)
+    append_dates(str(tmp_path / 'half_0.csv'), database_path, CSV_COLUMNS, COLUMNS_O,
+                 COLUMNS_3_1, COLUMNS_PF_O, engine=engine)
+    donors = len(engine.donors)
+
+    conn = sqlite3.connect(database_path)
+    last_rowid = conn.execute('SELECT MAX(rowid) FROM speed_dating').fetchone()[0]
+    conn.close()
+
+    report = append_dates(str(tmp_path / 'half_1.csv'), database_path, CSV_COLUMNS, COLUMNS_O,
+                          COLUMNS_3_1, COLUMNS_PF_O, engine=engine)
+
+    # Only the complete rows of the second half were added as donors
+    conn = sqlite3.connect(database_path)
+    new_rows = conn.execute('SELECT COUNT(*) FROM speed_dating WHERE rowid > ?',
+                            (last_rowid,)).fetchone()[0]
+    conn.close()
+    imputed = next(stage['rows'] for stage in report if stage['stage'] == 'data_imputation')
+
+    assert len(engine.donors) == donors + new_rows - imputed
+
+    assert_matches_rebuild(database_path, tmp_path)
+
+
+def test_updated_dates_and_participants_match_rebuild(database_path, tmp_path):
+    conn = sqlite3.connect(database_path)
+    # New ratings and decisions, a NULL rating and participants moving
+    # between (gender, attr3_1) groups, including to a NULL self-rating
+    conn.execute('UPDATE dates SET attr_o = attr_o + 1, dec_o = 1 - dec_o WHERE date_id % 7 = 0')
+    conn.execute('UPDATE dates SET sinc_o = NULL WHERE date_id % 11 = 0')
+    conn.execute('UPDATE participants SET attr3_1 = 10 - attr3_1 WHERE iid % 5 = 0')
+    conn.execute('UPDATE participants SET attr3_1 = NULL WHERE iid % 13 = 0')
+    conn.execute('UPDATE participants SET gender = 1 - gender WHERE iid % 17 = 0')
+    conn.commit()
+    conn.close()
+
+    assert_matches_rebuild(database_path, tmp_path)
+
+
+def test_deleted_dates_and_participants_match_rebuild(database_path, tmp_path):
+    conn = sqlite3.connect(database_path)
+    conn.execute('DELETE FROM dates WHERE date_id % 3 = 0')
+    # Every date of one participant, then participants whose dates remain
+    conn.execute('DELETE FROM dates WHERE iid = (SELECT MIN(iid) FROM dates)')
+    conn.execute('DELETE FROM participants WHERE iid % 9 = 0')
+    conn.commit()
+    conn.close()
+
+    assert_matches_rebuild(database_path, tmp_path)
@@ -0,0 +1,100 @@
+import json
+import sqlite3
+
+import pytest
+
+from speed_dating.tracing import (TRACER, connect, disable_tracing, enable_tracing,
+                                  export_folded, export_json, self_seconds, span,
+                                  summarise_spans)
+
+
+@pytest.fixture
+def tracing():
+    enable_tracing()
+    try:
+        yield
+    finally:
+        disable_tracing()
+
+
+def test_spans_nest_stages_and_statements(tracing, tmp_path):
+    database_path = str(tmp_path / 'traced.db')
+
+    # The statements as sqlite3's own trace callback sees them
+    statements = []
+    with span('outer', rows_in=3) as outer:
+        conn = connect(database_path)
+        with span('create'):
+            conn.execute('CREATE TABLE t (x INTEGER)')
+            conn.executemany('INSERT INTO t VALUES (?)', [(1,), (2,), (3,)])
+            conn.commit()
+        outer.set(rows_out=conn.execute('SELECT COUNT(*) FROM t').fetchone()[0])
+        conn.close()
+
+    plain = sqlite3.connect(database_path)
+    plain.set_trace_callback(statements.append)
+    plain.execute('SELECT COUNT(*) FROM t').fetchone()
+    plain.close()
+
+    spans = disable_tracing()
+    by_name = {record['name']: record for record in spans}
+
+    assert by_name['outer']['parent'] is None
+    assert by_name['outer']['rows_in'] == 3 and by_name['outer']['rows_out'] == 3
+    assert by_name['create']['parent'] == by_name['outer']['id']
+    assert by_name['CREATE TABLE t (x INTEGER)']['parent'] == by_name['create']['id']
+    # executemany is one span with a call per row
+    assert by_name['INSERT INTO t VALUES (?)']['calls'] == 3
+    assert by_name[statements[0]]['parent'] == by_name['outer']['id']
+
+    # A child never outlasts its parent
+    for record in spans:
+        if record['parent'] is not None:
+            parent = next(other for other in spans if other['id'] == record['parent'])
+            assert record['start'] >= parent['start']
+            assert record['seconds'] <= parent['seconds'] + 1e-6
+
+
+def test_exports_keep_every_span(tracing, tmp_path):
+    conn = connect(str(tmp_path / 'traced.db'))
+    with span('outer'):
+        with span('inner'):
+            conn.execute('WITH RECURSIVE n(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM n '
+                         'WHERE x < 100000) SELECT SUM(x) FROM n').fetchone()
+    conn.close()
+    spans = disable_tracing()
+
+    export_json(spans, str(tmp_path / 'trace.json'))
+    with open(tmp_path / 'trace.json') as file:
+        events = json.load(file)['traceEvents']
+    assert [event['name'] for event in events] == [record['name'] for record in spans]
+
+    # The folded stacks add up to the self time of every span
+    export_folded(spans, str(tmp_path / 'trace.folded'))
+    with open(tmp_path / 'trace.folded') as file:
+        stacks = dict(line.rsplit(' ', 1) for line in file.read().splitlines())
+    assert any(stack.startswith('outer;inner;WITH RECURSIVE') for stack in stacks)
+    assert sum(int(value) for value in stacks.values()) == pytest.approx(
+        sum(self_seconds(spans).values()) * 1e6, abs=len(spans))
+
+    summary = {entry['name']: entry for entry in summarise_spans(spans)}
+    assert summary['outer']['seconds'] >= summary['inner']['seconds']
+
+
+def test_disabled_tracing_adds_nothing(tmp_path):
+    assert span('stage') is span('other')
+
+    conn = connect(str(tmp_path / 'plain.db'))
+    assert type(conn) is sqlite3.Connection
+    conn.close()
+
+    enable_tracing()
+    conn = connect(str(tmp_path / 'traced.db'))
+    assert id(conn) in TRACER.connections
+    disable_tracing()
+
+    # The callbacks are removed so the connection records nothing after
+    assert not TRACER.connections
+    conn.execute('SELECT 1').fetchone()
+    assert not TRACER.statements
+    conn.close()
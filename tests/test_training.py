@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+
+from speed_dating.analysis_store import AnalysisStore
+from speed_dating.benchmark import COLUMNS_O
+from speed_dating.notebook import load_notebook_functions
+from speed_dating.training import fit_model, train_and_evaluate_parallel
+
+GENDER_LABELS = ['Female', 'Male']
+
+
+@pytest.fixture(scope='module')
+def rating_data(analysis_database):
+    return AnalysisStore.from_database(analysis_database).fetch_rating_data(COLUMNS_O)
+
+
+def test_parallel_training_matches_notebook(rating_data, tmp_path):
+    train_and_evaluate = load_notebook_functions()['train_and_evaluate']
+    expected = train_and_evaluate(rating_data, GENDER_LABELS)
+
+    cache_dir = str(tmp_path / 'models')
+    for cache in ('miss', 'hit'):
+        *results, reports = train_and_evaluate_parallel(rating_data, GENDER_LABELS,
+                                                        cache_dir=cache_dir, max_workers=2)
+
+        assert {report['cache'] for report in reports.values()} == {cache}
+        np.testing.assert_allclose(results[0], expected[0])
+        np.testing.assert_allclose(results[1], expected[1])
+        for label in GENDER_LABELS:
+            np.testing.assert_allclose(results[2][label], expected[2][label])
+
+
+def test_warm_start_matches_fresh_fit(rating_data, tmp_path):
+    X, y = rating_data[0]
+    cache_dir = str(tmp_path / 'models')
+
+    fit_model(X, y, n_estimators=10, cache_dir=cache_dir)
+    grown, (_, X_test, _, _), report = fit_model(X, y, n_estimators=20, cache_dir=cache_dir)
+    fresh, _, _ = fit_model(X, y, n_estimators=20, cache_dir=None)
+
+    assert report['cache'] == 'warm_start'
+    np.testing.assert_allclose(grown.predict(X_test), fresh.predict(X_test))